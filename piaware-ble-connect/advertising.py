@@ -0,0 +1,297 @@
+""" Event driven controller that enables/disables BLE advertising
+
+    The controller runs entirely on the GLib mainloop. Receiver state is
+    re-evaluated when piaware's status.json changes, when the kernel reports a
+    network change, and on a poll timer that tightens while a central is
+    connected. Requests to piaware-configurator run on the request dispatcher
+    so the mainloop is never blocked.
+
+"""
+import logging
+import time
+from gi.repository import GLib, Gio
+
+import constants
+from piaware_status import status_reader
+from request_handlers import advertising_should_be_on, is_ethernet_active, device_state
+
+logger = logging.getLogger('piaware_ble_connect')
+
+# Seconds the BLE service stays up before shutting itself down
+BLE_TIMEOUT_SECONDS = 15 * 60
+
+# Seconds to wait for Ethernet to come up before deciding whether BLE is needed
+ETHERNET_GRACE_SECONDS = 10
+
+# Poll intervals (seconds) while idle and while a central is connected
+IDLE_POLL_INTERVAL = 60
+CONNECTED_POLL_INTERVAL = 5
+
+# Coalesce bursts of file/network events into one state check (milliseconds)
+EVENT_DEBOUNCE_MS = 250
+
+
+class AdvertisingController():
+    ''' State machine deciding whether the BLE peripheral should advertise
+
+        States:
+        starting   - giving Ethernet time to come up before the first check
+        monitoring - tracking receiver state and toggling advertising
+        stopped    - BLE service is being shut down
+    '''
+    STARTING = 'starting'
+    MONITORING = 'monitoring'
+    STOPPED = 'stopped'
+
+    def __init__(self, ble_peripheral, piaware_configurator_url, dispatcher,
+                 is_central_connected, stop_service):
+        '''
+            Parameters:
+            ble_peripheral (BLE_Peripheral): Peripheral to start/stop advertising on
+            piaware_configurator_url (str): URL of piaware-configurator to request receiver data from
+            dispatcher (RequestDispatcher): Worker pool for piaware-configurator requests
+            is_central_connected (callable): Returns True while a central is subscribed
+            stop_service (callable): Shuts down the BLE service
+        '''
+        self.ble_peripheral = ble_peripheral
+        self.piaware_configurator_url = piaware_configurator_url
+        self.dispatcher = dispatcher
+        self.is_central_connected = is_central_connected
+        self.stop_service = stop_service
+
+        self.state = None
+        self.deadline = None
+        self.advertising_blocked = False
+        self.ethernet_checked = False
+        self.configurator_says_off = False
+        self.check_in_flight = False
+        self.check_pending = False
+
+        self.poll_source = None
+        self.poll_connected = None
+        self.debounce_source = None
+        self.deadline_source = None
+        self.grace_source = None
+        self.status_monitor = None
+        self.network_monitor = None
+        self.network_handler = None
+
+    def start(self):
+        ''' Install event sources and begin monitoring. Must be called on the mainloop
+
+        '''
+        self.deadline = time.monotonic() + BLE_TIMEOUT_SECONDS
+        self.deadline_source = GLib.timeout_add_seconds(BLE_TIMEOUT_SECONDS, self.on_deadline)
+
+        # inotify watch on piaware's status file, claim/connection state lives there
+        status_file = Gio.File.new_for_path(constants.PIAWARE_STATUS_JSON)
+        self.status_monitor = status_file.monitor_file(Gio.FileMonitorFlags.NONE, None)
+        self.status_monitor.connect('changed', self.on_status_changed)
+        status_reader.add_listener(self.on_status_snapshot)
+        status_reader.read()
+
+        # netlink backed notification of link/route changes
+        self.network_monitor = Gio.NetworkMonitor.get_default()
+        self.network_handler = self.network_monitor.connect('network-changed', self.on_network_changed)
+
+        if self.ble_peripheral.ethernet_present:
+            logger.info(f'Making sure everything is up before enabling Bluetooth LE Advertising...')
+            self.state = self.STARTING
+            self.grace_source = GLib.timeout_add_seconds(ETHERNET_GRACE_SECONDS, self.on_grace_elapsed)
+        else:
+            logger.info(f'No ethernet interface present')
+            self.begin_monitoring()
+
+    def stop(self):
+        self.state = self.STOPPED
+        for source in (self.poll_source, self.debounce_source, self.deadline_source, self.grace_source):
+            if source is not None:
+                GLib.source_remove(source)
+        self.poll_source = self.debounce_source = self.deadline_source = self.grace_source = None
+
+        if self.status_monitor is not None:
+            self.status_monitor.cancel()
+            self.status_monitor = None
+        if self.network_handler is not None:
+            self.network_monitor.disconnect(self.network_handler)
+            self.network_handler = None
+
+    def remaining_seconds(self):
+        return max(0, self.deadline - time.monotonic())
+
+    def on_status_changed(self, monitor, file, other_file, event_type):
+        if event_type in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED,
+                          Gio.FileMonitorEvent.MOVED_IN, Gio.FileMonitorEvent.RENAMED,
+                          Gio.FileMonitorEvent.DELETED):
+            # Re-reads the file and notifies on_status_snapshot if the state changed
+            status_reader.read()
+
+    def on_status_snapshot(self, snapshot):
+        # Listeners may be called from worker threads, hop back to the mainloop
+        GLib.idle_add(self.on_status_snapshot_idle)
+
+    def on_status_snapshot_idle(self):
+        self.schedule_check()
+        return GLib.SOURCE_REMOVE
+
+    def on_network_changed(self, monitor, available):
+        logger.debug(f'Network change detected (available: {available})')
+        self.schedule_check()
+
+    def schedule_check(self):
+        ''' Debounce an event triggered state check
+
+        '''
+        if self.state == self.STOPPED or self.debounce_source is not None:
+            return
+        self.debounce_source = GLib.timeout_add(EVENT_DEBOUNCE_MS, self.on_debounce_elapsed)
+
+    def on_debounce_elapsed(self):
+        self.debounce_source = None
+        # Events mean state likely changed, don't reuse a recent snapshot
+        device_state.invalidate()
+        if self.state == self.STARTING:
+            self.submit(is_ethernet_active, self.on_early_ethernet_state)
+        elif self.state == self.MONITORING:
+            self.check()
+        return GLib.SOURCE_REMOVE
+
+    def on_grace_elapsed(self):
+        self.grace_source = None
+        self.begin_monitoring()
+        return GLib.SOURCE_REMOVE
+
+    def on_early_ethernet_state(self, ethernet_active):
+        # Ethernet came up during the grace period, no need to wait it out
+        if self.state == self.STARTING and ethernet_active:
+            GLib.source_remove(self.grace_source)
+            self.grace_source = None
+            self.on_ethernet_state(ethernet_active)
+
+    def begin_monitoring(self):
+        logger.info(f'Starting BLE Advertising Mode monitor')
+        self.state = self.MONITORING
+        self.check_ethernet()
+
+    def check_ethernet(self):
+        self.submit(is_ethernet_active, self.on_ethernet_state)
+
+    def on_ethernet_state(self, ethernet_active):
+        if self.state == self.STOPPED:
+            return
+        # Unknown when piaware-configurator could not be asked, the next poll retries
+        if ethernet_active is not None:
+            self.ethernet_checked = True
+
+        if ethernet_active:
+            logger.info(f'Ethernet is connected. PiAware Bluetooth service is not needed')
+            self.shutdown()
+            return
+
+        current_advertising_state = "on" if self.ble_peripheral.is_advertising else "off"
+        logger.info(f'PiAware Bluetooth advertising is currently {current_advertising_state}')
+        self.check()
+
+    def check(self):
+        ''' Evaluate whether advertising should be on, at most one check at a time
+
+        '''
+        if self.check_in_flight:
+            self.check_pending = True
+            return
+
+        # Once piaware-configurator has reported the receiver claimed and
+        # connected, piaware's own status file is enough to confirm that it
+        # still is. The file alone never turns advertising off
+        snapshot = status_reader.read()
+        if self.configurator_says_off and snapshot is not None and snapshot.is_claimed and snapshot.is_connected:
+            self.on_advertising_state(False)
+            return
+
+        self.check_in_flight = True
+        self.submit(advertising_should_be_on, self.on_configurator_state)
+
+    def on_configurator_state(self, should_advertising_be_on):
+        self.configurator_says_off = should_advertising_be_on == False
+        self.on_advertising_state(should_advertising_be_on)
+
+    def on_advertising_state(self, should_advertising_be_on):
+        self.check_in_flight = False
+        if self.state != self.MONITORING:
+            return
+
+        is_advertising = self.ble_peripheral.is_advertising
+
+        # Advertising ON but should be off now. Disable BLE advertising
+        if is_advertising == True and should_advertising_be_on == False:
+            logger.info(f'PiAware has been connected and claimed. Disabling PiAware Bluetooth discovery mode.')
+            self.ble_peripheral.stop_advertising()
+
+        # Advertising OFF and should be OFF. But let's leave the service on until BLE timeout reached. Existing connections may still need it.
+        elif is_advertising == False and should_advertising_be_on == False:
+            logger.debug(f'BLE Discovery mode is OFF')
+
+        # Advertising OFF and should be ON. Enable BLE advertising
+        elif is_advertising == False and should_advertising_be_on == True:
+            # Never re-enable advertising for security purposes. Reboot is required
+            if not self.advertising_blocked:
+                logger.info(f'PiAware is not connected to FlightAware and/or unclaimed. Enabling Bluetooth LE advertising mode.')
+                self.ble_peripheral.start_advertising()
+                self.advertising_blocked = True
+
+        if self.check_pending:
+            self.check_pending = False
+            self.check()
+        else:
+            self.schedule_poll()
+
+    def schedule_poll(self):
+        ''' Arm the poll timer, polling more often while a central is connected
+
+        '''
+        if self.poll_source is not None:
+            GLib.source_remove(self.poll_source)
+        self.poll_connected = self.is_central_connected()
+        interval = CONNECTED_POLL_INTERVAL if self.poll_connected else IDLE_POLL_INTERVAL
+        logger.debug(f'Next advertising check in {interval}s, {self.remaining_seconds():.0f}s until BLE timeout')
+        self.poll_source = GLib.timeout_add_seconds(interval, self.on_poll)
+
+    def connection_changed(self):
+        ''' Re-arm a pending poll if a central connected or disconnected since it was armed
+
+        '''
+        if self.state != self.MONITORING or self.poll_source is None:
+            return
+        if self.is_central_connected() != self.poll_connected:
+            self.schedule_poll()
+
+    def on_poll(self):
+        self.poll_source = None
+        if self.state != self.MONITORING:
+            return GLib.SOURCE_REMOVE
+
+        # The Ethernet check decides whether BLE is needed at all, retry it until it has run
+        if self.ethernet_checked:
+            self.check()
+        else:
+            self.check_ethernet()
+        return GLib.SOURCE_REMOVE
+
+    def on_deadline(self):
+        self.deadline_source = None
+        logger.info(f'Bluetooth discovery enabled timeout reached. Shutting down PiAware Bluetooth service.')
+        self.ble_peripheral.stop_advertising()
+        self.shutdown()
+        return GLib.SOURCE_REMOVE
+
+    def shutdown(self):
+        self.stop()
+        self.stop_service()
+
+    def submit(self, func, callback):
+        queued = self.dispatcher.submit(func, (self.piaware_configurator_url,), callback,
+                                        label=func.__name__)
+        if not queued:
+            # Worker pool saturated by BLE requests, try again on the next poll
+            self.check_in_flight = False
+            self.schedule_poll()
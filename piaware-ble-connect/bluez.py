@@ -8,6 +8,7 @@ SPDX-License-Identifier: LGPL-2.1-or-later
 '''
 import dbus
 import dbus.service
+import socket
 
 from constants import *
 import logging
@@ -34,8 +35,45 @@ class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
 
-class Advertisement(dbus.service.Object):
+class CachedProperties():
+    """
+    Caches the D-Bus properties of a BlueZ object until they change
+
+    Subclasses implement build_properties() and list the attributes it reads
+    in PROPERTY_ATTRIBUTES; assigning one of them invalidates the cache.
+    Methods that mutate those attributes in place must call
+    invalidate_properties() themselves. The cached dictionaries are shared
+    between calls and must not be modified by callers.
+    """
+    PROPERTY_ATTRIBUTES = ()
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.PROPERTY_ATTRIBUTES:
+            self.invalidate_properties()
+
+    def get_properties(self):
+        properties = self.__dict__.get('cached_properties')
+        if properties is None:
+            properties = self.build_properties()
+            self.__dict__['cached_properties'] = properties
+        return properties
+
+    def invalidate_properties(self):
+        self.__dict__['cached_properties'] = None
+        self.invalidate_tree()
+
+    def invalidate_tree(self):
+        # Let the owning object (and ultimately the Application) know the tree changed
+        owner = self.__dict__.get('owner')
+        if owner is not None:
+            owner.invalidate_tree()
+
+
+class Advertisement(CachedProperties, dbus.service.Object):
     PATH_BASE = '/org/bluez/example/advertisement'
+    PROPERTY_ATTRIBUTES = ('ad_type', 'service_uuids', 'manufacturer_data', 'solicit_uuids',
+                           'service_data', 'local_name', 'include_tx_power', 'data')
 
     def __init__(self, bus, index, advertising_type):
         self.path = self.PATH_BASE + str(index)
@@ -50,8 +88,8 @@ class Advertisement(dbus.service.Object):
         self.data = None
         dbus.service.Object.__init__(self, bus, self.path)
 
-    def get_properties(self):
-        properties = dict()
+    def build_properties(self):
+        properties = dbus.Dictionary({}, signature='sv')
         properties['Type'] = self.ad_type
         if self.service_uuids is not None:
             properties['ServiceUUIDs'] = dbus.Array(self.service_uuids,
@@ -73,7 +111,7 @@ class Advertisement(dbus.service.Object):
         if self.data is not None:
             properties['Data'] = dbus.Dictionary(
                 self.data, signature='yv')
-        return {LE_ADVERTISEMENT_IFACE: properties}
+        return dbus.Dictionary({LE_ADVERTISEMENT_IFACE: properties}, signature='sa{sv}')
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -82,21 +120,25 @@ class Advertisement(dbus.service.Object):
         if not self.service_uuids:
             self.service_uuids = []
         self.service_uuids.append(uuid)
+        self.invalidate_properties()
 
     def add_solicit_uuid(self, uuid):
         if not self.solicit_uuids:
             self.solicit_uuids = []
         self.solicit_uuids.append(uuid)
+        self.invalidate_properties()
 
     def add_manufacturer_data(self, manuf_code, data):
         if not self.manufacturer_data:
             self.manufacturer_data = dbus.Dictionary({}, signature='qv')
         self.manufacturer_data[manuf_code] = dbus.Array(data, signature='y')
+        self.invalidate_properties()
 
     def add_service_data(self, uuid, data):
         if not self.service_data:
             self.service_data = dbus.Dictionary({}, signature='sv')
         self.service_data[uuid] = dbus.Array(data, signature='y')
+        self.invalidate_properties()
 
     def add_local_name(self, name):
         if not self.local_name:
@@ -107,6 +149,7 @@ class Advertisement(dbus.service.Object):
         if not self.data:
             self.data = dbus.Dictionary({}, signature='yv')
         self.data[ad_type] = dbus.Array(data, signature='y')
+        self.invalidate_properties()
 
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
@@ -126,21 +169,29 @@ class Advertisement(dbus.service.Object):
 class Application(dbus.service.Object):
     """
     org.bluez.GattApplication1 interface implementation
+
+    The GetManagedObjects reply is built once and reused until a service,
+    characteristic or descriptor is added or one of their properties changes.
     """
     def __init__(self, bus):
         self.path = '/'
         self.services = []
+        self.managed_objects = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
+        service.owner = self
         self.services.append(service)
+        self.invalidate_tree()
 
-    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
+    def invalidate_tree(self):
+        self.managed_objects = None
+
+    def build_managed_objects(self):
+        response = dbus.Dictionary({}, signature='oa{sa{sv}}')
         for service in self.services:
             response[service.get_path()] = service.get_properties()
             chrcs = service.get_characteristics()
@@ -152,12 +203,19 @@ class Application(dbus.service.Object):
 
         return response
 
+    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        if self.managed_objects is None:
+            self.managed_objects = self.build_managed_objects()
+        return self.managed_objects
+
 
-class Service(dbus.service.Object):
+class Service(CachedProperties, dbus.service.Object):
     """
     org.bluez.GattService1 interface implementation
     """
     PATH_BASE = '/org/bluez/example/service'
+    PROPERTY_ATTRIBUTES = ('uuid', 'primary', 'characteristics')
 
     def __init__(self, bus, index, uuid, primary):
         self.path = self.PATH_BASE + str(index)
@@ -165,24 +223,27 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.owner = None
         dbus.service.Object.__init__(self, bus, self.path)
 
-    def get_properties(self):
-        return {
-                GATT_SERVICE_IFACE: {
-                        'UUID': self.uuid,
-                        'Primary': self.primary,
+    def build_properties(self):
+        return dbus.Dictionary({
+                GATT_SERVICE_IFACE: dbus.Dictionary({
+                        'UUID': dbus.String(self.uuid),
+                        'Primary': dbus.Boolean(self.primary),
                         'Characteristics': dbus.Array(
                                 self.get_characteristic_paths(),
                                 signature='o')
-                }
-        }
+                }, signature='sv')
+        }, signature='sa{sv}')
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_characteristic(self, characteristic):
+        characteristic.owner = self
         self.characteristics.append(characteristic)
+        self.invalidate_properties()
 
     def get_characteristic_paths(self):
         result = []
@@ -203,10 +264,12 @@ class Service(dbus.service.Object):
         return self.get_properties()[GATT_SERVICE_IFACE]
 
 
-class Characteristic(dbus.service.Object):
+class Characteristic(CachedProperties, dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
     """
+    PROPERTY_ATTRIBUTES = ('uuid', 'flags', 'descriptors', 'write_acquired', 'notify_acquired')
+
     def __init__(self, bus, index, uuid, flags, service):
         self.path = service.path + '/char' + str(index)
         self.bus = bus
@@ -214,25 +277,36 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
+        # Set to True/False by subclasses that implement AcquireWrite/AcquireNotify.
+        # BlueZ only offers fd based access when these properties are present.
+        self.write_acquired = None
+        self.notify_acquired = None
+        self.owner = service
         dbus.service.Object.__init__(self, bus, self.path)
 
-    def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
-        }
+    def build_properties(self):
+        properties = dbus.Dictionary({
+                'Service': self.service.get_path(),
+                'UUID': dbus.String(self.uuid),
+                'Flags': dbus.Array(self.flags, signature='s'),
+                'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
+        }, signature='sv')
+        if self.write_acquired is not None:
+            properties['WriteAcquired'] = dbus.Boolean(self.write_acquired)
+        if self.notify_acquired is not None:
+            properties['NotifyAcquired'] = dbus.Boolean(self.notify_acquired)
+
+        return dbus.Dictionary({GATT_CHRC_IFACE: properties}, signature='sa{sv}')
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
+        descriptor.owner = self
         self.descriptors.append(descriptor)
+        self.invalidate_properties()
 
     def get_descriptor_paths(self):
         result = []
@@ -243,6 +317,16 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
+    def create_acquired_socket(self):
+        ''' Create a socket pair for AcquireWrite/AcquireNotify
+
+            Returns: (local socket, dbus.types.UnixFd to hand to BlueZ)
+        '''
+        local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        fd = dbus.types.UnixFd(remote)
+        remote.close()
+        return local, fd
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -264,6 +348,20 @@ class Characteristic(dbus.service.Object):
         logger.info('Default WriteValue called, returning error')
         raise NotSupportedException()
 
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='hq')
+    def AcquireWrite(self, options):
+        logger.info('Default AcquireWrite called, returning error')
+        raise NotSupportedException()
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='hq')
+    def AcquireNotify(self, options):
+        logger.info('Default AcquireNotify called, returning error')
+        raise NotSupportedException()
+
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
         logger.info('Default StartNotify called, returning error')
@@ -280,26 +378,29 @@ class Characteristic(dbus.service.Object):
         pass
 
 
-class Descriptor(dbus.service.Object):
+class Descriptor(CachedProperties, dbus.service.Object):
     """
     org.bluez.GattDescriptor1 interface implementation
     """
+    PROPERTY_ATTRIBUTES = ('uuid', 'flags')
+
     def __init__(self, bus, index, uuid, flags, characteristic):
         self.path = characteristic.path + '/desc' + str(index)
         self.bus = bus
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
+        self.owner = characteristic
         dbus.service.Object.__init__(self, bus, self.path)
 
-    def get_properties(self):
-        return {
-                GATT_DESC_IFACE: {
+    def build_properties(self):
+        return dbus.Dictionary({
+                GATT_DESC_IFACE: dbus.Dictionary({
                         'Characteristic': self.chrc.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                }
-        }
+                        'UUID': dbus.String(self.uuid),
+                        'Flags': dbus.Array(self.flags, signature='s'),
+                }, signature='sv')
+        }, signature='sa{sv}')
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -0,0 +1,245 @@
+""" Persistent HTTP client for piaware-configurator
+
+    piaware-configurator is always reached over loopback (or a Unix domain
+    socket), so connections are kept alive and reused across requests instead
+    of paying a TCP handshake for every BLE request and advertising check.
+
+"""
+import json
+import logging
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from metrics import metrics
+from recorder import recorder
+
+logger = logging.getLogger('piaware_ble_connect')
+
+DEFAULT_TIMEOUT = 20
+
+# Requests that only read state from piaware-configurator should answer quickly
+REQUEST_TIMEOUTS = {
+    'get_device_info': 10,
+    'get_device_state': 10,
+    'piaware_config_read': 10,
+    'get_wifi_networks': 20,
+    'set_wifi_config': 20,
+}
+
+# Requests that change receiver configuration and invalidate cached responses
+MUTATING_REQUESTS = [
+    'set_wifi_config',
+]
+
+QUICKACK_SUPPORTED = hasattr(socket, 'TCP_QUICKACK')
+
+
+def preload():
+    ''' Import the HTTP connection classes ahead of the first request
+
+    '''
+    import configurator_http
+
+
+class ConfiguratorClient():
+    ''' Keep-alive JSON client for one piaware-configurator URL
+
+        Idle connections are kept in a small pool so concurrent worker
+        threads each get their own connection.
+    '''
+    def __init__(self, url, unix_socket=None, pool_size=4):
+        split_url = urlsplit(url)
+        self.url = url
+        self.host = split_url.hostname
+        self.port = split_url.port
+        self.path = split_url.path or '/'
+        self.unix_socket = unix_socket
+        self.pool_size = pool_size
+        self.idle_connections = []
+        self.lock = threading.Lock()
+
+    def post(self, json_body, timeout=None):
+        """ Send a JSON POST request and decode the JSON response
+
+            Parameters:
+            json_body (dict): JSON data to include in HTTP POST body
+            timeout (float): Seconds to wait for a response. Defaults to a
+                             per-request-type timeout
+
+            Returns: dict in the form returned to BLE centrals
+        """
+        request_id = json_body.get("request_id")
+        request = json_body.get("request")
+        if timeout is None:
+            timeout = REQUEST_TIMEOUTS.get(request, DEFAULT_TIMEOUT)
+
+        import configurator_http
+
+        started = time.perf_counter()
+        body = json.dumps(json_body).encode('utf-8')
+        try:
+            status, data = self._send(body, timeout, request in MUTATING_REQUESTS)
+        except socket.timeout:
+            metrics.observe_since('configurator_request_ms', started, request=request, outcome='timeout')
+            error = f'Request to {self.url} timed out...'
+            return {"success": False, "error": error, "request_id": request_id}
+        except (OSError, configurator_http.HTTPException):
+            metrics.observe_since('configurator_request_ms', started, request=request, outcome='connection_error')
+            error = f'Cannot connect to {self.url}...'
+            return {"success": False, "error": error, "request_id": request_id}
+
+        recorder.record_http(json_body, status, data, started)
+
+        if status >= 400:
+            metrics.observe_since('configurator_request_ms', started, request=request, outcome='http_error')
+            error = f'HTTP Error returned from server: {status}'
+            return {"success": False, "error": error, "request_id": request_id}
+
+        try:
+            payload = json.loads(data) if data else None
+        except ValueError:
+            metrics.observe_since('configurator_request_ms', started, request=request, outcome='invalid_response')
+            error = f'Invalid JSON response from {self.url}'
+            return {"success": False, "error": error, "request_id": request_id}
+
+        metrics.observe_since('configurator_request_ms', started, request=request, outcome='success')
+
+        # Send success json back to BLE central
+        response_json = {"success": True, "request_id": request_id}
+        if payload:
+            response_json["response_payload"] = payload
+
+        return response_json
+
+    def close(self):
+        with self.lock:
+            connections, self.idle_connections = self.idle_connections, []
+        for conn in connections:
+            conn.close()
+
+    def _send(self, body, timeout, mutating):
+        """ Send body, retrying once on a fresh connection if an idle one turns out stale
+
+            Parameters:
+            body (bytes): Encoded JSON request
+            timeout (float): Seconds to wait for a response
+            mutating (bool): True if the request changes receiver configuration
+
+            A request is only repeated if piaware-configurator cannot have
+            acted on it: the connection failed while the request was being
+            written, or the request only reads state. Mutating requests are
+            always sent on a new connection, so a stale one cannot fail them.
+        """
+        import configurator_http
+
+        conn, reused = self._checkout(timeout, fresh=mutating)
+        try:
+            self._write_request(conn, body)
+        except configurator_http.STALE_CONNECTION_ERRORS:
+            if not reused:
+                raise
+            return self._resend(body, timeout)
+
+        try:
+            return self._read_response(conn)
+        except configurator_http.STALE_CONNECTION_ERRORS:
+            if not reused or mutating:
+                raise
+            return self._resend(body, timeout)
+
+    def _resend(self, body, timeout):
+        # The server dropped the idle connection, try once on a fresh one
+        conn, _ = self._checkout(timeout, fresh=True)
+        self._write_request(conn, body)
+        return self._read_response(conn)
+
+    def _write_request(self, conn, body):
+        try:
+            conn.request('POST', self.path, body=body,
+                         headers={'Content-Type': 'application/json'})
+            self._quickack(conn)
+        except BaseException:
+            conn.close()
+            raise
+
+    def _read_response(self, conn):
+        try:
+            response = conn.getresponse()
+            data = response.read()
+        except BaseException:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(conn)
+
+        return response.status, data
+
+    def _quickack(self, conn):
+        # A server that writes headers and body separately on a keep-alive
+        # connection would otherwise wait on our delayed ACK (~40 ms)
+        if QUICKACK_SUPPORTED and not self.unix_socket and conn.sock is not None:
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+    def _checkout(self, timeout, fresh=False):
+        conn = None
+        if not fresh:
+            with self.lock:
+                if self.idle_connections:
+                    conn = self.idle_connections.pop()
+
+        if conn is None:
+            return self._new_connection(timeout), False
+
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _checkin(self, conn):
+        with self.lock:
+            if len(self.idle_connections) < self.pool_size:
+                self.idle_connections.append(conn)
+                return
+        conn.close()
+
+    def _new_connection(self, timeout):
+        import configurator_http
+
+        return configurator_http.new_connection(self.host, self.port, self.unix_socket, timeout)
+
+
+# Shared clients, one per piaware-configurator URL
+_clients = {}
+_clients_lock = threading.Lock()
+_unix_socket = None
+
+
+def set_unix_socket(socket_path):
+    """ Talk to piaware-configurator over a Unix domain socket instead of TCP
+
+        Parameters:
+        socket_path (str): Path of the socket piaware-configurator listens on
+    """
+    global _unix_socket
+    with _clients_lock:
+        _unix_socket = socket_path
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+def get_client(url):
+    """ Returns the shared ConfiguratorClient for url
+
+    """
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            client = _clients[url] = ConfiguratorClient(url, unix_socket=_unix_socket)
+        return client
@@ -0,0 +1,39 @@
+""" HTTP connections to piaware-configurator
+
+    Kept apart from configurator_client because http.client pulls in most of
+    the email package; it is imported on first use, or by preload() while
+    piaware-configurator restarts, instead of before startup can begin.
+
+"""
+import http.client
+import socket
+
+# Errors raised when reusing a keep-alive connection the server already closed
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+HTTPException = http.client.HTTPException
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    ''' HTTPConnection over a Unix domain socket
+
+    '''
+    def __init__(self, socket_path, timeout):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def new_connection(host, port, unix_socket, timeout):
+    if unix_socket:
+        return UnixHTTPConnection(unix_socket, timeout)
+    return http.client.HTTPConnection(host, port, timeout=timeout)
@@ -35,4 +35,7 @@ GATT_DESC_IFACE = 'org.bluez.GattDescriptor1'
 LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
 
 # BlueZ DBus Advertisement Interface
-LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
\ No newline at end of file
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+
+# PiAware status file
+PIAWARE_STATUS_JSON = '/var/run/piaware/status.json'
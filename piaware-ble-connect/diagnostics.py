@@ -0,0 +1,135 @@
+""" Resource usage and memory growth diagnostics
+
+    Reads the daemon's memory, open fds, threads and child processes from
+    /proc and, when tracemalloc is tracing, compares allocations against the
+    first snapshot taken. Used by tools/soak.py to catch leaks over a long
+    run, and by the daemon itself to dump a snapshot to the log on SIGUSR1:
+
+        systemctl kill -s USR1 piaware-ble-connect
+
+"""
+import logging
+import os
+import signal
+import threading
+import tracemalloc
+from collections import namedtuple
+from gi.repository import GLib
+
+logger = logging.getLogger('piaware_ble_connect')
+
+ResourceUsage = namedtuple('ResourceUsage', ['rss_kb', 'fds', 'threads', 'children', 'zombies', 'traced_kb'])
+
+# Allocation sites reported in a snapshot dump
+TOP_ALLOCATIONS = 10
+
+PAGE_SIZE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def child_processes():
+    """ Returns (children, zombies) of this process
+
+        Zombies are children that exited without being reaped.
+    """
+    pid = os.getpid()
+    children = zombies = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, the fields after it do not
+        state, ppid = stat[stat.rfind(')') + 2:].split()[:2]
+        if int(ppid) == pid:
+            children += 1
+            if state == 'Z':
+                zombies += 1
+    return children, zombies
+
+
+def resource_usage():
+    ''' Returns the current ResourceUsage of this process
+
+    '''
+    with open('/proc/self/statm') as f:
+        rss_kb = int(f.read().split()[1]) * PAGE_SIZE_KB
+    children, zombies = child_processes()
+    traced_kb = tracemalloc.get_traced_memory()[0] // 1024 if tracemalloc.is_tracing() else None
+    return ResourceUsage(rss_kb, len(os.listdir('/proc/self/fd')), threading.active_count(),
+                         children, zombies, traced_kb)
+
+
+def format_usage(usage):
+    traced = f', traced {usage.traced_kb} KiB' if usage.traced_kb is not None else ''
+    return (f'RSS {usage.rss_kb} KiB, {usage.fds} fds, {usage.threads} threads, '
+            f'{usage.children} children ({usage.zombies} zombies){traced}')
+
+
+class MemoryTracker():
+    ''' Compares tracemalloc snapshots against the first one taken
+
+    '''
+    def __init__(self):
+        self.baseline = None
+
+    def start(self, frames):
+        """ Start tracing allocations
+
+            Parameters:
+            frames (int): Stack frames kept per allocation
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = None
+
+    def snapshot(self):
+        ''' Take a snapshot, the first one becomes the baseline
+
+            Returns: list of the largest tracemalloc.StatisticDiff since the
+                     baseline, empty when not tracing
+        '''
+        if not tracemalloc.is_tracing():
+            return []
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+        if self.baseline is None:
+            self.baseline = snapshot
+            return []
+
+        stats = snapshot.compare_to(self.baseline, 'lineno')
+        return [stat for stat in stats if stat.size_diff > 0][:TOP_ALLOCATIONS]
+
+
+memory_tracker = MemoryTracker()
+
+
+def dump_snapshot():
+    ''' Log resource usage and allocation growth since the baseline snapshot
+
+    '''
+    logger.info(f'Diagnostics: {format_usage(resource_usage())}')
+    growth = memory_tracker.snapshot()
+    if not tracemalloc.is_tracing():
+        logger.info('Diagnostics: start with --trace-memory to include allocation growth')
+    elif not growth:
+        logger.info('Diagnostics: no allocation growth since the baseline')
+    for stat in growth:
+        logger.info(f'Diagnostics: {stat}')
+
+
+def install_signal_handler(signum=signal.SIGUSR1):
+    ''' Dump a snapshot from the mainloop whenever signum is received
+
+    '''
+    def on_signal():
+        dump_snapshot()
+        return GLib.SOURCE_CONTINUE
+
+    return GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, on_signal)
@@ -0,0 +1,189 @@
+""" Worker pool that runs BLE requests off the GLib mainloop
+
+    Requests forwarded to piaware-configurator can take up to the HTTP timeout
+    to complete. Running them on the mainloop would stall every other D-Bus
+    callback, so they are handed to a bounded executor and their results are
+    marshalled back to the mainloop with GLib.idle_add.
+
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from gi.repository import GLib
+
+from metrics import metrics
+
+logger = logging.getLogger('piaware_ble_connect')
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_QUEUE_DEPTH = 8
+
+
+class RequestDispatcher():
+    ''' Bounded worker pool for BLE requests
+
+        At most pool_size requests run at once and at most queue_depth more
+        may wait for a free worker. Anything beyond that is rejected so a
+        misbehaving central cannot grow the backlog without bound.
+    '''
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.pool_size = pool_size
+        self.queue_depth = queue_depth
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='ble-request')
+        self.slots = threading.BoundedSemaphore(pool_size + queue_depth)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completion_hooks = []
+
+    def add_completion_hook(self, hook):
+        ''' Register hook() to be called on the mainloop after every job's callback
+
+            Lets work waiting for a free worker (e.g. queued BLE requests) be
+            started when a worker is freed by any job, not only its own kind.
+        '''
+        self.completion_hooks.append(hook)
+
+    def has_idle_worker(self):
+        ''' Returns True if a submitted request would start without queueing
+
+        '''
+        with self.lock:
+            return self.pending < self.pool_size
+
+    def submit(self, func, args, callback, label='request'):
+        ''' Queue func(*args) on the worker pool
+
+            Parameters:
+            func (callable): Blocking function to run on a worker thread
+            args (tuple): Positional arguments for func
+            callback (callable): Called on the mainloop with func's return value
+                                 (None if func raised)
+            label (str): Name used when logging timings
+
+            Returns: True if queued, False if the queue is full
+        '''
+        if not self.slots.acquire(blocking=False):
+            logger.warning(f'Request queue full, rejecting {label}')
+            return False
+
+        queued_at = time.monotonic()
+        with self.lock:
+            self.pending += 1
+        try:
+            self.executor.submit(self._run, func, args, callback, label, queued_at)
+        except RuntimeError:
+            # Executor has been shut down
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+            return False
+
+        return True
+
+    def _run(self, func, args, callback, label, queued_at):
+        started_at = time.monotonic()
+        try:
+            result = func(*args)
+        except Exception as e:
+            logger.error(f'Unhandled error processing {label}: {e}')
+            result = None
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+        finished_at = time.monotonic()
+
+        queue_wait_ms = (started_at - queued_at) * 1000
+        service_time_ms = (finished_at - started_at) * 1000
+        metrics.observe('dispatcher_queue_wait_ms', queue_wait_ms)
+        metrics.observe('dispatcher_service_ms', service_time_ms)
+        logger.debug(f'{label}: queue wait {queue_wait_ms:.1f} ms, service time {service_time_ms:.1f} ms')
+
+        GLib.idle_add(self._deliver, callback, result)
+
+    def fan_out(self, func, items, label='fan-out'):
+        ''' Run func(item) for every item, sharing the work with idle workers
+
+            Called on a worker thread. The calling worker works through the
+            items itself and hands a share to workers that are idle right
+            now, so the fan-out never uses more than pool_size workers, never
+            waits for a worker to become free and cannot deadlock the pool.
+
+            Returns: list of func's results in item order (None where func raised)
+        '''
+        results = [None] * len(items)
+        remaining = deque(enumerate(items))
+        running = 0
+        finished = threading.Condition()
+
+        def work():
+            nonlocal running
+            while True:
+                with finished:
+                    if not remaining:
+                        return
+                    index, item = remaining.popleft()
+                    running += 1
+                try:
+                    result = func(item)
+                except Exception as e:
+                    logger.error(f'Unhandled error processing {label} item: {e}')
+                    result = None
+                with finished:
+                    results[index] = result
+                    running -= 1
+                    finished.notify_all()
+
+        for _ in range(len(items) - 1):
+            if not self._submit_helper(work):
+                break
+
+        work()
+        with finished:
+            while running:
+                finished.wait()
+        return results
+
+    def _submit_helper(self, work):
+        # Only take a worker that is idle now, helpers never queue
+        with self.lock:
+            if self.pending >= self.pool_size or not self.slots.acquire(blocking=False):
+                return False
+            self.pending += 1
+        try:
+            self.executor.submit(self._run_helper, work)
+        except RuntimeError:
+            # Executor has been shut down
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+            return False
+        return True
+
+    def _run_helper(self, work):
+        try:
+            work()
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+        # The freed worker may be able to start queued requests
+        GLib.idle_add(self._run_completion_hooks)
+
+    def _run_completion_hooks(self):
+        for hook in self.completion_hooks:
+            hook()
+        return GLib.SOURCE_REMOVE
+
+    def _deliver(self, callback, result):
+        try:
+            callback(result)
+        finally:
+            for hook in self.completion_hooks:
+                hook()
+        return GLib.SOURCE_REMOVE
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,424 @@
+""" Framing of UART messages exchanged over the BLE Tx/Rx characteristics
+
+    Each message is a JSON document followed by a chr(19) terminator. On the
+    Tx side the encoded message is split into chunks that fit in a single
+    ATT notification for the negotiated MTU.
+
+    A central may negotiate a more compact Tx encoding. Those messages are
+    sent as a 5 byte header (encoding id, 32-bit big-endian body length)
+    followed by the body, instead of being terminated:
+
+        deflate: zlib-wrapped JSON
+        cbor:    CBOR (RFC 8949) encoded message
+
+"""
+import json
+import struct
+import zlib
+
+MESSAGE_TERMINATOR = b'\x13'
+
+ENCODING_JSON = 'json'
+ENCODING_DEFLATE = 'deflate'
+ENCODING_CBOR = 'cbor'
+
+# Encoding id carried in the first byte of the frame header
+ENCODING_IDS = {
+    ENCODING_DEFLATE: 1,
+    ENCODING_CBOR: 2,
+}
+ENCODINGS = [ENCODING_JSON] + list(ENCODING_IDS)
+
+FRAME_HEADER = struct.Struct('>BI')
+DEFLATE_LEVEL = 6
+
+# ATT opcode (1 byte) + attribute handle (2 bytes) precede every notification payload
+ATT_HEADER_SIZE = 3
+DEFAULT_ATT_MTU = 23
+MAX_ATTRIBUTE_VALUE_SIZE = 512
+
+
+def encode_message(message, encoding=ENCODING_JSON):
+    """ Encode a message for transmission
+
+        Parameters:
+        message (dict): JSON-serializable message
+        encoding (str): One of ENCODINGS
+
+        Returns: bytes
+    """
+    if encoding == ENCODING_JSON:
+        return json.dumps(message).encode('utf-8') + MESSAGE_TERMINATOR
+
+    if encoding == ENCODING_DEFLATE:
+        body = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'), DEFLATE_LEVEL)
+    elif encoding == ENCODING_CBOR:
+        body = encode_cbor(message)
+    else:
+        raise ValueError(f'Unknown encoding: {encoding}')
+
+    return FRAME_HEADER.pack(ENCODING_IDS[encoding], len(body)) + body
+
+
+def cbor_head(major_type, value):
+    major_type <<= 5
+    if value < 24:
+        return bytes([major_type | value])
+    if value < 0x100:
+        return struct.pack('>BB', major_type | 24, value)
+    if value < 0x10000:
+        return struct.pack('>BH', major_type | 25, value)
+    if value < 0x100000000:
+        return struct.pack('>BI', major_type | 26, value)
+    return struct.pack('>BQ', major_type | 27, value)
+
+
+def encode_cbor(value):
+    """ Encode a JSON-compatible value as CBOR
+
+        Only the types json.dumps accepts are supported. Integers must fit in
+        64 bits.
+
+        Returns: bytes
+    """
+    out = bytearray()
+    _encode_cbor(value, out)
+    return bytes(out)
+
+
+def _encode_cbor(value, out):
+    # bool before int, bool is a subclass of int
+    if value is None:
+        out.append(0xf6)
+    elif value is True:
+        out.append(0xf5)
+    elif value is False:
+        out.append(0xf4)
+    elif isinstance(value, int):
+        if value >= 0:
+            out += cbor_head(0, value)
+        else:
+            out += cbor_head(1, -1 - value)
+    elif isinstance(value, float):
+        out += struct.pack('>Bd', 0xfb, value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out += cbor_head(3, len(data))
+        out += data
+    elif isinstance(value, (list, tuple)):
+        out += cbor_head(4, len(value))
+        for item in value:
+            _encode_cbor(item, out)
+    elif isinstance(value, dict):
+        out += cbor_head(5, len(value))
+        for key, item in value.items():
+            # JSON object keys are always strings
+            _encode_cbor(key if isinstance(key, str) else json.dumps(key), out)
+            _encode_cbor(item, out)
+    else:
+        raise TypeError(f'Cannot CBOR encode {type(value).__name__}')
+
+
+def chunk_size_for_mtu(mtu):
+    """ Returns the largest notification payload that fits in one ATT PDU
+
+        Parameters:
+        mtu (int): Negotiated ATT MTU, or None if unknown
+    """
+    if not mtu or mtu < DEFAULT_ATT_MTU:
+        mtu = DEFAULT_ATT_MTU
+    return min(mtu - ATT_HEADER_SIZE, MAX_ATTRIBUTE_VALUE_SIZE)
+
+
+def split_payload(payload, mtu=DEFAULT_ATT_MTU):
+    """ Split an encoded payload into MTU sized chunks
+
+        Parameters:
+        payload (bytes): Encoded message
+        mtu (int): Negotiated ATT MTU
+
+        Returns: list of bytes
+    """
+    chunk_size = chunk_size_for_mtu(mtu)
+    return [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)]
+
+
+MAX_FRAME_SIZE = 8192
+
+# Result of scanning the bytes of an unterminated message
+DOCUMENT_PREFIX = 'prefix'
+DOCUMENT_COMPLETE = 'complete'
+DOCUMENT_INVALID = 'invalid'
+
+WHITESPACE = b' \t\n\r'
+DIGITS = b'0123456789'
+HEX_DIGITS = b'0123456789abcdefABCDEF'
+ESCAPES = b'"\\/bfnrt'
+LITERALS = {ord('t'): b'true', ord('f'): b'false', ord('n'): b'null'}
+
+# Number grammar: state -> ((accepted bytes, next state), ...)
+NUMBER_STATES = {
+    'sign': ((b'0', 'zero'), (b'123456789', 'int')),
+    'zero': ((b'.', 'dot'), (b'eE', 'exp')),
+    'int': ((DIGITS, 'int'), (b'.', 'dot'), (b'eE', 'exp')),
+    'dot': ((DIGITS, 'frac'),),
+    'frac': ((DIGITS, 'frac'), (b'eE', 'exp')),
+    'exp': ((b'+-', 'exp_sign'), (DIGITS, 'exp_int')),
+    'exp_sign': ((DIGITS, 'exp_int'),),
+    'exp_int': ((DIGITS, 'exp_int'),),
+}
+# Number states a number may end in
+NUMBER_ENDS = ('zero', 'int', 'frac', 'exp_int')
+
+
+class FrameTooLargeError(Exception):
+    pass
+
+
+class DocumentScanner():
+    ''' Incremental syntax check of a JSON document
+
+        Fed the bytes of a message as they arrive, tells whether they form a
+        complete document, the beginning of one, or something that can never
+        become one. Scanning works on bytes: outside strings JSON is ASCII,
+        and inside strings the bytes of multi-byte UTF-8 sequences are
+        accepted as they are, so a sequence split across writes needs no
+        special handling. Whether those bytes decode is left to the JSON
+        decoder the complete message is handed to.
+
+        Each state is a method taking the next byte. It returns False if the
+        byte ends the current value without being consumed (the end of a
+        number), in which case the byte is passed to the next state.
+    '''
+    def __init__(self):
+        # b'{' or b'[' for each open container
+        self.stack = []
+        self.state = self._value
+        self.in_key = False
+        self.number = None
+        self.literal = None
+        self.hex_digits_left = 0
+
+    def feed(self, data):
+        """ Scan more bytes of the message
+
+            Parameters:
+            data (bytes): Bytes following those already scanned
+
+            Returns: DOCUMENT_PREFIX, DOCUMENT_COMPLETE or DOCUMENT_INVALID
+                     for all bytes scanned so far
+        """
+        for byte in data:
+            while self.state is not None and not self.state(byte):
+                pass
+            if self.state is None:
+                break
+        return self.result()
+
+    def result(self):
+        if self.state is None:
+            return DOCUMENT_INVALID
+        if self.state == self._done:
+            return DOCUMENT_COMPLETE
+        # A number at the top level is complete as soon as it could end
+        if not self.stack and self.state == self._number and self.number in NUMBER_ENDS:
+            return DOCUMENT_COMPLETE
+        return DOCUMENT_PREFIX
+
+    def _reject(self):
+        self.state = None
+        return True
+
+    def _open(self, container, state):
+        self.stack.append(container)
+        self.state = state
+        return True
+
+    def _close(self, byte):
+        if not self.stack or byte != (ord('}') if self.stack[-1] == b'{' else ord(']')):
+            return self._reject()
+        self.stack.pop()
+        self._end_value()
+        return True
+
+    def _end_value(self):
+        self.state = self._after_value if self.stack else self._done
+
+    def _value(self, byte):
+        if byte in WHITESPACE:
+            return True
+        if byte == ord('{'):
+            return self._open(b'{', self._key_or_end)
+        if byte == ord('['):
+            return self._open(b'[', self._value_or_end)
+        if byte == ord('"'):
+            self.in_key = False
+            self.state = self._string
+            return True
+        if byte in LITERALS:
+            self.literal = LITERALS[byte][1:]
+            self.state = self._literal
+            return True
+        if byte == ord('-'):
+            self.number = 'sign'
+            self.state = self._number
+            return True
+        if byte in DIGITS:
+            self.number = 'sign'
+            self.state = self._number
+            return False
+        return self._reject()
+
+    def _value_or_end(self, byte):
+        if byte == ord(']'):
+            return self._close(byte)
+        return self._value(byte)
+
+    def _key_or_end(self, byte):
+        if byte == ord('}'):
+            return self._close(byte)
+        return self._key(byte)
+
+    def _key(self, byte):
+        if byte in WHITESPACE:
+            return True
+        if byte != ord('"'):
+            return self._reject()
+        self.in_key = True
+        self.state = self._string
+        return True
+
+    def _colon(self, byte):
+        if byte in WHITESPACE:
+            return True
+        if byte != ord(':'):
+            return self._reject()
+        self.state = self._value
+        return True
+
+    def _after_value(self, byte):
+        if byte in WHITESPACE:
+            return True
+        if byte == ord(','):
+            self.state = self._key if self.stack[-1] == b'{' else self._value
+            return True
+        return self._close(byte)
+
+    def _string(self, byte):
+        if byte == ord('"'):
+            if self.in_key:
+                self.state = self._colon
+            else:
+                self._end_value()
+        elif byte == ord('\\'):
+            self.state = self._escape
+        return True
+
+    def _escape(self, byte):
+        if byte == ord('u'):
+            self.hex_digits_left = 4
+            self.state = self._unicode_escape
+            return True
+        if byte not in ESCAPES:
+            return self._reject()
+        self.state = self._string
+        return True
+
+    def _unicode_escape(self, byte):
+        if byte not in HEX_DIGITS:
+            return self._reject()
+        self.hex_digits_left -= 1
+        if not self.hex_digits_left:
+            self.state = self._string
+        return True
+
+    def _literal(self, byte):
+        if byte != self.literal[0]:
+            return self._reject()
+        self.literal = self.literal[1:]
+        if not self.literal:
+            self._end_value()
+        return True
+
+    def _number(self, byte):
+        for accepted, next_state in NUMBER_STATES[self.number]:
+            if byte in accepted:
+                self.number = next_state
+                return True
+        if self.number not in NUMBER_ENDS:
+            return self._reject()
+        self._end_value()
+        return False
+
+    def _done(self, byte):
+        if byte not in WHITESPACE:
+            return self._reject()
+        return True
+
+
+class FrameDecoder():
+    ''' Incremental decoder for Rx messages
+
+        Accumulates the bytes of consecutive writes from one central and
+        yields each complete message once its terminator arrives. Messages are
+        split on bytes before decoding, so a multi-byte UTF-8 sequence split
+        across two writes is reassembled intact.
+
+        Centrals that send a single unterminated JSON document per write are
+        still supported. The pending bytes are scanned as each write arrives,
+        and as soon as they form a complete document, or can no longer become
+        one, they are yielded without waiting for a terminator. A complete
+        document is handled and an invalid one is answered, rather than
+        being prepended to the central's next request.
+    '''
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        self.scanner = DocumentScanner()
+        # Bytes of buffer already passed to scanner
+        self.scanned = 0
+
+    def feed(self, data):
+        """ Add received bytes and yield any complete messages
+
+            Parameters:
+            data (bytes): Bytes from one GATT write
+
+            Yields: bytes of each complete message, without terminator
+
+            Raises: FrameTooLargeError if the pending message exceeds
+                    max_frame_size. The pending bytes are discarded.
+        """
+        self.buffer.extend(data)
+
+        while True:
+            end = self.buffer.find(MESSAGE_TERMINATOR)
+            if end < 0:
+                break
+            frame = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            self.restart_scan()
+            if frame:
+                yield frame
+
+        if len(self.buffer) > self.max_frame_size:
+            self.reset()
+            raise FrameTooLargeError()
+
+        if not self.buffer:
+            return
+
+        result = self.scanner.feed(self.buffer[self.scanned:])
+        self.scanned = len(self.buffer)
+        if result != DOCUMENT_PREFIX:
+            frame = bytes(self.buffer)
+            self.reset()
+            yield frame
+
+    def restart_scan(self):
+        self.scanner = DocumentScanner()
+        self.scanned = 0
+
+    def reset(self):
+        self.buffer.clear()
+        self.restart_scan()
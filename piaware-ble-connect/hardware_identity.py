@@ -0,0 +1,217 @@
+""" Raspberry Pi hardware identity
+
+    Determines the Pi model and serial number once per process. The device
+    tree is checked first since it exposes the revision code and serial number
+    directly; /proc/cpuinfo is only read if that fails. New-style revision
+    codes are decoded bitwise, older codes are looked up in a precomputed
+    reverse index.
+
+    https://www.raspberrypi.com/documentation/computers/raspberry-pi.html#raspberry-pi-revision-codes
+
+"""
+import functools
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger('piaware_ble_connect')
+
+DEVICE_TREE_MODEL = '/proc/device-tree/model'
+DEVICE_TREE_REVISION = '/proc/device-tree/system/linux,revision'
+DEVICE_TREE_SERIAL = '/proc/device-tree/serial-number'
+CPUINFO = '/proc/cpuinfo'
+
+DEFAULT_MODEL = 'Raspberry Pi'
+
+HardwareIdentity = namedtuple('HardwareIdentity',
+                              ['model', 'serial_number', 'revision', 'memory', 'manufacturer', 'processor'])
+
+# Bit 23 of the revision code is set for new-style codes
+NEW_STYLE_FLAG = 1 << 23
+
+# New-style revision code fields: (shift, mask)
+TYPE_FIELD = (4, 0xff)
+PROCESSOR_FIELD = (12, 0xf)
+MANUFACTURER_FIELD = (16, 0xf)
+MEMORY_FIELD = (20, 0x7)
+
+MODEL_TYPES = {
+    0x00: 'RPi A',
+    0x01: 'RPi B',
+    0x02: 'RPi A+',
+    0x03: 'RPi B+',
+    0x04: 'RPi 2B',
+    0x06: 'RPi CM1',
+    0x08: 'RPi 3B',
+    0x09: 'RPi Zero',
+    0x0a: 'RPi CM3',
+    0x0c: 'RPi Zero W',
+    0x0d: 'RPi 3B+',
+    0x0e: 'RPi 3A+',
+    0x10: 'RPi CM3+',
+    0x11: 'RPi 4',
+    0x12: 'RPi Zero 2 W',
+    0x13: 'RPi 400',
+    0x14: 'RPi CM4',
+    0x15: 'RPi CM4S',
+    0x17: 'RPi 5',
+    0x18: 'RPi CM5',
+    0x19: 'RPi 500',
+    0x1a: 'RPi CM5 Lite',
+}
+
+PROCESSORS = ['BCM2835', 'BCM2836', 'BCM2837', 'BCM2711', 'BCM2712']
+
+MANUFACTURERS = ['Sony UK', 'Egoman', 'Embest', 'Sony Japan', 'Embest', 'Stadium']
+
+MEMORY_SIZES = ['256MB', '512MB', '1GB', '2GB', '4GB', '8GB', '16GB']
+
+# Old-style revision codes: model -> [(code, memory, manufacturer)]
+LEGACY_MODELS = {
+    'RPi B': [('0002', '256MB', 'Egoman'), ('0003', '256MB', 'Egoman'),
+              ('0004', '256MB', 'Sony UK'), ('0005', '256MB', 'Qisda'),
+              ('0006', '256MB', 'Egoman'), ('000d', '512MB', 'Egoman'),
+              ('000e', '512MB', 'Sony UK'), ('000f', '512MB', 'Egoman')],
+    'RPi A': [('0007', '256MB', 'Egoman'), ('0008', '256MB', 'Sony UK'),
+              ('0009', '256MB', 'Qisda')],
+    'RPi B+': [('0010', '512MB', 'Sony UK'), ('0013', '512MB', 'Embest')],
+    'RPi CM1': [('0011', '512MB', 'Sony UK'), ('0014', '512MB', 'Embest')],
+    'RPi A+': [('0012', '256MB', 'Sony UK'), ('0015', '256MB', 'Embest')],
+}
+
+# Reverse index: legacy code -> (model, memory, manufacturer)
+LEGACY_REVISIONS = {
+    code: (model, memory, manufacturer)
+    for model, codes in LEGACY_MODELS.items()
+    for code, memory, manufacturer in codes
+}
+
+
+def field(code, bits):
+    shift, mask = bits
+    return (code >> shift) & mask
+
+
+def lookup(table, index):
+    return table[index] if index < len(table) else None
+
+
+def decode_revision(revision):
+    """ Decode a revision code
+
+        Parameters:
+        revision (str): Hex revision code as shown in /proc/cpuinfo
+
+        Returns: (model, memory, manufacturer, processor), any of which may be
+                 None if unknown
+    """
+    try:
+        code = int(revision, 16)
+    except (TypeError, ValueError):
+        return None, None, None, None
+
+    if code & NEW_STYLE_FLAG:
+        return (MODEL_TYPES.get(field(code, TYPE_FIELD)),
+                lookup(MEMORY_SIZES, field(code, MEMORY_FIELD)),
+                lookup(MANUFACTURERS, field(code, MANUFACTURER_FIELD)),
+                lookup(PROCESSORS, field(code, PROCESSOR_FIELD)))
+
+    # Old-style codes may carry the overvolt warranty bit above the code itself
+    legacy = LEGACY_REVISIONS.get(f'{code & 0xffff:04x}')
+    if legacy is None:
+        return None, None, None, None
+    model, memory, manufacturer = legacy
+    return model, memory, manufacturer, 'BCM2835'
+
+
+def read_device_tree():
+    """ Returns (revision, serial number, model string) from the device tree
+
+    """
+    revision = serial = model = None
+    try:
+        with open(DEVICE_TREE_REVISION, 'rb') as f:
+            revision = f'{int.from_bytes(f.read(4), "big"):x}'
+    except OSError:
+        pass
+
+    try:
+        with open(DEVICE_TREE_SERIAL, 'rb') as f:
+            serial = f.read().rstrip(b'\0').decode('ascii').strip() or None
+    except (OSError, UnicodeDecodeError):
+        pass
+
+    try:
+        with open(DEVICE_TREE_MODEL, 'rb') as f:
+            model = f.read().rstrip(b'\0').decode('ascii').strip() or None
+    except (OSError, UnicodeDecodeError):
+        pass
+
+    return revision, serial, model
+
+
+def read_cpuinfo(path=CPUINFO):
+    """ Returns (revision, serial number) from cpuinfo
+
+        Stops reading as soon as both fields have been seen.
+    """
+    revision = serial = None
+    with open(path, 'r') as cpuinfo:
+        for line in cpuinfo:
+            attribute, separator, value = line.partition(':')
+            if not separator:
+                continue
+
+            attribute = attribute.strip()
+            if attribute == 'Revision':
+                revision = value.strip()
+            elif attribute == 'Serial':
+                serial = value.strip()
+            else:
+                continue
+
+            if revision is not None and serial is not None:
+                break
+
+    return revision, serial
+
+
+def model_from_device_tree(model):
+    """ Shorten a device tree model string, e.g. 'Raspberry Pi 4 Model B Rev 1.4' -> 'RPi 4 Model B'
+
+    """
+    model = model.split(' Rev ')[0]
+    if model.startswith('Raspberry Pi'):
+        model = 'RPi' + model[len('Raspberry Pi'):]
+    return model
+
+
+def identify(revision, serial, device_tree_model=None):
+    """ Build a HardwareIdentity from raw revision/serial values
+
+    """
+    model, memory, manufacturer, processor = decode_revision(revision)
+    if model is None:
+        model = model_from_device_tree(device_tree_model) if device_tree_model else DEFAULT_MODEL
+
+    # Last 6 characters of serial number are used on identifiers
+    serial_number = serial[-6:].upper() if serial else None
+
+    return HardwareIdentity(model, serial_number, revision, memory, manufacturer, processor)
+
+
+@functools.lru_cache(maxsize=None)
+def get_hardware_identity():
+    """ Returns the HardwareIdentity of this Pi. Computed once per process
+
+    """
+    revision, serial, device_tree_model = read_device_tree()
+
+    if revision is None or serial is None:
+        try:
+            cpuinfo_revision, cpuinfo_serial = read_cpuinfo(CPUINFO)
+            revision = revision or cpuinfo_revision
+            serial = serial or cpuinfo_serial
+        except OSError:
+            logger.error(f"Error retreiving Raspberry Pi Model or Serial Number")
+
+    return identify(revision, serial, device_tree_model)
@@ -0,0 +1,80 @@
+""" Per-module import times of the daemon, measured with python3 -X importtime
+
+    The daemon script is loaded in a fresh interpreter without running main(),
+    so the numbers cover exactly the imports done before startup begins.
+    Interpreter startup (site, encodings) is excluded by only counting the
+    entries written after a marker line.
+
+"""
+import os
+import subprocess
+import sys
+from collections import namedtuple
+
+DAEMON_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'piaware_ble_connect')
+
+IMPORT_MARKER = '--- piaware-ble-connect imports ---'
+
+ImportTime = namedtuple('ImportTime', ['module', 'self_ms', 'cumulative_ms', 'depth'])
+
+MEASURE_SCRIPT = '''
+import importlib.machinery, importlib.util, sys
+sys.path.insert(0, {directory!r})
+loader = importlib.machinery.SourceFileLoader('piaware_ble_connect_main', {script!r})
+module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+sys.stderr.write({marker!r} + "\\n")
+sys.stderr.flush()
+loader.exec_module(module)
+'''
+
+
+def parse_importtime(output):
+    ''' Parse -X importtime output written after IMPORT_MARKER
+
+        Returns: list of ImportTime in the order the imports finished
+    '''
+    lines = output.splitlines()
+    if IMPORT_MARKER in lines:
+        lines = lines[lines.index(IMPORT_MARKER) + 1:]
+
+    entries = []
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        module = name.lstrip(' ')
+        depth = (len(name) - len(module) - 1) // 2
+        entries.append(ImportTime(module, int(self_us) / 1000, int(cumulative_us) / 1000, depth))
+    return entries
+
+
+def measure_imports(script=DAEMON_SCRIPT, python=sys.executable):
+    """ Import the daemon script in a fresh interpreter with -X importtime
+
+        Parameters:
+        script (str): Path of the daemon script
+        python (str): Interpreter to measure with
+
+        Returns: list of ImportTime
+    """
+    code = MEASURE_SCRIPT.format(directory=os.path.dirname(script), marker=IMPORT_MARKER, script=script)
+    result = subprocess.run([python, '-X', 'importtime', '-c', code],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing {script} failed:\n{result.stderr.strip()}')
+    return parse_importtime(result.stderr)
+
+
+def total_ms(entries):
+    return sum(entry.cumulative_ms for entry in entries if entry.depth == 0)
+
+
+def format_report(entries, limit=15):
+    ''' Format the slowest top-level imports and the total
+
+    '''
+    top_level = sorted((entry for entry in entries if entry.depth == 0),
+                       key=lambda entry: entry.cumulative_ms, reverse=True)
+    lines = [f'Imports: {total_ms(entries):8.1f} ms total, {len(entries)} modules']
+    lines.extend(f'  {entry.module:<32} {entry.cumulative_ms:8.1f} ms' for entry in top_level[:limit])
+    return lines
@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
 
 # Helper functions to control LEDs on the Pi
+#
+# The trigger and brightness files of the activity LED are made writable by
+# the piaware-ble-connect group by a udev rule, so no helper processes are
+# needed to change them. The same rule grants the delay_on/delay_off files the
+# kernel creates once the timer trigger is selected.
 
 import logging
 import os
-import subprocess
+from gi.repository import GLib
 
 logger = logging.getLogger('piaware_ble_connect')
 
+LED_CANDIDATES = ['ACT', 'led0']
+SAVED_TRIGGER_FILE = '/run/piaware-ble-connect/trigger'
+
+# Fallback to mmc0 if we can't read the saved trigger for some reason
+FALLBACK_TRIGGER = 'mmc0'
+
+# Blink patterns as (on ms, off ms)
+PATTERNS = {
+    'advertising': (500, 500),
+    'connected': (100, 1900),
+    'request': (50, 50),
+}
+
+# udev makes the timer trigger's delay files writable shortly after they
+# appear: retries (and ms between them) before blinking from the mainloop instead
+DELAY_RETRIES = 5
+DELAY_RETRY_MS = 100
+
 def detect_led(candidates):
     for candidate in candidates:
         if os.path.exists(f'/sys/class/leds/{candidate}/trigger'):
@@ -15,20 +38,172 @@ def detect_led(candidates):
 
     return None
 
-def blink(led_num):
-    logger.info(f'Setting sysfs {led_num} trigger: trigger')
-
-    subprocess.run(['sudo', 'tee', f'/sys/class/leds/{led_num}/trigger'], text=True, input="timer\n", stdout=subprocess.DEVNULL, check=True)
+def write_sysfs(path, value):
+    with open(path, 'w') as f:
+        f.write(f'{value}\n')
 
 # Read default trigger saved in /run/ directory
-def restore_default(led_num):
+def read_default_trigger():
     try:
-        with open('/run/piaware-ble-connect/trigger', 'r') as f:
-            trigger = f.read()
-    except FileNotFoundError as e:
-        # Fallback to mmc0 if we can't read the file for some reason
-        trigger = 'mmc0'
+        with open(SAVED_TRIGGER_FILE, 'r') as f:
+            return f.read().strip() or FALLBACK_TRIGGER
+    except OSError:
+        return FALLBACK_TRIGGER
+
+def restore_default(led_num):
+    trigger = read_default_trigger()
 
     logger.info(f'Setting sysfs {led_num} trigger: {trigger}')
 
-    subprocess.run(['sudo', 'tee', f'/sys/class/leds/{led_num}/trigger'], text=True, input=f'{trigger}\n', stdout=subprocess.DEVNULL, check=True)
+    write_sysfs(f'/sys/class/leds/{led_num}/trigger', trigger)
+
+
+class LedController():
+    ''' Drives the activity LED from the GLib mainloop
+
+        The LED is detected once and its trigger/brightness files are kept
+        open. The pattern reflects the service state: connected, advertising,
+        or a fast blink while requests are in flight. When neither advertising
+        nor connected the saved default trigger is restored.
+
+        Patterns are blinked by the kernel's timer trigger where available.
+        Otherwise the brightness is toggled from GLib timers.
+    '''
+    def __init__(self, candidates=LED_CANDIDATES):
+        self.led = detect_led(candidates)
+        self.default_trigger = read_default_trigger()
+        self.trigger_file = None
+        self.brightness_file = None
+        self.advertising = False
+        self.connected = False
+        self.requests_in_flight = 0
+        self.pattern = None
+        self.timer_source = None
+        self.led_on = False
+        self.timer_trigger_available = True
+
+        if self.led is None:
+            logger.info('No controllable LED found')
+            return
+
+        try:
+            self.trigger_file = open(f'/sys/class/leds/{self.led}/trigger', 'w')
+            self.brightness_file = open(f'/sys/class/leds/{self.led}/brightness', 'w')
+        except OSError as e:
+            logger.error(f'Unable to open sysfs {self.led} LED controls: {e}')
+            self.close()
+
+    def set_advertising(self, advertising):
+        self.advertising = advertising
+        self.apply()
+
+    def set_connected(self, connected):
+        self.connected = connected
+        self.apply()
+
+    def set_requests_in_flight(self, count):
+        self.requests_in_flight = count
+        self.apply()
+
+    def apply(self):
+        if self.connected:
+            pattern = 'request' if self.requests_in_flight else 'connected'
+        elif self.advertising:
+            pattern = 'advertising'
+        else:
+            pattern = None
+
+        if pattern == self.pattern or self.trigger_file is None:
+            return
+
+        self.stop_timer()
+        self.pattern = pattern
+
+        try:
+            if pattern is None:
+                logger.info(f'Setting sysfs {self.led} trigger: {self.default_trigger}')
+                self.write(self.trigger_file, self.default_trigger)
+                return
+
+            logger.debug(f'Setting sysfs {self.led} pattern: {pattern}')
+            self.start_blink()
+        except OSError as e:
+            logger.error(f'Unable to configure LED: {e}')
+
+    def start_blink(self):
+        if self.timer_trigger_available:
+            try:
+                # A fresh handle, a rejected write must not stay buffered in trigger_file
+                write_sysfs(f'/sys/class/leds/{self.led}/trigger', 'timer')
+            except OSError:
+                # Kernel built without ledtrig-timer
+                self.disable_timer_trigger()
+            else:
+                self.set_delays(DELAY_RETRIES)
+                return
+
+        self.start_toggling()
+
+    def set_delays(self, retries):
+        self.timer_source = None
+        if self.pattern is None:
+            return GLib.SOURCE_REMOVE
+
+        on_ms, off_ms = PATTERNS[self.pattern]
+        try:
+            write_sysfs(f'/sys/class/leds/{self.led}/delay_on', on_ms)
+            write_sysfs(f'/sys/class/leds/{self.led}/delay_off', off_ms)
+        except OSError:
+            if retries:
+                self.timer_source = GLib.timeout_add(DELAY_RETRY_MS, self.set_delays, retries - 1)
+            else:
+                self.disable_timer_trigger()
+                try:
+                    self.start_toggling()
+                except OSError as e:
+                    logger.error(f'Unable to configure LED: {e}')
+        return GLib.SOURCE_REMOVE
+
+    def disable_timer_trigger(self):
+        logger.info(f'LED timer trigger unavailable for {self.led}, blinking from the mainloop')
+        self.timer_trigger_available = False
+
+    def start_toggling(self):
+        self.write(self.trigger_file, 'none')
+        self.led_on = False
+        self.toggle()
+
+    def toggle(self):
+        self.timer_source = None
+        if self.pattern is None:
+            return GLib.SOURCE_REMOVE
+
+        self.led_on = not self.led_on
+        try:
+            self.write(self.brightness_file, 1 if self.led_on else 0)
+        except OSError as e:
+            logger.error(f'Unable to configure LED: {e}')
+            return GLib.SOURCE_REMOVE
+
+        on_ms, off_ms = PATTERNS[self.pattern]
+        self.timer_source = GLib.timeout_add(on_ms if self.led_on else off_ms, self.toggle)
+        return GLib.SOURCE_REMOVE
+
+    def stop_timer(self):
+        if self.timer_source is not None:
+            GLib.source_remove(self.timer_source)
+            self.timer_source = None
+
+    def close(self):
+        self.stop_timer()
+        for f in (self.trigger_file, self.brightness_file):
+            if f is not None:
+                f.close()
+        self.trigger_file = None
+        self.brightness_file = None
+
+    @staticmethod
+    def write(f, value):
+        f.seek(0)
+        f.write(f'{value}\n')
+        f.flush()
@@ -0,0 +1,141 @@
+""" Lightweight in-process metrics
+
+    Counters, gauges and fixed-bucket latency histograms keyed by a name and
+    a small set of labels, e.g. the request type and outcome. Recording is a
+    dictionary lookup and a few additions under a lock, cheap enough to leave
+    enabled on a Pi Zero. Histograms keep bucket counts only, so percentiles
+    are reported as the upper bound of the bucket they fall in.
+
+"""
+import bisect
+import threading
+import time
+
+# Upper bounds (milliseconds) of the latency histogram buckets, the last
+# bucket catches everything above
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def format_key(key):
+    ''' Format a metric key as name{label=value,...}
+
+    '''
+    name, labels = key
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}={value}' for label, value in labels) + '}'
+
+
+class Histogram():
+    ''' Fixed-bucket histogram
+
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        ''' Returns the upper bound of the bucket holding the given fraction of observations
+
+        '''
+        if not self.count:
+            return 0.0
+
+        threshold = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return float(self.buckets[index]) if index < len(self.buckets) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+        }
+
+
+class Metrics():
+    ''' Registry of counters, gauges and histograms. Safe to use from any thread
+
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        ''' Record a latency in milliseconds
+
+        '''
+        key = metric_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def observe_since(self, name, started, **labels):
+        ''' Record the milliseconds elapsed since started, a time.perf_counter() value
+
+        '''
+        self.observe(name, (time.perf_counter() - started) * 1000, **labels)
+
+    def snapshot(self):
+        ''' Returns (counters, gauges, histogram summaries) keyed by formatted metric name
+
+        '''
+        with self.lock:
+            counters = {format_key(key): value for key, value in self.counters.items()}
+            gauges = {format_key(key): value for key, value in self.gauges.items()}
+            histograms = {format_key(key): histogram.summary() for key, histogram in self.histograms.items()}
+        return counters, gauges, histograms
+
+    def uptime(self):
+        return time.monotonic() - self.started
+
+    def summary(self):
+        ''' Returns a compact one line summary for the log
+
+        '''
+        counters, gauges, histograms = self.snapshot()
+        parts = [f'uptime={self.uptime():.0f}s']
+        parts.extend(f'{name}={value}' for name, value in sorted(counters.items()))
+        parts.extend(f'{name}={value}' for name, value in sorted(gauges.items()))
+        parts.extend(f'{name}=n{h["count"]}/p50:{h["p50"]:g}/p95:{h["p95"]:g}/max:{h["max"]:.1f}ms'
+                     for name, h in sorted(histograms.items()))
+        return ' '.join(parts)
+
+
+metrics = Metrics()
@@ -0,0 +1,112 @@
+""" Read-only D-Bus view of the daemon's metrics
+
+    Exports the metrics registry as properties of METRICS_IFACE on the bus
+    the daemon already uses, and probes how late the GLib mainloop dispatches
+    timers. Read it with e.g.
+
+        busctl get-property com.flightaware.PiAwareBleConnect \\
+            /com/flightaware/PiAwareBleConnect/Metrics \\
+            com.flightaware.PiAwareBleConnect.Metrics1 Counters
+
+"""
+import logging
+import time
+
+import dbus
+import dbus.service
+from gi.repository import GLib
+
+from bluez import InvalidArgsException
+from constants import DBUS_PROP_IFACE
+from metrics import metrics
+
+logger = logging.getLogger('piaware_ble_connect')
+
+METRICS_BUS_NAME = 'com.flightaware.PiAwareBleConnect'
+METRICS_PATH = '/com/flightaware/PiAwareBleConnect/Metrics'
+METRICS_IFACE = 'com.flightaware.PiAwareBleConnect.Metrics1'
+
+# Mainloop lag probe interval, and how often a summary is logged
+LAG_PROBE_INTERVAL_MS = 1000
+SUMMARY_INTERVAL_SECONDS = 5 * 60
+
+
+class PropertyReadOnlyException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.freedesktop.DBus.Error.PropertyReadOnly'
+
+
+class MetricsService(dbus.service.Object):
+    ''' Exposes metrics over D-Bus and runs the mainloop lag probe
+
+    '''
+    def __init__(self, bus):
+        self.bus_name = None
+        try:
+            self.bus_name = dbus.service.BusName(METRICS_BUS_NAME, bus, do_not_queue=True)
+        except dbus.exceptions.DBusException as e:
+            # Without the bus policy installed the name cannot be owned, and the system
+            # bus denies other clients' calls to this connection, so the metrics are
+            # only available from the periodic log summary
+            logger.warning(f'Unable to own {METRICS_BUS_NAME}: {e}')
+
+        dbus.service.Object.__init__(self, bus, METRICS_PATH)
+
+        self.lag_expected = time.monotonic() + LAG_PROBE_INTERVAL_MS / 1000
+        self.lag_source = GLib.timeout_add(LAG_PROBE_INTERVAL_MS, self.probe_lag)
+        self.summary_source = GLib.timeout_add_seconds(SUMMARY_INTERVAL_SECONDS, self.log_summary)
+
+    def probe_lag(self):
+        now = time.monotonic()
+        metrics.observe('mainloop_lag_ms', max(0.0, (now - self.lag_expected) * 1000))
+        self.lag_expected = now + LAG_PROBE_INTERVAL_MS / 1000
+        return GLib.SOURCE_CONTINUE
+
+    def log_summary(self):
+        logger.info(f'Metrics: {metrics.summary()}')
+        return GLib.SOURCE_CONTINUE
+
+    def stop(self):
+        for source in (self.lag_source, self.summary_source):
+            if source is not None:
+                GLib.source_remove(source)
+        self.lag_source = self.summary_source = None
+        self.remove_from_connection()
+
+    def get_properties(self):
+        counters, gauges, histograms = metrics.snapshot()
+        return dbus.Dictionary({
+            'Uptime': dbus.Double(metrics.uptime()),
+            'Counters': dbus.Dictionary({name: dbus.UInt64(value) for name, value in counters.items()},
+                                        signature='st'),
+            'Gauges': dbus.Dictionary({name: dbus.Double(value) for name, value in gauges.items()},
+                                      signature='sd'),
+            'Histograms': dbus.Dictionary({name: dbus.Dictionary({field: dbus.Double(value)
+                                                                  for field, value in summary.items()},
+                                                                 signature='sd')
+                                           for name, summary in histograms.items()},
+                                          signature='sa{sd}'),
+        }, signature='sv')
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='ss',
+                         out_signature='v')
+    def Get(self, interface, name):
+        if interface != METRICS_IFACE:
+            raise InvalidArgsException()
+        properties = self.get_properties()
+        if name not in properties:
+            raise InvalidArgsException()
+        return properties[name]
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != METRICS_IFACE:
+            raise InvalidArgsException()
+        return self.get_properties()
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='ssv')
+    def Set(self, interface, name, value):
+        raise PropertyReadOnlyException()
@@ -0,0 +1,116 @@
+""" Cached reader for piaware's status.json
+
+    piaware rewrites status.json periodically. The parsed document is cached
+    keyed by the file's (inode, mtime, size), so repeated reads only stat the
+    file, and listeners are notified when the derived snapshot changes.
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import constants
+
+logger = logging.getLogger('piaware_ble_connect')
+
+StatusSnapshot = namedtuple('StatusSnapshot', ['site_number', 'is_claimed', 'is_connected', 'is_expired'])
+
+
+def parse_site_number(site_url):
+    """ Returns the site number from a FlightAware site URL, or None
+
+    """
+    if "#stats-" in site_url:
+        split_site_url = site_url.split("#stats-")
+    elif "/stats/site/" in site_url:
+        split_site_url = site_url.split("/stats/site/")
+    else:
+        return None
+
+    if len(split_site_url) == 2:
+        return split_site_url[1]
+
+    return None
+
+
+def make_snapshot(data):
+    """ Build a StatusSnapshot from a parsed status.json document
+
+    """
+    site_url = data.get('site_url')
+    site_number = parse_site_number(site_url) if isinstance(site_url, str) else None
+
+    # piaware stops refreshing the file when it exits, don't trust stale state
+    expiry = data.get('expiry')
+    is_expired = isinstance(expiry, (int, float)) and expiry < time.time() * 1000
+
+    adept = data.get('adept')
+    is_connected = isinstance(adept, dict) and adept.get('status') == 'green' and not is_expired
+
+    is_claimed = site_number is not None and 'unclaimed_feeder_id' not in data
+
+    return StatusSnapshot(site_number, is_claimed, is_connected, is_expired)
+
+
+class StatusReader():
+    ''' Reads status.json, re-parsing only when the file changes
+
+    '''
+    def __init__(self, path=constants.PIAWARE_STATUS_JSON):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file_key = None
+        self.data = None
+        self.snapshot = None
+        self.listeners = []
+
+    def add_listener(self, callback):
+        ''' Register callback(snapshot) to be called when the snapshot changes
+
+            Callbacks run on the thread that called read().
+        '''
+        self.listeners.append(callback)
+
+    def read(self):
+        """ Returns the current StatusSnapshot, or None if status.json is unavailable
+
+        """
+        try:
+            st = os.stat(self.path)
+            file_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            file_key = None
+
+        with self.lock:
+            if file_key != self.file_key:
+                data = None
+                if file_key is not None:
+                    try:
+                        with open(self.path, 'r') as status_json:
+                            data = json.load(status_json)
+                        if not isinstance(data, dict):
+                            raise ValueError('not a JSON object')
+                    except (OSError, ValueError) as e:
+                        logger.error(f'Error reading {self.path}: {e}')
+                        # Leave the key unset so the next read retries
+                        data = None
+                        file_key = None
+                self.file_key = file_key
+                self.data = data
+
+            # Rebuilt from the cached document each time so expiry is re-evaluated
+            snapshot = make_snapshot(self.data) if self.data is not None else None
+            previous, self.snapshot = self.snapshot, snapshot
+
+        if snapshot != previous:
+            logger.debug(f'piaware status changed: {snapshot}')
+            for callback in self.listeners:
+                callback(snapshot)
+
+        return snapshot
+
+
+status_reader = StatusReader()
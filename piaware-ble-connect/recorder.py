@@ -0,0 +1,288 @@
+""" Optional recording of BLE sessions for replay
+
+    When started with --record, every Rx write, every Tx notification chunk
+    and every piaware-configurator HTTP exchange is appended to a compact
+    binary log, timestamped relative to the start of the recording.
+    tools/replay_session.py feeds a recording back through the request path.
+
+    File layout: FILE_MAGIC, the wall-clock start time as a big-endian
+    double, then records of RECORD_HEADER (type, seconds since start,
+    session id, payload length) followed by the payload. Session id 0 means
+    no particular central.
+
+    Wi-Fi passphrases never reach the file. Rx writes are held until the
+    request they belong to is complete; the writes of a request carrying a
+    passphrase are recorded as a single write of the redacted request. Tx
+    messages and configurator exchanges are redacted before they are
+    recorded.
+
+"""
+import json
+import logging
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from framing import FrameDecoder, FrameTooLargeError, MESSAGE_TERMINATOR, encode_message, split_payload
+
+logger = logging.getLogger('piaware_ble_connect')
+
+FILE_MAGIC = b'PBLEREC1'
+FILE_HEADER = struct.Struct('>d')
+RECORD_HEADER = struct.Struct('>BdHI')
+
+# Record types
+RECORD_SESSION = 1    # payload: central name, utf-8
+RECORD_MTU = 2        # payload: >H ATT MTU
+RECORD_RX = 3         # payload: bytes of one write
+RECORD_TX = 4         # payload: one notification chunk
+RECORD_TX_END = 5     # payload: the last notification chunk of a message
+RECORD_HTTP = 6       # payload: JSON {request, status, response, ms}
+
+MTU_PAYLOAD = struct.Struct('>H')
+
+# Keys whose values are replaced before anything is written
+SECRET_KEY_FRAGMENTS = ('password', 'passphrase', 'psk')
+REDACTED = '<redacted>'
+
+Record = namedtuple('Record', ['type', 'offset', 'session', 'payload'])
+
+
+def is_secret_key(key):
+    key = str(key).lower()
+    return any(fragment in key for fragment in SECRET_KEY_FRAGMENTS)
+
+
+def redact(value):
+    ''' Returns a copy of a decoded JSON value with secret values replaced
+
+    '''
+    if isinstance(value, dict):
+        return {key: REDACTED if is_secret_key(key) else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def redact_frame(frame):
+    """ Redact one Rx request
+
+        Parameters:
+        frame (bytes): Request without terminator
+
+        Returns: (bytes, redacted), the original bytes when nothing needed redacting
+    """
+    try:
+        message = json.loads(frame)
+    except ValueError:
+        # Unparseable requests are rejected anyway, keep them unless they may hold a secret
+        lowered = frame.lower()
+        if any(fragment.encode('ascii') in lowered for fragment in SECRET_KEY_FRAGMENTS):
+            return REDACTED.encode('ascii'), True
+        return frame, False
+
+    redacted = redact(message)
+    if redacted == message:
+        return frame, False
+    return json.dumps(redacted).encode('utf-8'), True
+
+
+class SessionRecorder():
+    ''' Writes the recording. Does nothing until start() is called
+
+        Safe to use from any thread; HTTP exchanges are recorded from the
+        request worker threads.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.file = None
+        self.started = None
+        self.session_ids = {}
+        self.mtus = {}
+        self.decoders = {}
+        self.held_writes = {}
+
+    def start(self, path):
+        """ Start recording to path, replacing any existing file
+
+            Parameters:
+            path (str): File to write the recording to
+        """
+        with self.lock:
+            self.file = open(path, 'wb')
+            self.started = time.monotonic()
+            self.file.write(FILE_MAGIC + FILE_HEADER.pack(time.time()))
+            self.enabled = True
+        logger.info(f'Recording BLE sessions to {path}')
+
+    def stop(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self.file.close()
+            self.file = None
+            self.session_ids.clear()
+            self.mtus.clear()
+            self.decoders.clear()
+            self.held_writes.clear()
+
+    def _write(self, record_type, offset, session_id, payload):
+        self.file.write(RECORD_HEADER.pack(record_type, offset, session_id, len(payload)))
+        self.file.write(payload)
+
+    def _session_id(self, session, offset):
+        # Sessions are numbered in order of appearance; their MTU is recorded whenever it changes
+        session_id = self.session_ids.get(session.name)
+        if session_id is None:
+            session_id = self.session_ids[session.name] = len(self.session_ids) + 1
+            self._write(RECORD_SESSION, offset, session_id, session.name.encode('utf-8'))
+        if self.mtus.get(session_id) != session.mtu:
+            self.mtus[session_id] = session.mtu
+            self._write(RECORD_MTU, offset, session_id, MTU_PAYLOAD.pack(session.mtu))
+        return session_id
+
+    def record_rx(self, session, data):
+        """ Record one Rx write from session
+
+            Parameters:
+            session (Session): Central the write came from
+            data (bytes): Bytes written
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if not self.enabled:
+                return
+            offset = time.monotonic() - self.started
+            session_id = self._session_id(session, offset)
+            decoder = self.decoders.setdefault(session_id, FrameDecoder())
+            held = self.held_writes.setdefault(session_id, [])
+            held.append((offset, bytes(data)))
+
+            try:
+                frames = list(decoder.feed(data))
+            except FrameTooLargeError:
+                # Discarded by the daemon too, keep only the fact that it happened
+                held.clear()
+                self._write(RECORD_RX, offset, session_id, REDACTED.encode('ascii'))
+                return
+
+            if not frames:
+                return
+
+            # Bytes after the last complete request start the next one, hold them back
+            leftover = len(decoder.buffer)
+            last_offset, last_write = held.pop()
+            if leftover:
+                held.append((last_offset, last_write[:-leftover]))
+            else:
+                held.append((last_offset, last_write))
+
+            redacted_frames = [redact_frame(frame) for frame in frames]
+            if any(redacted for _, redacted in redacted_frames):
+                payload = b''.join(frame + MESSAGE_TERMINATOR for frame, _ in redacted_frames)
+                self._write(RECORD_RX, last_offset, session_id, payload)
+            else:
+                for write_offset, write in held:
+                    if write:
+                        self._write(RECORD_RX, write_offset, session_id, write)
+
+            held.clear()
+            if leftover:
+                held.append((last_offset, last_write[-leftover:]))
+            self.file.flush()
+
+    def record_tx(self, session, message, encoding, mtu, chunks):
+        """ Record the notification chunks of one Tx message
+
+            Parameters:
+            session (Session): Central the message was meant for, None for all
+            message (dict): Message before encoding
+            encoding (str): Tx encoding the message was sent in
+            mtu (int): ATT MTU the chunks were sized for
+            chunks (list): bytes of each chunk, in order
+        """
+        if not self.enabled or not chunks:
+            return
+
+        # A message echoing a secret is recorded as if the secret had been redacted before sending
+        redacted = redact(message)
+        if redacted != message:
+            chunks = split_payload(encode_message(redacted, encoding), mtu)
+
+        with self.lock:
+            if not self.enabled:
+                return
+            offset = time.monotonic() - self.started
+            session_id = self._session_id(session, offset) if session is not None else 0
+            for chunk in chunks[:-1]:
+                self._write(RECORD_TX, offset, session_id, chunk)
+            self._write(RECORD_TX_END, offset, session_id, chunks[-1])
+            self.file.flush()
+
+    def record_http(self, json_body, status, data, started):
+        """ Record one piaware-configurator exchange
+
+            Parameters:
+            json_body (dict): Request body
+            status (int): HTTP status of the response
+            data (bytes): Response body
+            started (float): time.perf_counter() value when the request was sent
+        """
+        if not self.enabled:
+            return
+
+        elapsed = (time.perf_counter() - started) * 1000
+        try:
+            response = redact(json.loads(data)) if data else None
+        except ValueError:
+            response = data.decode('utf-8', errors='replace')
+        payload = json.dumps({'request': redact(json_body), 'status': status,
+                              'response': response, 'ms': round(elapsed, 3)}).encode('utf-8')
+
+        with self.lock:
+            if not self.enabled:
+                return
+            self._write(RECORD_HTTP, time.monotonic() - self.started, 0, payload)
+            self.file.flush()
+
+
+def read_recording(path):
+    """ Read a recording written by SessionRecorder
+
+        Parameters:
+        path (str): Recording file
+
+        Returns: (wall-clock start time, list of Record)
+
+        Raises: ValueError if path is not a recording
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(FILE_MAGIC):
+        raise ValueError(f'{path} is not a BLE session recording')
+
+    position = len(FILE_MAGIC)
+    (started,) = FILE_HEADER.unpack_from(data, position)
+    position += FILE_HEADER.size
+
+    records = []
+    while position + RECORD_HEADER.size <= len(data):
+        record_type, offset, session_id, length = RECORD_HEADER.unpack_from(data, position)
+        position += RECORD_HEADER.size
+        payload = data[position:position + length]
+        if len(payload) < length:
+            # Truncated by a crash mid-write
+            break
+        position += length
+        records.append(Record(record_type, offset, session_id, payload))
+
+    return started, records
+
+
+recorder = SessionRecorder()
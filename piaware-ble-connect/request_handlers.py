@@ -2,10 +2,16 @@
 requests to piaware_configurator to configure piaware
 
 """
+import copy
 import json
-import requests
 import logging
+import random
+import threading
 import time
+from collections import OrderedDict
+from functools import partial
+from configurator_client import get_client, MUTATING_REQUESTS
+from metrics import metrics
 from piaware_helpers import get_rpi_model_and_serial_number
 
 logger = logging.getLogger('piaware_ble_connect')
@@ -16,9 +22,179 @@ SUPPORTED_REQUESTS = [
     'get_device_state',
     'get_wifi_networks',
     'set_wifi_config',
-    'piaware_config_read'
+    'piaware_config_read',
+    'stream_wifi_networks',
 ]
 
+# Read-only requests whose responses may be reused, with their TTL in seconds
+CACHEABLE_REQUEST_TTLS = {
+    'get_device_info': 300,
+    'piaware_config_read': 60,
+}
+
+# Backoff (seconds) between readiness probes while piaware-configurator starts
+READY_PROBE_INITIAL_DELAY = 0.25
+READY_PROBE_MAX_DELAY = 6
+
+# get_wifi_networks answered as a sequence of pages, strongest networks first
+WIFI_STREAM_REQUEST = 'stream_wifi_networks'
+WIFI_PAGE_SIZE = 5
+WIFI_SIGNAL_FIELDS = ['signal_level', 'signal', 'rssi']
+
+# Requests handled by the daemon itself rather than piaware-configurator
+ENCODING_REQUEST = 'set_encoding'
+SUBSCRIBE_STATE_REQUEST = 'subscribe_device_state'
+UNSUBSCRIBE_STATE_REQUEST = 'unsubscribe_device_state'
+LOCAL_REQUESTS = [
+    ENCODING_REQUEST,
+    SUBSCRIBE_STATE_REQUEST,
+    UNSUBSCRIBE_STATE_REQUEST,
+]
+
+# Envelope carrying several requests answered with one response
+BATCH_REQUEST = 'batch'
+MAX_BATCH_REQUESTS = 8
+
+
+class ResponseStream():
+    ''' Several self-contained responses sent in order for one request
+
+    '''
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __len__(self):
+        return len(self.pages)
+
+
+class ResponseCache():
+    ''' Size-bounded LRU cache of piaware-configurator responses with per-entry TTL
+
+    '''
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(url, json_body):
+        payload = json.dumps(json_body.get('request_payload'), sort_keys=True)
+        return (url, json_body.get('request'), payload)
+
+    def get(self, key):
+        ''' Returns a copy of the cached response for key, or None
+
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                response = copy.deepcopy(entry[1])
+            else:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                response = None
+
+        metrics.increment('response_cache_hits' if response is not None else 'response_cache_misses',
+                          request=key[1])
+        return response
+
+    def put(self, key, response, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, copy.deepcopy(response))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+                metrics.increment('response_cache_evictions')
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self.entries)}
+
+
+response_cache = ResponseCache()
+
+
+class DeviceStateProvider():
+    ''' Shared source of get_device_state responses
+
+        Concurrent callers are coalesced onto a single in-flight request to
+        piaware-configurator, and a successful response is reused until it is
+        older than max_age seconds. All callers are expected to use the same
+        piaware-configurator URL. The shared request has no request_payload;
+        requests that carry one are forwarded on their own.
+    '''
+    def __init__(self, max_age=2):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.in_flight = None
+        self.last_response = None
+        self.snapshot = None
+        self.snapshot_time = 0
+
+    def get(self, url, request_id=None):
+        """ Returns the current device state response
+
+            Parameters:
+            url (str): piaware-configurator URL
+            request_id: request_id to echo in the returned response
+
+            Returns: JSON response
+        """
+        with self.lock:
+            if self.snapshot is not None and time.monotonic() - self.snapshot_time < self.max_age:
+                return self._copy(self.snapshot, request_id)
+
+            leader = self.in_flight is None
+            if leader:
+                self.in_flight = threading.Event()
+            flight = self.in_flight
+
+        if not leader:
+            flight.wait()
+            with self.lock:
+                return self._copy(self.last_response, request_id)
+
+        response = None
+        try:
+            response = http_json_post(url, {"request": "get_device_state", "requestor": "piaware-ble-connect"})
+        finally:
+            with self.lock:
+                if response is None:
+                    response = {"success": False, "error": "Could not read device state"}
+                self.last_response = response
+                if response.get("success"):
+                    self.snapshot = response
+                    self.snapshot_time = time.monotonic()
+                self.in_flight = None
+            flight.set()
+
+        return self._copy(response, request_id)
+
+    def invalidate(self):
+        with self.lock:
+            self.snapshot = None
+
+    @staticmethod
+    def _copy(response, request_id):
+        response = copy.deepcopy(response)
+        response["request_id"] = request_id
+        return response
+
+
+device_state = DeviceStateProvider()
+
 
 def http_json_post(url, json_body):
     """Create and send a JSON POST request
@@ -30,84 +206,327 @@ def http_json_post(url, json_body):
         Returns: JSON response
 
     """
-    request_id = json_body.get("request_id")
+    return get_client(url).post(json_body)
+
+
+def cached_json_post(url, json_body):
+    """ Send a JSON POST request, reusing a cached response for read-only requests
+
+        Successful mutating requests invalidate the cache. Cached responses
+        carry the request_id of the current request.
+
+        Parameters:
+        url (str): piaware-configurator URL
+        json_body (dict): JSON data to include in HTTP POST body
+
+        Returns: JSON response
+
+    """
+    request = json_body.get("request")
+    ttl = CACHEABLE_REQUEST_TTLS.get(request)
+
+    if ttl is not None:
+        key = ResponseCache.make_key(url, json_body)
+        response = response_cache.get(key)
+        if response is not None:
+            logger.debug(f'Serving {request} from cache')
+            response["request_id"] = json_body.get("request_id")
+            return response
+
+    response = http_json_post(url, json_body)
+
+    if response.get("success"):
+        if ttl is not None:
+            response_cache.put(key, response, ttl)
+        elif request in MUTATING_REQUESTS:
+            response_cache.invalidate()
+            device_state.invalidate()
+
+    return response
+
+
+def is_mutating_request(request):
+    """ Returns True if request changes receiver configuration
+
+        Parameters:
+        request (json str or bytes): Raw BLE request
+
+        A batch counts as mutating if any of its items is. Malformed requests
+        are treated as read-only, handle_request rejects them.
+    """
     try:
-        r = requests.post(url, json=json_body, timeout=20)
-        r.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xxx
-    except requests.ConnectionError:
-        error = f'Cannot connect to {url}...'
-        return {"success": False, "error": error, "request_id": request_id}
-    except requests.Timeout:
-        error = f'Request to {url} timed out...'
-        return {"success": False, "error": error, "request_id": request_id}
-    except requests.HTTPError:
-        error = f'HTTP Error returned from server: {r.status_code}'
-        return {"success": False, "error": error, "request_id": request_id}
-    except Exception as e:
-        return {"success": False, "error": e, "request_id": request_id}
+        json_object = json.loads(request)
+    except ValueError:
+        return False
+
+    if not isinstance(json_object, dict):
+        return False
 
-    # Send success json back to BLE central
-    response_json = {"success": True, "request_id": request_id}
-    if r.json():
-        response_json["response_payload"] = r.json()
+    if json_object.get("request") == BATCH_REQUEST:
+        items = json_object.get("requests")
+        return isinstance(items, list) and any(
+            isinstance(item, dict) and item.get("request") in MUTATING_REQUESTS for item in items)
 
-    return response_json
+    return json_object.get("request") in MUTATING_REQUESTS
 
 
-def handle_request(host, port, request):
-    """ Handles incoming BLE UART data
+def parse_local_request(request):
+    """ Recognise requests the daemon answers itself on the mainloop
 
         Parameters:
-        host (str): Host IP of piaware-configurator serving BLE requests
-        port (str): Port number of piaware-configurator serving BLE requests
-        request (json str): Valid JSON string that requires with
-                            request_id and request fields
+        request (json str or bytes): Raw BLE request
 
+        Returns: (request, request_id, request_payload dict) for one of
+                 LOCAL_REQUESTS, otherwise None
     """
-    # Validate json formatting
+    # Cheap check first, this runs on the mainloop for every request
+    if not any(name.encode('utf-8') in request for name in LOCAL_REQUESTS):
+        return None
+
     try:
         json_object = json.loads(request)
     except ValueError:
-        return {"success": False, "error": "Bad JSON formatting"}
+        return None
 
-    # Validate request
+    if not isinstance(json_object, dict) or json_object.get("request") not in LOCAL_REQUESTS:
+        return None
+
+    payload = json_object.get("request_payload")
+    return json_object["request"], json_object.get("request_id"), payload if isinstance(payload, dict) else {}
+
+
+def validate_request(json_object, supported=SUPPORTED_REQUESTS):
+    """ Check a decoded request has the required fields and is supported
+
+        Parameters:
+        json_object (dict): Decoded request
+        supported (list): Request types accepted
+
+        Returns: (request_id, request, error response or None)
+    """
     try:
         request_id = json_object["request_id"]
         request = json_object["request"]
     except KeyError as e:
         error = f'Missing required field in request: {e}'
-        return {"success": False, "error": error}
-
-    if request not in SUPPORTED_REQUESTS:
+        response = {"success": False, "error": error}
+        # Responses may complete out of order, echo the id whenever we have one
+        if "request_id" in json_object:
+            response["request_id"] = json_object["request_id"]
+        return None, None, response
+    except TypeError:
+        return None, None, {"success": False, "error": "Bad JSON formatting"}
+
+    if request not in supported:
         logger.error(f'Unsupported BLE request received: {request}')
         error = f'Unsupported request received: {request}'
-        return {"success": False, "error": error}
+        return request_id, request, {"success": False, "error": error, "request_id": request_id}
 
-    logger.info(f'BLE request received: {request}')
+    return request_id, request, None
 
-    # Generate piaware-configurator URL to send POST request to
-    piaware_configurator_host_url = f'http://{host}:{port}/configurator'
+
+def process_request(url, json_object, request_id, request):
+    """ Forward a validated request to piaware-configurator
+
+    """
+    # Device state is shared with the advertising monitor, unless the central
+    # sent a payload the shared request would not carry
+    if request == 'get_device_state' and json_object.get('request_payload') is None:
+        return device_state.get(url, request_id)
+
+    if request == WIFI_STREAM_REQUEST:
+        return stream_wifi_networks(url, request_id, json_object)
 
     # Tag request showing it came in via BLE
     json_object['requestor'] = "piaware-ble-connect"
 
-    response = http_json_post(piaware_configurator_host_url, json_object)
+    response = cached_json_post(url, json_object)
+    if isinstance(response, dict):
+        response.setdefault("request_id", request_id)
 
     return response
 
 
-def get_ble_advertisement_identifier(BLE_host, BLE_port):
+def network_signal(network):
+    """ Returns a network's signal strength in dBm, or None if not reported
+
+    """
+    for field in WIFI_SIGNAL_FIELDS:
+        value = network.get(field)
+        if isinstance(value, bool) or value is None:
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def stream_wifi_networks(url, request_id, json_object):
+    """ Fetch the Wi-Fi scan results and split them into pages
+
+        Every page is a complete response tagged with the request_id and a
+        sequence number, so the client can render each one as it arrives.
+        The stream ends with a page carrying "end_of_stream": true and the
+        total number of networks. A failed scan is sent as a single error
+        page that also ends the stream.
+
+        Returns: ResponseStream
+    """
+    forward = dict(json_object, request="get_wifi_networks", requestor="piaware-ble-connect")
+    response = cached_json_post(url, forward)
+
+    payload = response.get("response_payload") if response.get("success") else None
+    networks = payload.get("wifi_networks") if isinstance(payload, dict) else None
+    if not isinstance(networks, list):
+        error = dict(response, request_id=request_id, sequence=0, end_of_stream=True)
+        if error.get("success"):
+            error.update(success=False, error="Invalid get_wifi_networks response")
+        return ResponseStream([error])
+
+    # Strongest first; networks without a usable signal go last
+    networks = [network for network in networks if isinstance(network, dict)]
+    networks.sort(key=lambda network: (network_signal(network) is None, -(network_signal(network) or 0)))
+
+    pages = []
+    for start in range(0, len(networks), WIFI_PAGE_SIZE):
+        pages.append({"success": True, "request_id": request_id, "sequence": len(pages),
+                      "end_of_stream": False,
+                      "response_payload": {"wifi_networks": networks[start:start + WIFI_PAGE_SIZE]}})
+
+    pages.append({"success": True, "request_id": request_id, "sequence": len(pages),
+                  "end_of_stream": True, "response_payload": {"total": len(networks)}})
+
+    return ResponseStream(pages)
+
+
+def process_batch_item(url, item):
+    request_id, request, error = validate_request(item)
+    if error is not None:
+        return error
+
+    if request == WIFI_STREAM_REQUEST:
+        return {"success": False, "error": f'{request} is not allowed in a batch', "request_id": request_id}
+
+    logger.debug(f'BLE batch item: {request}')
+    return process_request(url, item, request_id, request)
+
+
+def run_batch_item(url, item):
+    try:
+        return process_batch_item(url, item)
+    except Exception as e:
+        logger.error(f'Unhandled error processing batch item: {e}')
+        return {"success": False, "error": "Internal error"}
+
+
+def handle_batch(url, request_id, json_object, fan_out=None):
+    """ Handles a batch request: a list of sub-requests answered in one response
+
+        Read-only items run concurrently through fan_out, so a batch takes
+        about as long as its slowest item. If any item changes configuration
+        the items run one after another in order instead, so later items see
+        the change.
+
+        Parameters:
+        fan_out (callable): fan_out(func, items) runs func on every item and
+                            returns the results in order, e.g.
+                            RequestDispatcher.fan_out. Items run one after
+                            another when None
+
+        Returns: {"success": True, "request_id": ..., "responses": [...]} with
+                 one response per item in request order
+    """
+    items = json_object.get("requests")
+    if not isinstance(items, list) or not items:
+        return {"success": False, "error": "Batch request requires a non-empty requests list",
+                "request_id": request_id}
+
+    if len(items) > MAX_BATCH_REQUESTS:
+        return {"success": False, "error": f'Batch request exceeds {MAX_BATCH_REQUESTS} items',
+                "request_id": request_id}
+
+    logger.info(f'BLE batch request received: {len(items)} requests')
+
+    run_item = partial(run_batch_item, url)
+    mutating = any(isinstance(item, dict) and item.get("request") in MUTATING_REQUESTS for item in items)
+    if mutating or fan_out is None:
+        responses = [run_item(item) for item in items]
+    else:
+        responses = [response if response is not None else {"success": False, "error": "Internal error"}
+                     for response in fan_out(run_item, items)]
+
+    return {"success": True, "request_id": request_id, "responses": responses}
+
+
+def handle_request(host, port, request, fan_out=None):
+    """ Handles incoming BLE UART data
+
+        Parameters:
+        host (str): Host IP of piaware-configurator serving BLE requests
+        port (str): Port number of piaware-configurator serving BLE requests
+        request (json str or bytes): Valid JSON document that requires
+                                     request_id and request fields
+        fan_out (callable): Runs the read-only items of a batch concurrently,
+                            see handle_batch
+
+    """
+    started = time.perf_counter()
+    request_type, response = process_ble_request(host, port, request, fan_out)
+    metrics.observe_since('ble_request_ms', started, request=request_type, outcome=response_outcome(response))
+    return response
+
+
+def response_outcome(response):
+    if isinstance(response, ResponseStream):
+        response = response.pages[-1] if response.pages else None
+    return 'success' if isinstance(response, dict) and response.get("success") else 'error'
+
+
+def process_ble_request(host, port, request, fan_out=None):
+    """ Returns (request type for metrics, response) for a raw BLE request
+
+    """
+    # Validate json formatting
+    try:
+        json_object = json.loads(request)
+    except ValueError:
+        return 'invalid', {"success": False, "error": "Bad JSON formatting"}
+
+    # Generate piaware-configurator URL to send POST request to
+    piaware_configurator_host_url = f'http://{host}:{port}/configurator'
+
+    if isinstance(json_object, dict) and json_object.get("request") == BATCH_REQUEST:
+        # The envelope needs a request_id like any other request; items are validated one by one
+        request_id, _, error = validate_request(json_object, [BATCH_REQUEST])
+        if error is not None:
+            return 'invalid', error
+        return BATCH_REQUEST, handle_batch(piaware_configurator_host_url, request_id, json_object, fan_out)
+
+    # Validate request
+    request_id, request, error = validate_request(json_object)
+    if error is not None:
+        return 'invalid', error
+
+    logger.info(f'BLE request received: {request}')
+
+    return request, process_request(piaware_configurator_host_url, json_object, request_id, request)
+
+
+def get_ble_advertisement_identifier(BLE_host, BLE_port, raspberry_pi_model=None):
     """ Returns an identifier name to use when advertising over BLE.
 
         Parameters:
         host (str): Host IP of piaware-configurator serving BLE requests
         port (str): Port number of piaware-configurator serving BLE requests
+        raspberry_pi_model (str): Pi model if already known, otherwise read from cpuinfo
     """
     piaware_configurator_url = f'http://{BLE_host}:{BLE_port}/configurator'
 
-    raspberry_pi_model, mfr_serial_number = get_rpi_model_and_serial_number()
+    if raspberry_pi_model is None:
+        raspberry_pi_model, mfr_serial_number = get_rpi_model_and_serial_number()
     request = '{"request": "get_device_info", "requestor":"piaware-ble-connect"}'
-    response = http_json_post(piaware_configurator_url, json.loads(request))
+    response = cached_json_post(piaware_configurator_url, json.loads(request))
     if response is None or type(response) is not dict:
         return f"FlightAware Receiver - {raspberry_pi_model}"
 
@@ -129,14 +548,13 @@ def get_ble_advertisement_identifier(BLE_host, BLE_port):
     return f"FlightAware Receiver - {raspberry_pi_model}"
 
 def is_ethernet_active(piaware_configurator_url):
-    ''' Returns whether Ethernet is connected
+    ''' Returns whether Ethernet is connected, or None if that could not be determined
 
         Parameters:
         piaware_configurator_url (str): URL of piaware-configurator to request receiver data from
     '''
-    request = '{"request": "get_device_state"}'
-    response = http_json_post(piaware_configurator_url, json.loads(request))
-    if response is None or type(response) is not dict:
+    response = device_state.get(piaware_configurator_url)
+    if response is None or type(response) is not dict or not response.get('success'):
         return None
 
     try:
@@ -148,7 +566,7 @@ def is_ethernet_active(piaware_configurator_url):
     except KeyError:
         logger.info(f'Could not determine Ethernet state')
 
-    return False
+    return None
 
 
 def advertising_should_be_on(piaware_configurator_url):
@@ -159,8 +577,7 @@ def advertising_should_be_on(piaware_configurator_url):
         Parameters:
         piaware_configurator_url (str): URL of piaware-configurator to request receiver data from
     '''
-    request = '{"request": "get_device_state"}'
-    response = http_json_post(piaware_configurator_url, json.loads(request))
+    response = device_state.get(piaware_configurator_url)
     if response is None or type(response) is not dict:
         return None
 
@@ -176,15 +593,20 @@ def advertising_should_be_on(piaware_configurator_url):
     return True
 
 
-def ble_enabled(piaware_configurator_url):
+def ble_enabled(piaware_configurator_url, ready_timeout=60):
     ''' Returns whether BLE service is enabled in piaware-config
 
+        Parameters:
+        piaware_configurator_url (str): URL of piaware-configurator to request receiver data from
+        ready_timeout (float): Seconds to keep retrying while piaware-configurator starts up
     '''
     request = '{"request": "piaware_config_read", "request_payload": ["allow-ble-setup", "wireless-ssid"]}'
-    max_retries = 10
+    deadline = time.monotonic() + ready_timeout
+    attempt = 0
 
-    # Retry requests to piaware-configurator in case it's not ready to serve requests
-    for i in range(max_retries):
+    # Retry requests to piaware-configurator in case it's not ready to serve requests.
+    # Back off exponentially with jitter so a fast start is noticed quickly on any Pi.
+    while True:
         response = http_json_post(piaware_configurator_url, json.loads(request))
         # Something went wrong determining if BLE is enabled. Let's disable it
         if response is None or type(response) is not dict:
@@ -193,11 +615,15 @@ def ble_enabled(piaware_configurator_url):
         if response.get("success") == True:
            break
 
-        logger.debug(f'Error making request to piaware-configurator...retrying...')
-        time.sleep(6)
-    else:
-        logger.error(f'Could not read piaware-config settings to determine if Bluetooth configuration should be enabled.')
-        return False
+        delay = min(READY_PROBE_MAX_DELAY, READY_PROBE_INITIAL_DELAY * 2 ** attempt)
+        delay = min(random.uniform(delay / 2, delay), deadline - time.monotonic())
+        if delay <= 0:
+           logger.error(f'Could not read piaware-config settings to determine if Bluetooth configuration should be enabled.')
+           return False
+
+        logger.debug(f'Error making request to piaware-configurator...retrying in {delay:.2f}s...')
+        time.sleep(delay)
+        attempt += 1
 
     try:
        settings = response['response_payload']
@@ -1,44 +1,217 @@
 """ This file contains helper functions to enable/disable BLE services
 
+    Units are managed through the systemd D-Bus API on the system bus. Access
+    is granted to the piaware-ble-connect user by a polkit rule. polkit
+    versions before 0.106 do not load JavaScript rules and deny the request;
+    there the sudo systemctl fallback allowed by sudoers is used instead.
+
 """
 import logging
-import subprocess
+import threading
+import time
+import dbus
+from gi.repository import GLib
+
+import constants
 
 logger = logging.getLogger('piaware_ble_connect')
 
+# Seconds to wait for the sudo systemctl fallback to finish
+SYSTEMCTL_TIMEOUT = 30
+
+
+class SystemdJob():
+    ''' A systemd job queued for a unit
+
+        result is None until systemd reports the job finished, then one of
+        'done', 'canceled', 'timeout', 'failed', 'dependency' or 'skipped'.
+    '''
+    def __init__(self, unit, action, path=None):
+        self.unit = unit
+        self.action = action
+        self.path = path
+        self.result = None
+        self.finished = threading.Event()
+
+    def complete(self, result):
+        self.result = str(result)
+        self.finished.set()
+        logger.debug(f'{self.action} {self.unit}: {self.result}')
+
+    def wait(self, timeout=None):
+        ''' Wait for the job to finish
+
+            On the main thread the default GLib main context is iterated so the
+            JobRemoved signal can be delivered even before the mainloop runs.
+
+            Returns: job result, or None if it did not finish in time
+        '''
+        if threading.current_thread() is not threading.main_thread():
+            self.finished.wait(timeout)
+            return self.result
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        context = GLib.MainContext.default()
+        while not self.finished.is_set():
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if not context.iteration(False):
+                self.finished.wait(0.01)
+        return self.result
+
+
+class SystemdManager():
+    ''' Client for org.freedesktop.systemd1.Manager
+
+    '''
+    def __init__(self, bus):
+        self.bus = bus
+        self.manager = dbus.Interface(bus.get_object(constants.DBUS_SYSTEMD_IFACE,
+                                                     constants.DBUS_SYSTEMD_OBJECT_PATH),
+                                      constants.DBUS_SYSTEMD_MANAGER_IFACE)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.removed = {}
+
+        bus.add_signal_receiver(self.on_job_removed,
+                                signal_name='JobRemoved',
+                                dbus_interface=constants.DBUS_SYSTEMD_MANAGER_IFACE,
+                                path=constants.DBUS_SYSTEMD_OBJECT_PATH)
+        # systemd only emits job signals while at least one client is subscribed
+        self.manager.Subscribe()
+
+    def start_unit(self, unit):
+        return self.queue_job('StartUnit', unit)
+
+    def stop_unit(self, unit):
+        return self.queue_job('StopUnit', unit)
+
+    def restart_unit(self, unit):
+        return self.queue_job('RestartUnit', unit)
+
+    def queue_job(self, method, unit):
+        ''' Ask systemd to queue a job for unit
+
+            Returns: SystemdJob
+
+            Raises: dbus.exceptions.DBusException if systemd refused the job
+        '''
+        job = SystemdJob(unit, method)
+        job.path = str(getattr(self.manager, method)(unit, 'replace'))
+
+        with self.lock:
+            result = self.removed.pop(job.path, None)
+            if result is None:
+                self.jobs[job.path] = job
+        if result is not None:
+            job.complete(result)
+
+        return job
+
+    def on_job_removed(self, job_id, job_path, unit, result):
+        job_path = str(job_path)
+        with self.lock:
+            job = self.jobs.pop(job_path, None)
+            if job is None:
+                # Signal raced ahead of our bookkeeping, or a job we didn't start
+                self.removed[job_path] = result
+                if len(self.removed) > 64:
+                    self.removed.pop(next(iter(self.removed)))
+                return
+        job.complete(result)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_systemd_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SystemdManager(dbus.SystemBus())
+        return _manager
+
+
+def systemctl_fallback(action, service_name):
+    """ Run sudo systemctl for polkit versions that ignore the JavaScript rule
+
+        The command is started with Popen and a thread waits for it, so
+        callers get the job back at once and can wait on it like a D-Bus job,
+        and the child is always reaped. Only used where polkit denied the
+        D-Bus call, i.e. polkit older than 0.106.
+
+        Returns: SystemdJob, or None if sudo could not be started
+    """
+    # Only reached when systemd refuses the D-Bus call, keep subprocess off the startup path
+    import subprocess
+
+    job = SystemdJob(service_name, action)
+    try:
+        process = subprocess.Popen(["sudo", "systemctl", action, service_name],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        logger.error(f'Unable to run sudo systemctl {action} {service_name}: {e}')
+        return None
+
+    def reap():
+        try:
+            returncode = process.wait(timeout=SYSTEMCTL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            job.complete('timeout')
+            return
+        job.complete('done' if returncode == 0 else 'failed')
+
+    threading.Thread(target=reap, name=f'systemctl-{action}', daemon=True).start()
+    return job
+
+
+def systemd_action(action, service_name):
+    ''' Queue a start/stop/restart job for service_name
+
+        Returns: SystemdJob, or None if the job could not be queued
+    '''
+    method = {'start': 'StartUnit', 'stop': 'StopUnit', 'restart': 'RestartUnit'}[action]
+    try:
+        return get_systemd_manager().queue_job(method, service_name)
+    except dbus.exceptions.DBusException as e:
+        if e.get_dbus_name() in ('org.freedesktop.DBus.Error.AccessDenied',
+                                 'org.freedesktop.DBus.Error.InteractiveAuthorizationRequired'):
+            logger.debug(f'systemd refused to {action} {service_name}, falling back to systemctl')
+            return systemctl_fallback(action, service_name)
+        logger.error(f'Unable to {action} {service_name}: {e}')
+        return None
+
 def stop_systemd_service(service_name):
     logger.debug(f'Stopping {service_name}')
-
-    cmd = ["sudo", "systemctl", "stop", service_name]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return systemd_action('stop', service_name)
 
 def start_systemd_service(service_name):
     logger.debug(f'Starting {service_name}')
-
-    cmd = ["sudo", "systemctl", "start", service_name]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return systemd_action('start', service_name)
 
 def restart_systemd_service(service_name):
     logger.debug(f'Restarting {service_name}')
-
-    cmd = ["sudo", "systemctl", "restart", service_name]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return systemd_action('restart', service_name)
 
 def shutdown_ble_services():
     logger.info(f'Stopping PiAware Bluetooth LE services for piaware configuration')
 
-    stop_systemd_service('piaware-wifi-scan.service')
-    stop_systemd_service('piaware-ble-connect.service')
+    # Both stop jobs are queued at once and run concurrently in systemd.
+    # Stopping piaware-ble-connect terminates this process, so don't wait on it.
+    return [stop_systemd_service('piaware-wifi-scan.service'),
+            stop_systemd_service('piaware-ble-connect.service')]
 
 def start_piaware_configurator():
     logger.debug(f'Starting piaware-configurator...')
-    start_systemd_service('piaware-configurator.service')
+    return start_systemd_service('piaware-configurator.service')
 
 def restart_piaware_configurator():
     logger.debug(f'Restarting piaware-configurator...')
-    restart_systemd_service('piaware-configurator.service')
+    return restart_systemd_service('piaware-configurator.service')
 
 def start_piaware_wifi_scan():
     logger.debug(f'Starting piaware-wifi-scan...')
-    start_systemd_service('piaware-wifi-scan.service')
-
+    return start_systemd_service('piaware-wifi-scan.service')
@@ -0,0 +1,301 @@
+""" Per-central sessions for the UART service
+
+    Each connected central is identified by the device object path BlueZ
+    passes in write options. A session owns the central's Rx reassembly
+    buffer, its queue of pending requests, its MTU and its Tx encoding.
+    Requests from different sessions are scheduled round-robin onto the
+    request dispatcher so one busy central cannot starve the others.
+
+    A session's Tx encoding only takes effect while it is the only session.
+    BlueZ delivers every notification to every subscribed central, so with
+    several sessions active all responses are sent as terminated JSON, which
+    every central can reassemble. A session starts when BlueZ reports its
+    central connected, so a central that has subscribed to Tx but not yet
+    written is counted too.
+
+    A central may pipeline requests: up to max_in_flight of a session's
+    requests run concurrently and responses are delivered as they complete,
+    matched up by the client using request_id. Requests that change the
+    receiver's configuration run on their own: they wait for everything
+    already started to finish, and nothing else starts until they are done.
+
+"""
+import logging
+import time
+from collections import deque, OrderedDict
+from functools import partial
+
+import constants
+from framing import FrameDecoder, DEFAULT_ATT_MTU, ENCODING_JSON
+from metrics import metrics
+from request_handlers import is_mutating_request
+
+logger = logging.getLogger('piaware_ble_connect')
+
+DEFAULT_MAX_SESSIONS = 8
+DEFAULT_MAX_QUEUED = 8
+DEFAULT_MAX_IN_FLIGHT = 2
+
+BLUEZ_DEVICE_IFACE = 'org.bluez.Device1'
+
+
+def session_key(device):
+    # BlueZ passes dbus.ObjectPath, signals carry plain strings
+    return str(device) if device is not None else None
+
+
+class Session():
+    ''' State for one connected central
+
+    '''
+    def __init__(self, device):
+        self.device = device
+        self.name = str(device).rsplit('/', 1)[-1] if device else 'unknown'
+        self.decoder = FrameDecoder()
+        self.requests = deque()
+        self.in_flight = 0
+        self.mutation_in_flight = False
+        self.mtu = DEFAULT_ATT_MTU
+        self.mtu_reported = False
+        self.encoding = ENCODING_JSON
+        self.requests_handled = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def update_mtu(self, mtu):
+        if not mtu:
+            return
+        self.mtu_reported = True
+        if int(mtu) != self.mtu:
+            logger.debug(f'{self.name}: ATT MTU negotiated: {mtu}')
+            self.mtu = int(mtu)
+
+    def record_latency(self, latency):
+        self.requests_handled += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+
+class SessionManager():
+    ''' Tracks sessions and schedules their requests fairly
+
+        Must only be used from the mainloop.
+    '''
+    def __init__(self, dispatcher, handler, deliver, max_sessions=DEFAULT_MAX_SESSIONS,
+                 max_queued=DEFAULT_MAX_QUEUED, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        '''
+            Parameters:
+            dispatcher (RequestDispatcher): Worker pool requests run on
+            handler (callable): handler(request) run on a worker, returns the response
+            deliver (callable): deliver(session, response, encoding) called on the mainloop
+            max_sessions (int): Maximum number of concurrent sessions
+            max_queued (int): Maximum number of queued requests per session, at
+                              most the dispatcher's queue_depth
+            max_in_flight (int): Maximum number of a session's requests running at once
+        '''
+        self.dispatcher = dispatcher
+        # Background work (advertising checks, state polls) shares the workers,
+        # so queued requests are also scheduled whenever one of those finishes
+        self.dispatcher.add_completion_hook(self.schedule)
+        self.handler = handler
+        self.deliver = deliver
+        self.max_sessions = max_sessions
+        self.max_queued = min(max_queued, dispatcher.queue_depth)
+        self.max_in_flight = max_in_flight
+        self.mutation_in_flight = False
+        self.sessions = OrderedDict()
+        self.rotation = 0
+        self.listeners = []
+
+    def add_listener(self, callback):
+        ''' Register callback() to be called when sessions or their requests change
+
+        '''
+        self.listeners.append(callback)
+
+    def get(self, device):
+        ''' Returns the session for device, creating it if needed
+
+        '''
+        device = session_key(device)
+        session = self.sessions.get(device)
+        if session is not None:
+            return session
+
+        if len(self.sessions) >= self.max_sessions:
+            # Drop the least recently created session to make room
+            oldest = next(iter(self.sessions))
+            logger.warning(f'Too many BLE sessions, dropping {self.sessions[oldest].name}')
+            self.remove(oldest)
+
+        session = self.sessions[device] = Session(device)
+        metrics.increment('sessions_started')
+        metrics.set_gauge('sessions_active', len(self.sessions))
+        logger.info(f'BLE session started: {session.name} ({len(self.sessions)} active)')
+        self.notify_listeners()
+        return session
+
+    def remove(self, device):
+        session = self.sessions.pop(session_key(device), None)
+        if session is None:
+            return
+
+        session.requests.clear()
+        metrics.increment('sessions_ended')
+        metrics.set_gauge('sessions_active', len(self.sessions))
+        if session.requests_handled:
+            average_ms = session.total_latency / session.requests_handled * 1000
+            logger.info(f'BLE session ended: {session.name}, {session.requests_handled} requests, '
+                        f'average {average_ms:.1f} ms, max {session.max_latency * 1000:.1f} ms')
+        else:
+            logger.info(f'BLE session ended: {session.name}')
+        self.notify_listeners()
+
+    def notify_listeners(self):
+        for callback in self.listeners:
+            callback()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def is_active(self, session):
+        ''' Returns True if session is still registered
+
+        '''
+        return self.sessions.get(session.device) is session
+
+    def min_mtu(self):
+        ''' Returns the smallest MTU reported by any session
+
+            Sessions that never reported one (writes without a device, or a
+            central that left before BlueZ passed its MTU) are left out, so
+            they cannot hold every central to the default MTU.
+        '''
+        return min((session.mtu for session in self.sessions.values() if session.mtu_reported),
+                   default=DEFAULT_ATT_MTU)
+
+    def tx_encoding(self, encoding):
+        ''' Returns the encoding to send a response in, given the one its session asked for
+
+        '''
+        if len(self.sessions) > 1:
+            return ENCODING_JSON
+        return encoding
+
+    def pending_requests(self):
+        ''' Returns the number of queued and in-flight requests across all sessions
+
+        '''
+        return sum(len(session.requests) + session.in_flight for session in self.sessions.values())
+
+    def queued_requests(self):
+        return sum(len(session.requests) for session in self.sessions.values())
+
+    def enqueue(self, session, request):
+        ''' Queue a request for session and schedule pending work
+
+            Requests wait in their session's queue rather than the dispatcher's,
+            so the dispatcher's queue_depth bounds the backlog of all sessions.
+            A request that starts at once on an idle worker never counts
+            against it.
+
+            Returns: False if the session's queue or the backlog is full
+        '''
+        # Responses use the encoding in effect when the request arrived
+        entry = (request, time.monotonic(), is_mutating_request(request), session.encoding)
+        session.requests.append(entry)
+        self.schedule()
+
+        accepted = True
+        if session.requests and session.requests[-1] is entry and (
+                len(session.requests) > self.max_queued or self.queued_requests() > self.dispatcher.queue_depth):
+            session.requests.pop()
+            metrics.increment('requests_rejected')
+            accepted = False
+
+        self.notify_listeners()
+        return accepted
+
+    def schedule(self):
+        ''' Hand queued requests to idle workers, one session at a time in turn
+
+        '''
+        while self.dispatcher.has_idle_worker():
+            session = self.next_ready_session()
+            if session is None:
+                return
+
+            entry = session.requests.popleft()
+            request, queued_at, mutating, encoding = entry
+            self.set_in_flight(session, mutating, 1)
+            queued = self.dispatcher.submit(self.handler, (request,),
+                                            partial(self.request_complete, session, queued_at, mutating, encoding),
+                                            label=f'BLE request ({session.name})')
+            if not queued:
+                self.set_in_flight(session, mutating, -1)
+                session.requests.appendleft(entry)
+                return
+
+    def set_in_flight(self, session, mutating, delta):
+        session.in_flight += delta
+        if mutating:
+            session.mutation_in_flight = delta > 0
+            self.mutation_in_flight = delta > 0
+
+    def can_start(self, session):
+        ''' Returns True if the request at the head of session's queue may start now
+
+            Requests start in the order they were written, so a request queued
+            behind a mutating one sees its effects.
+        '''
+        if not session.requests or session.mutation_in_flight:
+            return False
+
+        mutating = session.requests[0][2]
+        if mutating:
+            # Configuration changes are serialized across all sessions too
+            return session.in_flight == 0 and not self.mutation_in_flight
+
+        return session.in_flight < self.max_in_flight
+
+    def next_ready_session(self):
+        sessions = list(self.sessions.values())
+        for i in range(len(sessions)):
+            index = (self.rotation + i) % len(sessions)
+            session = sessions[index]
+            if self.can_start(session):
+                self.rotation = index + 1
+                return session
+        return None
+
+    def request_complete(self, session, queued_at, mutating, encoding, response):
+        self.set_in_flight(session, mutating, -1)
+        session.record_latency(time.monotonic() - queued_at)
+
+        # Don't deliver to a central that has gone away meanwhile
+        if self.is_active(session):
+            self.deliver(session, response, encoding)
+
+        self.schedule()
+        self.notify_listeners()
+
+    def watch_connections(self, bus):
+        ''' Start and end sessions as BlueZ reports their device connected or disconnected
+
+        '''
+        bus.add_signal_receiver(self.on_device_properties_changed,
+                                signal_name='PropertiesChanged',
+                                dbus_interface=constants.DBUS_PROP_IFACE,
+                                bus_name=constants.BLUEZ_SERVICE_NAME,
+                                arg0=BLUEZ_DEVICE_IFACE,
+                                path_keyword='path')
+
+    def on_device_properties_changed(self, interface, changed, invalidated, path=None):
+        connected = changed.get('Connected')
+        if connected == False:
+            self.remove(path)
+        elif connected == True:
+            self.get(path)
@@ -0,0 +1,121 @@
+""" Startup orchestration for piaware-ble-connect
+
+    Brings the service up to the point where it can advertise: restarts
+    piaware-configurator and, while that runs, looks up the BLE adapter, reads
+    the Pi model and imports the HTTP client. Once the configurator restart
+    has finished, readiness is probed by reading the piaware-config BLE
+    settings. The wifi scan is only started if BLE setup is enabled. Each
+    phase is recorded so time-to-first-advertisement can be measured.
+
+"""
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from bluez import find_adapter
+from configurator_client import preload as preload_http_client
+from piaware_helpers import get_rpi_model_and_serial_number
+from request_handlers import ble_enabled, get_ble_advertisement_identifier
+from services import restart_piaware_configurator, start_piaware_wifi_scan
+
+logger = logging.getLogger('piaware_ble_connect')
+
+# Seconds to wait for the piaware-configurator restart to complete
+CONFIGURATOR_RESTART_TIMEOUT = 30
+
+StartupResult = namedtuple('StartupResult', ['enabled', 'adapter', 'advertisement_name'])
+
+
+class StartupTimeline():
+    ''' Records the start and duration of each startup phase
+
+    '''
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.phases = []
+        self.reported = False
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, started - self.start_time, time.monotonic() - started))
+
+    def mark(self, name):
+        self.phases.append((name, time.monotonic() - self.start_time, 0))
+
+    def record_imports(self, started, finished):
+        ''' Start the timeline at started, a time.monotonic() value taken before the daemon's imports
+
+        '''
+        self.start_time = started
+        self.phases.append(('imports', 0, finished - started))
+
+    def summary(self):
+        return [f'{name:<26} at {offset:6.2f}s, took {duration:6.2f}s'
+                for name, offset, duration in sorted(self.phases, key=lambda phase: phase[1])]
+
+    def log_summary(self):
+        if self.reported:
+            return
+        self.reported = True
+        for line in self.summary():
+            logger.info(f'Startup: {line}')
+
+
+timeline = StartupTimeline()
+
+
+def timed(name, func, *args):
+    with timeline.phase(name):
+        return func(*args)
+
+
+def run_startup(bus, host, port):
+    """ Run the startup phases
+
+        Parameters:
+        bus (dbus.Bus): System bus used to look up the BLE adapter
+        host (str): Host IP of piaware-configurator serving BLE requests
+        port (str): Port number of piaware-configurator serving BLE requests
+
+        Returns: StartupResult
+
+        Raises: dbus.exceptions.DBusException if the BLE adapter lookup failed,
+                e.g. because bluetoothd is not running yet
+    """
+    piaware_configurator_url = f'http://{host}:{port}/configurator'
+
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix='startup') as executor:
+        # Restart piaware_configurator to ensure clean state
+        restart = restart_piaware_configurator()
+
+        # Independent of piaware-configurator, run them while it restarts
+        adapter = executor.submit(timed, 'adapter lookup', find_adapter, bus)
+        rpi_model = executor.submit(timed, 'cpuinfo parse', get_rpi_model_and_serial_number)
+        executor.submit(timed, 'http client import', preload_http_client)
+
+        with timeline.phase('configurator restart'):
+            if restart is not None:
+                result = restart.wait(CONFIGURATOR_RESTART_TIMEOUT)
+                if result != 'done':
+                    logger.error(f'piaware-configurator restart did not complete: {result}')
+
+        # Check piaware-config setting. This doubles as the readiness probe
+        with timeline.phase('configurator ready'):
+            enabled = ble_enabled(piaware_configurator_url)
+
+        if not enabled:
+            return StartupResult(False, None, None)
+
+        wifi_scan = executor.submit(timed, 'wifi scan start', start_piaware_wifi_scan)
+        raspberry_pi_model, _ = rpi_model.result()
+        with timeline.phase('advertisement identifier'):
+            advertisement_name = get_ble_advertisement_identifier(host, port, raspberry_pi_model)
+
+        wifi_scan.result()
+        return StartupResult(True, adapter.result(), advertisement_name)
@@ -0,0 +1,217 @@
+""" Device state push subscriptions
+
+    A session that sends subscribe_device_state receives the full device
+    state once, then only the fields that changed since the last update sent
+    to that session. State is polled from piaware-configurator only while
+    someone is subscribed, and re-checked immediately when piaware's
+    status.json changes. Updates to a session are throttled to at most one
+    per min_interval; changes inside the window are folded into one update.
+
+"""
+import logging
+import math
+import time
+from gi.repository import GLib
+
+from piaware_status import status_reader
+from request_handlers import device_state
+
+logger = logging.getLogger('piaware_ble_connect')
+
+# Seconds between device state polls while any session is subscribed
+POLL_INTERVAL = 2
+
+# Default, smallest and largest allowed seconds between updates to one session
+DEFAULT_MIN_INTERVAL = 1.0
+MIN_INTERVAL_FLOOR = 0.25
+MIN_INTERVAL_CEILING = 300.0
+
+STATE_EVENT = 'device_state'
+
+
+def state_delta(previous, current):
+    """ Returns (changed fields, removed field names) between two state payloads
+
+    """
+    changed = {key: value for key, value in current.items()
+               if key not in previous or previous[key] != value}
+    removed = [key for key in previous if key not in current]
+    return changed, removed
+
+
+class Subscription():
+    ''' One session's device state subscription
+
+    '''
+    def __init__(self, session, request_id, min_interval):
+        self.session = session
+        self.request_id = request_id
+        self.min_interval = min_interval
+        self.last_sent = None
+        self.last_push = None
+        self.sequence = 0
+        self.timer_source = None
+
+    def cancel(self):
+        if self.timer_source is not None:
+            GLib.source_remove(self.timer_source)
+            self.timer_source = None
+
+
+class DeviceStateSubscriptions():
+    ''' Pushes device state changes to subscribed sessions
+
+        Must only be used from the mainloop.
+    '''
+    def __init__(self, piaware_configurator_url, dispatcher, send):
+        '''
+            Parameters:
+            piaware_configurator_url (str): URL of piaware-configurator
+            dispatcher (RequestDispatcher): Worker pool device state is fetched on
+            send (callable): send(session, message) queues a message to a session
+        '''
+        self.piaware_configurator_url = piaware_configurator_url
+        self.dispatcher = dispatcher
+        self.send = send
+        self.subscriptions = {}
+        self.state = None
+        self.poll_source = None
+        self.fetch_in_flight = False
+        self.fetch_pending = False
+        status_reader.add_listener(self.on_status_snapshot)
+
+    def subscribe(self, session, request_id, min_interval=None):
+        ''' Start pushing device state to session, replacing any existing subscription
+
+            Returns: the acknowledgement to send to the session
+        '''
+        try:
+            interval = float(min_interval) if min_interval is not None else DEFAULT_MIN_INTERVAL
+        except (TypeError, ValueError, OverflowError):
+            interval = math.nan
+        # json.loads accepts NaN and Infinity, neither can be used as a timeout
+        if not math.isfinite(interval):
+            return {'success': False, 'request_id': request_id, 'error': f'Invalid min_interval: {min_interval}'}
+        min_interval = min(max(interval, MIN_INTERVAL_FLOOR), MIN_INTERVAL_CEILING)
+
+        self.unsubscribe(session)
+        self.subscriptions[session] = Subscription(session, request_id, min_interval)
+        logger.info(f'{session.name}: subscribed to device state (min interval {min_interval}s)')
+
+        if self.poll_source is None:
+            self.poll_source = GLib.timeout_add_seconds(POLL_INTERVAL, self.on_poll)
+
+        # The first update carries the full state
+        if self.state is not None:
+            GLib.idle_add(self.push, self.subscriptions[session])
+        self.fetch()
+
+        return {'success': True, 'request_id': request_id, 'response_payload': {'min_interval': min_interval}}
+
+    def unsubscribe(self, session):
+        ''' Stop pushing to session
+
+            Returns: True if session was subscribed
+        '''
+        subscription = self.subscriptions.pop(session, None)
+        if subscription is None:
+            return False
+
+        subscription.cancel()
+        logger.info(f'{session.name}: unsubscribed from device state')
+
+        if not self.subscriptions and self.poll_source is not None:
+            GLib.source_remove(self.poll_source)
+            self.poll_source = None
+            self.state = None
+        return True
+
+    def retain(self, is_active):
+        ''' Drop subscriptions of sessions for which is_active(session) is False
+
+        '''
+        for session in list(self.subscriptions):
+            if not is_active(session):
+                self.unsubscribe(session)
+
+    def clear(self):
+        for session in list(self.subscriptions):
+            self.unsubscribe(session)
+
+    def on_status_snapshot(self, snapshot):
+        # Called on whichever thread read status.json
+        GLib.idle_add(self.on_status_changed)
+
+    def on_status_changed(self):
+        if self.subscriptions:
+            device_state.invalidate()
+            self.fetch()
+        return GLib.SOURCE_REMOVE
+
+    def on_poll(self):
+        self.fetch()
+        return GLib.SOURCE_CONTINUE
+
+    def fetch(self):
+        if self.fetch_in_flight:
+            self.fetch_pending = True
+            return
+
+        self.fetch_in_flight = True
+        if not self.dispatcher.submit(device_state.get, (self.piaware_configurator_url,),
+                                      self.on_state, label='device state subscription'):
+            self.fetch_in_flight = False
+
+    def on_state(self, response):
+        self.fetch_in_flight = False
+
+        if self.subscriptions and response is not None and response.get('success'):
+            payload = response.get('response_payload')
+            if isinstance(payload, dict) and payload != self.state:
+                self.state = payload
+                for subscription in list(self.subscriptions.values()):
+                    self.push(subscription)
+
+        if self.fetch_pending:
+            self.fetch_pending = False
+            self.fetch()
+
+    def on_throttle_elapsed(self, subscription):
+        subscription.timer_source = None
+        return self.push(subscription)
+
+    def push(self, subscription):
+        ''' Send subscription the fields that changed since its last update, or
+            schedule that for when its throttle window ends
+
+        '''
+        if self.subscriptions.get(subscription.session) is not subscription or self.state is None:
+            return GLib.SOURCE_REMOVE
+
+        wait = 0
+        if subscription.last_push is not None:
+            wait = subscription.last_push + subscription.min_interval - time.monotonic()
+        if wait > 0:
+            if subscription.timer_source is None:
+                subscription.timer_source = GLib.timeout_add(int(wait * 1000) + 1, self.on_throttle_elapsed,
+                                                             subscription)
+            return GLib.SOURCE_REMOVE
+
+        if subscription.last_sent is None:
+            message = {'response_payload': self.state, 'full': True}
+        else:
+            changed, removed = state_delta(subscription.last_sent, self.state)
+            if not changed and not removed:
+                return GLib.SOURCE_REMOVE
+            message = {'response_payload': changed, 'full': False}
+            if removed:
+                message['removed'] = removed
+
+        subscription.cancel()
+        message.update(success=True, request_id=subscription.request_id,
+                       event=STATE_EVENT, sequence=subscription.sequence)
+        subscription.sequence += 1
+        subscription.last_sent = self.state
+        subscription.last_push = time.monotonic()
+        self.send(subscription.session, message)
+        return GLib.SOURCE_REMOVE
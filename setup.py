@@ -8,5 +8,5 @@ setup(
     author_email="eric.tran@flightawre.com",
     license="MIT",
     packages=find_packages(),
-    install_requires=["dbus-python","requests"]
+    install_requires=["dbus-python"]
 )
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The daemon's modules are imported by bare name, as the daemon itself does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-ble-connect'))
@@ -0,0 +1,76 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+from bench_common import serve_configurator
+from request_handlers import device_state, handle_request, response_cache
+
+LATENCY = 0.1
+
+
+@pytest.fixture
+def configurator():
+    calls = []
+
+    def answer(request):
+        calls.append(request.get('request'))
+        time.sleep(LATENCY)
+        return 200, json.dumps({'answer': request.get('request')}).encode('utf-8')
+
+    server = serve_configurator(answer)
+    response_cache.invalidate()
+    device_state.invalidate()
+    yield server.server_address[1], calls
+    server.shutdown()
+
+
+def thread_fan_out(func, items):
+    """ Runs every item on its own thread, like RequestDispatcher.fan_out with enough idle workers """
+    results = [None] * len(items)
+
+    def run(index, item):
+        results[index] = func(item)
+
+    threads = [threading.Thread(target=run, args=(index, item)) for index, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def batch(*requests):
+    return json.dumps({'request': 'batch', 'request_id': 1,
+                       'requests': [{'request': request, 'request_id': i} for i, request in enumerate(requests)]})
+
+
+def test_read_only_items_run_concurrently(configurator):
+    port, calls = configurator
+    started = time.monotonic()
+    response = handle_request('127.0.0.1', port, batch('get_device_info', 'get_wifi_networks', 'piaware_config_read'),
+                              thread_fan_out)
+
+    assert time.monotonic() - started < 2 * LATENCY
+    assert [item['request_id'] for item in response['responses']] == [0, 1, 2]
+    assert all(item['success'] for item in response['responses'])
+    assert sorted(calls) == ['get_device_info', 'get_wifi_networks', 'piaware_config_read']
+
+
+def test_mutating_batch_runs_in_order(configurator):
+    port, calls = configurator
+    requested = []
+
+    def recording_fan_out(func, items):
+        requested.append(items)
+        return thread_fan_out(func, items)
+
+    response = handle_request('127.0.0.1', port, batch('set_wifi_config', 'get_wifi_networks'), recording_fan_out)
+
+    assert not requested
+    assert calls == ['set_wifi_config', 'get_wifi_networks']
+    assert [item['request_id'] for item in response['responses']] == [0, 1]
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('gi')
+from gi.repository import GLib
+
+from dispatcher import RequestDispatcher
+
+
+def run_on_worker(dispatcher, func, args):
+    """ Submit func to dispatcher and run a mainloop until its result is delivered """
+    loop = GLib.MainLoop()
+    results = []
+    assert dispatcher.submit(func, args, lambda result: (results.append(result), loop.quit()))
+    GLib.timeout_add_seconds(10, loop.quit)
+    loop.run()
+    return results[0]
+
+
+class Tracker():
+    """ Records how many calls overlap """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def __call__(self, item):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        if item == 'boom':
+            raise ValueError(item)
+        return item * 2
+
+
+def test_fan_out_shares_items_with_idle_workers():
+    dispatcher = RequestDispatcher(pool_size=3, queue_depth=0)
+    tracker = Tracker()
+
+    started = time.monotonic()
+    results = run_on_worker(dispatcher, dispatcher.fan_out, (tracker, [1, 2, 3, 4, 5, 6]))
+
+    assert results == [2, 4, 6, 8, 10, 12]
+    assert tracker.peak == 3
+    assert time.monotonic() - started < 0.25
+    dispatcher.shutdown()
+
+
+def test_fan_out_uses_only_idle_workers():
+    dispatcher = RequestDispatcher(pool_size=2, queue_depth=2)
+    tracker = Tracker()
+    release = threading.Event()
+
+    # Keep one worker busy for the whole fan-out
+    assert dispatcher.submit(release.wait, (5,), lambda result: None)
+    results = run_on_worker(dispatcher, dispatcher.fan_out, (tracker, [1, 2, 3]))
+    release.set()
+
+    assert results == [2, 4, 6]
+    assert tracker.peak == 1
+    dispatcher.shutdown()
+
+
+def test_fan_out_reports_failed_items_as_none():
+    dispatcher = RequestDispatcher(pool_size=2, queue_depth=0)
+    results = run_on_worker(dispatcher, dispatcher.fan_out, (Tracker(), [1, 'boom', 3]))
+
+    assert results == [2, None, 6]
+    dispatcher.shutdown()
@@ -0,0 +1,208 @@
+import json
+import random
+import struct
+
+import pytest
+
+import framing
+from framing import (FrameDecoder, FrameTooLargeError, FRAME_HEADER, ENCODING_IDS, ENCODING_CBOR,
+                     MAX_FRAME_SIZE, MESSAGE_TERMINATOR, encode_cbor, encode_message, split_payload)
+
+SEEDS = range(20)
+
+MESSAGE = {
+    'request': 'set_wifi_config',
+    'request_id': 42,
+    'request_payload': {'ssid': 'Café ✈ 飞机 🛩', 'country': 'ÅLAND', 'notes': 'ünïcødé ' * 20},
+}
+
+
+def random_splits(data, rng, max_pieces=12):
+    """ Split data into pieces at random byte offsets """
+    cuts = sorted(rng.sample(range(1, len(data)), min(max_pieces, len(data) - 1)))
+    return [data[start:end] for start, end in zip([0] + cuts, cuts + [len(data)])]
+
+
+def decode_cbor(data, position=0):
+    """ Minimal decoder for the subset encode_cbor produces, returns (value, next position) """
+    initial = data[position]
+    major_type, info = initial >> 5, initial & 0x1f
+    position += 1
+    if major_type == 7:
+        if info == 27:
+            return struct.unpack_from('>d', data, position)[0], position + 8
+        return {20: False, 21: True, 22: None}[info], position
+    if info < 24:
+        value = info
+    else:
+        size = {24: 1, 25: 2, 26: 4, 27: 8}[info]
+        value = int.from_bytes(data[position:position + size], 'big')
+        position += size
+    if major_type == 0:
+        return value, position
+    if major_type == 1:
+        return -1 - value, position
+    if major_type == 3:
+        return data[position:position + value].decode('utf-8'), position + value
+    if major_type == 4:
+        items = []
+        for _ in range(value):
+            item, position = decode_cbor(data, position)
+            items.append(item)
+        return items, position
+    if major_type == 5:
+        items = {}
+        for _ in range(value):
+            key, position = decode_cbor(data, position)
+            items[key], position = decode_cbor(data, position)
+        return items, position
+    raise ValueError(f'Unsupported CBOR major type {major_type}')
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_multibyte_utf8_split_at_random_points(seed):
+    rng = random.Random(seed)
+    data = json.dumps(MESSAGE, ensure_ascii=False).encode('utf-8') + MESSAGE_TERMINATOR
+    decoder = FrameDecoder()
+
+    frames = []
+    for piece in random_splits(data, rng):
+        frames.extend(decoder.feed(piece))
+
+    assert len(frames) == 1
+    assert json.loads(frames[0].decode('utf-8')) == MESSAGE
+    assert not decoder.buffer
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_consecutive_messages_split_at_random_points(seed):
+    rng = random.Random(seed)
+    messages = [dict(MESSAGE, request_id=i) for i in range(5)]
+    data = b''.join(json.dumps(message, ensure_ascii=False).encode('utf-8') + MESSAGE_TERMINATOR
+                    for message in messages)
+    decoder = FrameDecoder()
+
+    frames = []
+    for piece in random_splits(data, rng, max_pieces=40):
+        frames.extend(decoder.feed(piece))
+
+    assert [json.loads(frame) for frame in frames] == messages
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_cbor_message_split_at_random_points(seed):
+    rng = random.Random(seed)
+    encoded = encode_message(MESSAGE, ENCODING_CBOR)
+    mtu = rng.choice([23, 27, 64, 185, 247, 517])
+
+    # Chunks as notified, regrouped at random points as a central's reads may be
+    received = random_splits(b''.join(split_payload(encoded, mtu)), rng)
+    data = b''.join(received)
+
+    encoding_id, length = FRAME_HEADER.unpack_from(data)
+    assert encoding_id == ENCODING_IDS[ENCODING_CBOR]
+    assert length == len(data) - FRAME_HEADER.size
+    value, end = decode_cbor(data, FRAME_HEADER.size)
+    assert end == len(data)
+    assert value == MESSAGE
+
+
+def test_cbor_round_trip_of_scalars():
+    values = [0, 23, 24, 255, 256, 65535, 65536, 2 ** 32, -1, -25, -2 ** 40, 1.5, True, False, None, '', 'ü' * 30]
+    for value in values:
+        decoded, end = decode_cbor(encode_cbor(value))
+        assert decoded == value
+        assert end == len(encode_cbor(value))
+
+
+def test_pending_message_up_to_cap_is_kept():
+    decoder = FrameDecoder()
+    start = b'{"filler": "'
+    assert list(decoder.feed(start + b'x' * (MAX_FRAME_SIZE - len(start)))) == []
+    assert len(decoder.buffer) == MAX_FRAME_SIZE
+
+
+def test_pending_message_over_cap_is_rejected():
+    decoder = FrameDecoder()
+    assert MAX_FRAME_SIZE == 8 * 1024
+
+    with pytest.raises(FrameTooLargeError):
+        for piece in [b'{"filler": "' + b'x' * 4096, b'x' * 4096, b'x']:
+            list(decoder.feed(piece))
+
+    assert not decoder.buffer
+
+
+def test_decoder_recovers_after_oversized_message():
+    decoder = FrameDecoder()
+    with pytest.raises(FrameTooLargeError):
+        list(decoder.feed(b'x' * (MAX_FRAME_SIZE + 1)))
+
+    frame = json.dumps(MESSAGE).encode('utf-8')
+    assert list(decoder.feed(frame + MESSAGE_TERMINATOR)) == [frame]
+
+
+def test_configurable_cap():
+    decoder = FrameDecoder(max_frame_size=16)
+    with pytest.raises(FrameTooLargeError):
+        list(decoder.feed(b'{"request": "get_device_info"'))
+
+
+def test_invalid_unterminated_write_is_not_carried_forward():
+    decoder = FrameDecoder()
+    valid = b'{"request": "get_device_info", "request_id": 2}'
+
+    # Legacy centrals send one unterminated document per write
+    assert list(decoder.feed(b'{"request": bad}')) == [b'{"request": bad}']
+    assert list(decoder.feed(valid)) == [valid]
+    assert not decoder.buffer
+
+
+@pytest.mark.parametrize('write', [b'hello', b'{"request": "get_device_info"}}', b'\xff\xfe'])
+def test_write_that_cannot_start_a_document_is_yielded_on_its_own(write):
+    decoder = FrameDecoder()
+    assert list(decoder.feed(write)) == [write]
+    assert not decoder.buffer
+
+
+@pytest.mark.parametrize('prefix', [b'{"request": "get_dev', b'{"request_id": 1', b'{"request_id": 1.',
+                                    b'{"flag": tr', b'{"ssid": "\\u00', b'{"ssid": "\xc3'])
+def test_beginning_of_a_document_is_buffered(prefix):
+    decoder = FrameDecoder()
+    assert list(decoder.feed(prefix)) == []
+    assert decoder.buffer == prefix
+
+
+def test_split_unterminated_document_followed_by_another_request():
+    decoder = FrameDecoder()
+    first = json.dumps(MESSAGE, ensure_ascii=False).encode('utf-8')
+    second = b'{"request": "get_device_state", "request_id": 43}'
+
+    frames = []
+    for start in range(0, len(first), 20):
+        frames.extend(decoder.feed(first[start:start + 20]))
+    frames.extend(decoder.feed(second))
+
+    assert [json.loads(frame) for frame in frames] == [MESSAGE, json.loads(second)]
+    assert not decoder.buffer
+
+
+def test_split_invalid_document_does_not_swallow_the_next_request():
+    decoder = FrameDecoder()
+    valid = b'{"request": "get_device_info", "request_id": 2}'
+
+    assert list(decoder.feed(b'{"request": "get_dev')) == []
+    assert list(decoder.feed(b'ice_info", "request_id": x}')) == [b'{"request": "get_device_info", "request_id": x}']
+    assert list(decoder.feed(valid)) == [valid]
+
+
+@pytest.mark.parametrize('document', [b'{}', b'[]', b'{"a": [1, -2.5e+3, true, false, null, {"b": "\\u00e9\\n"}]}',
+                                      b'"text"', b'0', b'  {"a": 1}'])
+def test_document_split_byte_by_byte_is_yielded_once_complete(document):
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(document)):
+        frames.extend(decoder.feed(document[i:i + 1]))
+
+    assert frames == [document]
+    assert json.loads(frames[0]) == json.loads(document)
@@ -0,0 +1,105 @@
+import pytest
+
+import hardware_identity
+from hardware_identity import DEFAULT_MODEL, HardwareIdentity, get_hardware_identity
+
+SERIAL = '00000000abcdef12'
+
+CASES = {
+    'new-style code from the device tree': dict(
+        device_tree={'revision': 0xc03114, 'serial': SERIAL, 'model': 'Raspberry Pi 4 Model B Rev 1.4'},
+        cpuinfo=None,
+        expected=HardwareIdentity('RPi 4', 'CDEF12', 'c03114', '4GB', 'Sony UK', 'BCM2711')),
+    'new-style code from cpuinfo': dict(
+        device_tree={},
+        cpuinfo=f'processor\t: 0\nRevision\t: a02082\nSerial\t\t: {SERIAL}\nModel\t\t: Raspberry Pi 3 Model B Rev 1.2\n',
+        expected=HardwareIdentity('RPi 3B', 'CDEF12', 'a02082', '1GB', 'Sony UK', 'BCM2837')),
+    'new-style code, 8GB Pi 5 from Sony UK': dict(
+        device_tree={'revision': 0xd04170, 'serial': SERIAL},
+        cpuinfo=None,
+        expected=HardwareIdentity('RPi 5', 'CDEF12', 'd04170', '8GB', 'Sony UK', 'BCM2712')),
+    'old-style code from the legacy index': dict(
+        device_tree={},
+        cpuinfo=f'Revision\t: 000e\nSerial\t\t: {SERIAL}\n',
+        expected=HardwareIdentity('RPi B', 'CDEF12', '000e', '512MB', 'Sony UK', 'BCM2835')),
+    'old-style code with the overvolt bit set': dict(
+        device_tree={},
+        cpuinfo=f'Revision\t: 1000013\nSerial\t\t: {SERIAL}\n',
+        expected=HardwareIdentity('RPi B+', 'CDEF12', '1000013', '512MB', 'Embest', 'BCM2835')),
+    'serial missing from the device tree is read from cpuinfo': dict(
+        device_tree={'revision': 0x9000c1},
+        cpuinfo=f'Revision\t: 9000c1\nSerial\t\t: {SERIAL}\n',
+        expected=HardwareIdentity('RPi Zero W', 'CDEF12', '9000c1', '512MB', 'Sony UK', 'BCM2835')),
+    'unknown code falls back to the device tree model': dict(
+        device_tree={'revision': 0xc03ff0, 'serial': SERIAL, 'model': 'Raspberry Pi Compute Module 9 Rev 1.0'},
+        cpuinfo=None,
+        expected=HardwareIdentity('RPi Compute Module 9', 'CDEF12', 'c03ff0', '4GB', 'Sony UK', 'BCM2711')),
+    'unknown old-style code falls back to the device tree model': dict(
+        device_tree={'model': 'Raspberry Pi Model B Rev 2'},
+        cpuinfo=f'Revision\t: 0001\nSerial\t\t: {SERIAL}\n',
+        expected=HardwareIdentity('RPi Model B', 'CDEF12', '0001', None, None, None)),
+    'malformed cpuinfo': dict(
+        device_tree={},
+        cpuinfo='Revision\t: not-hex\nSerial\n: \nHardware\t: BCM2835\n',
+        expected=HardwareIdentity(DEFAULT_MODEL, None, 'not-hex', None, None, None)),
+    'cpuinfo without a revision or serial': dict(
+        device_tree={},
+        cpuinfo='processor\t: 0\nBogoMIPS\t: 108.00\n',
+        expected=HardwareIdentity(DEFAULT_MODEL, None, None, None, None, None)),
+    'missing cpuinfo and device tree': dict(
+        device_tree={},
+        cpuinfo=None,
+        expected=HardwareIdentity(DEFAULT_MODEL, None, None, None, None, None)),
+}
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    get_hardware_identity.cache_clear()
+    yield
+    get_hardware_identity.cache_clear()
+
+
+def install_files(tmp_path, monkeypatch, device_tree, cpuinfo):
+    """ Point hardware_identity at files under tmp_path; absent entries are left missing """
+    revision = tmp_path / 'linux,revision'
+    serial = tmp_path / 'serial-number'
+    model = tmp_path / 'model'
+    cpuinfo_path = tmp_path / 'cpuinfo'
+
+    if 'revision' in device_tree:
+        revision.write_bytes(device_tree['revision'].to_bytes(4, 'big'))
+    if 'serial' in device_tree:
+        serial.write_bytes(device_tree['serial'].encode('ascii') + b'\0')
+    if 'model' in device_tree:
+        model.write_bytes(device_tree['model'].encode('ascii') + b'\0')
+    if cpuinfo is not None:
+        cpuinfo_path.write_text(cpuinfo)
+
+    monkeypatch.setattr(hardware_identity, 'DEVICE_TREE_REVISION', str(revision))
+    monkeypatch.setattr(hardware_identity, 'DEVICE_TREE_SERIAL', str(serial))
+    monkeypatch.setattr(hardware_identity, 'DEVICE_TREE_MODEL', str(model))
+    monkeypatch.setattr(hardware_identity, 'CPUINFO', str(cpuinfo_path))
+
+
+@pytest.mark.parametrize('case', CASES.values(), ids=CASES.keys())
+def test_get_hardware_identity(tmp_path, monkeypatch, case):
+    install_files(tmp_path, monkeypatch, case['device_tree'], case['cpuinfo'])
+    assert get_hardware_identity() == case['expected']
+
+
+def test_identity_is_cached_until_cleared(tmp_path, monkeypatch):
+    install_files(tmp_path, monkeypatch, {}, f'Revision\t: 000e\nSerial\t\t: {SERIAL}\n')
+    first = get_hardware_identity()
+
+    (tmp_path / 'cpuinfo').write_text(f'Revision\t: a02082\nSerial\t\t: {SERIAL}\n')
+    assert get_hardware_identity() is first
+
+    get_hardware_identity.cache_clear()
+    assert get_hardware_identity().model == 'RPi 3B'
+
+
+def test_read_cpuinfo_stops_after_both_fields(tmp_path):
+    cpuinfo = tmp_path / 'cpuinfo'
+    cpuinfo.write_text(f'Revision\t: 000e\nSerial\t\t: {SERIAL}\nRevision\t: a02082\n')
+    assert hardware_identity.read_cpuinfo(str(cpuinfo)) == ('000e', SERIAL)
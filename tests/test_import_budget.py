@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The daemon script imports both at module level, without them it cannot be loaded at all
+pytest.importorskip('dbus.mainloop.glib')
+pytest.importorskip('gi')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+from import_budget import DEFAULT_BUDGET_MS, measure_median
+from import_profile import format_report
+
+RUNS = 3
+
+
+def test_daemon_imports_within_budget():
+    median, totals, closest = measure_median(RUNS)
+    report = '\n'.join(format_report(closest))
+    assert median <= DEFAULT_BUDGET_MS, (
+        f'Median import time {median:.1f} ms of {totals} is over the {DEFAULT_BUDGET_MS} ms budget\n{report}')
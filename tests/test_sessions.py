@@ -0,0 +1,147 @@
+import json
+
+from framing import (FrameDecoder, DEFAULT_ATT_MTU, ENCODING_CBOR, ENCODING_JSON, FRAME_HEADER, ENCODING_IDS,
+                     encode_message, split_payload)
+from sessions import SessionManager
+
+DEVICE_A = '/org/bluez/hci0/dev_AA_AA_AA_AA_AA_AA'
+DEVICE_B = '/org/bluez/hci0/dev_BB_BB_BB_BB_BB_BB'
+
+
+class FakeDispatcher():
+    pool_size = 2
+    queue_depth = 8
+
+    def add_completion_hook(self, hook):
+        pass
+
+    def has_idle_worker(self):
+        return False
+
+
+class WorkerDispatcher(FakeDispatcher):
+    """ Records submitted jobs instead of running them """
+    def __init__(self, pool_size, queue_depth):
+        self.pool_size = pool_size
+        self.queue_depth = queue_depth
+        self.jobs = []
+
+    def has_idle_worker(self):
+        return len(self.jobs) < self.pool_size
+
+    def submit(self, func, args, callback, label='request'):
+        self.jobs.append((args, callback))
+        return True
+
+
+def make_manager():
+    return SessionManager(FakeDispatcher(), handler=None, deliver=None)
+
+
+def notify(manager, session, message):
+    """ Chunks BlueZ would notify to every subscribed central for one response """
+    return split_payload(encode_message(message, manager.tx_encoding(session.encoding)), 23)
+
+
+def test_single_session_uses_its_encoding():
+    manager = make_manager()
+    session = manager.get(DEVICE_A)
+    session.encoding = ENCODING_CBOR
+
+    chunks = notify(manager, session, {'success': True, 'request_id': 1})
+    assert chunks[0][0] == ENCODING_IDS[ENCODING_CBOR]
+
+
+def test_json_session_reassembly_is_intact_while_another_uses_cbor():
+    manager = make_manager()
+    cbor_session = manager.get(DEVICE_A)
+    json_session = manager.get(DEVICE_B)
+    cbor_session.encoding = ENCODING_CBOR
+
+    # A CBOR body of 0x13 bytes puts a terminator in the frame header
+    cbor_message = {'request_id': 7, 'xy': 'ab'}
+    assert encode_message(cbor_message, ENCODING_CBOR)[:FRAME_HEADER.size] == b'\x02\x00\x00\x00\x13'
+
+    sent = [
+        (json_session, {'success': True, 'request_id': 1, 'response_payload': {'ssid': 'Café'}}),
+        (cbor_session, cbor_message),
+        (json_session, {'success': True, 'request_id': 2}),
+        (cbor_session, {'success': True, 'request_id': 8, 'response_payload': list(range(40))}),
+        (json_session, {'success': False, 'request_id': 3, 'error': 'x' * 50}),
+    ]
+
+    # Every central sees every notification, in order
+    decoder = FrameDecoder()
+    received = []
+    for session, message in sent:
+        for chunk in notify(manager, session, message):
+            received.extend(decoder.feed(chunk))
+
+    assert [json.loads(frame) for frame in received] == [message for _, message in sent]
+    assert not decoder.buffer
+
+
+def test_encoding_applies_again_once_other_session_leaves():
+    manager = make_manager()
+    session = manager.get(DEVICE_A)
+    manager.get(DEVICE_B)
+    assert manager.tx_encoding(ENCODING_CBOR) == ENCODING_JSON
+
+    manager.remove(DEVICE_B)
+    assert manager.tx_encoding(ENCODING_CBOR) == ENCODING_CBOR
+    assert manager.tx_encoding(session.encoding) == ENCODING_JSON
+
+
+def test_sessions_without_a_reported_mtu_do_not_limit_chunk_size():
+    manager = make_manager()
+    manager.get(None)
+    manager.get(DEVICE_A).update_mtu(185)
+    manager.get(DEVICE_B).update_mtu(247)
+
+    assert manager.min_mtu() == 185
+
+
+def test_min_mtu_defaults_until_a_session_reports_one():
+    manager = make_manager()
+    manager.get(None)
+
+    assert manager.min_mtu() == DEFAULT_ATT_MTU
+
+
+def test_request_starts_on_an_idle_worker_with_no_queue():
+    dispatcher = WorkerDispatcher(pool_size=1, queue_depth=0)
+    manager = SessionManager(dispatcher, handler=None, deliver=None)
+    session = manager.get(DEVICE_A)
+
+    assert manager.enqueue(session, b'{"request": "get_device_info", "request_id": 1}')
+    assert len(dispatcher.jobs) == 1
+
+    # Nothing may wait for the busy worker
+    assert not manager.enqueue(session, b'{"request": "get_device_info", "request_id": 2}')
+    assert not session.requests
+
+
+def test_only_waiting_requests_count_against_queue_depth():
+    dispatcher = WorkerDispatcher(pool_size=2, queue_depth=1)
+    manager = SessionManager(dispatcher, handler=None, deliver=None, max_in_flight=2)
+    session = manager.get(DEVICE_A)
+
+    results = [manager.enqueue(session, json.dumps({'request': 'get_device_info', 'request_id': i}).encode())
+               for i in range(4)]
+
+    assert results == [True, True, True, False]
+    assert len(dispatcher.jobs) == 2
+    assert len(session.requests) == 1
+
+
+def test_connected_central_that_has_not_written_forces_json():
+    manager = make_manager()
+    session = manager.get(DEVICE_A)
+    session.encoding = ENCODING_CBOR
+    assert manager.tx_encoding(session.encoding) == ENCODING_CBOR
+
+    manager.on_device_properties_changed('org.bluez.Device1', {'Connected': True}, [], path=DEVICE_B)
+    assert manager.tx_encoding(session.encoding) == ENCODING_JSON
+
+    manager.on_device_properties_changed('org.bluez.Device1', {'Connected': False}, [], path=DEVICE_B)
+    assert manager.tx_encoding(session.encoding) == ENCODING_CBOR
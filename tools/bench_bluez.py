@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+""" Micro-benchmark of GetManagedObjects and Advertisement.GetAll on a synthetic GATT tree
+
+    Compares a cold call (every cached property dictionary invalidated first,
+    which is what each call cost before the tree was cached) with a warm
+    call that reuses the precomputed reply. Both are measured with and
+    without marshalling the reply into a D-Bus message. Objects are created
+    without a bus connection, so no D-Bus daemon is needed.
+
+    Usage: python3 tools/bench_bluez.py [--services N] [--characteristics N] [--descriptors N]
+
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import dbus
+import dbus.lowlevel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-ble-connect'))
+from bluez import Application, Advertisement, Service, Characteristic, Descriptor
+
+MANAGED_OBJECTS_SIGNATURE = 'a{oa{sa{sv}}}'
+PROPERTIES_SIGNATURE = 'a{sv}'
+
+
+def build_tree(services, characteristics, descriptors):
+    app = Application(None)
+    for s in range(services):
+        service = Service(None, s, f'0000{s:04x}-0000-1000-8000-00805f9b34fb', True)
+        for c in range(characteristics):
+            chrc = Characteristic(None, c, f'{s:04x}{c:04x}-0000-1000-8000-00805f9b34fb',
+                                  ['read', 'write', 'notify'], service)
+            chrc.write_acquired = False
+            chrc.notify_acquired = False
+            for d in range(descriptors):
+                chrc.add_descriptor(Descriptor(None, d, '00002901-0000-1000-8000-00805f9b34fb', ['read'], chrc))
+            service.add_characteristic(chrc)
+        app.add_service(service)
+    return app
+
+
+def invalidate_all(app):
+    for service in app.services:
+        service.invalidate_properties()
+        for chrc in service.get_characteristics():
+            chrc.invalidate_properties()
+            for desc in chrc.get_descriptors():
+                desc.invalidate_properties()
+
+
+def marshal(value, signature):
+    message = dbus.lowlevel.SignalMessage('/', 'org.example.Bench', 'Reply')
+    message.append(value, signature=signature)
+    return message
+
+
+def report(name, func, iterations):
+    elapsed = timeit.timeit(func, number=iterations) / iterations
+    print(f'  {name:28} {elapsed * 1e6:10.1f} us/call')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--services', type=int, default=8)
+    parser.add_argument('--characteristics', type=int, default=8, help='Characteristics per service')
+    parser.add_argument('--descriptors', type=int, default=1, help='Descriptors per characteristic')
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    app = build_tree(args.services, args.characteristics, args.descriptors)
+    objects = len(app.GetManagedObjects())
+    print(f'GetManagedObjects ({objects} objects)')
+
+    def cold():
+        invalidate_all(app)
+        return app.GetManagedObjects()
+
+    report('cold', cold, args.iterations)
+    report('warm', app.GetManagedObjects, args.iterations)
+    report('cold + marshal', lambda: marshal(cold(), MANAGED_OBJECTS_SIGNATURE), args.iterations)
+    report('warm + marshal', lambda: marshal(app.GetManagedObjects(), MANAGED_OBJECTS_SIGNATURE), args.iterations)
+
+    advertisement = Advertisement(None, 0, 'peripheral')
+    advertisement.add_service_uuid('ac8602af-0226-4889-b925-d751bdf70001')
+    advertisement.add_local_name('FlightAware Receiver - RPi 4')
+    advertisement.include_tx_power = True
+    print('Advertisement.GetAll')
+
+    def cold_advertisement():
+        advertisement.invalidate_properties()
+        return advertisement.GetAll('org.bluez.LEAdvertisement1')
+
+    report('cold', cold_advertisement, args.iterations * 10)
+    report('warm', lambda: advertisement.GetAll('org.bluez.LEAdvertisement1'), args.iterations * 10)
+
+
+if __name__ == '__main__':
+    main()
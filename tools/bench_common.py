@@ -0,0 +1,81 @@
+""" Helpers shared by the benchmark and replay tools
+
+    Latency percentiles, comparison of results against a --baseline file,
+    and a stand-in piaware-configurator HTTP server.
+
+"""
+import json
+import statistics
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Regressions larger than this fraction are flagged when comparing with --baseline
+REGRESSION_THRESHOLD = 0.10
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    if len(values) == 1:
+        p50 = p95 = p99 = values[0]
+    else:
+        cuts = statistics.quantiles(values, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    return {'p50': round(p50, 3), 'p95': round(p95, 3), 'p99': round(p99, 3),
+            'mean': round(statistics.mean(values), 3), 'max': round(max(values), 3)}
+
+
+def compare(results, baseline, checks):
+    """ Print changes against a baseline results file, flagging regressions
+
+        Parameters:
+        results (dict): Results of this run
+        baseline (dict): Results of an earlier run
+        checks (list): (name, keys, lower_is_better) tuples, keys being the
+                       path to a number in the results
+
+        Returns: True if any check regressed by more than REGRESSION_THRESHOLD
+    """
+    regressed = False
+    for name, keys, lower_is_better in checks:
+        old, new = baseline, results
+        for key in keys:
+            old = old.get(key, {}) if isinstance(old, dict) else None
+            new = new.get(key, {}) if isinstance(new, dict) else None
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+            continue
+        change = (new - old) / old
+        worse = change > REGRESSION_THRESHOLD if lower_is_better else change < -REGRESSION_THRESHOLD
+        regressed = regressed or worse
+        print(f'  {name:24} {old:10.3f} -> {new:10.3f} ({change:+.1%}){"  REGRESSION" if worse else ""}')
+    return regressed
+
+
+def serve_configurator(answer):
+    """ Serve a stand-in piaware-configurator on an ephemeral localhost port
+
+        Parameters:
+        answer (callable): answer(request) called on a server thread with the
+                           decoded JSON request, returns (HTTP status, body bytes)
+
+        Returns: ThreadingHTTPServer, already serving
+    """
+    class StandInConfigurator(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            status, body = answer(request)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInConfigurator)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
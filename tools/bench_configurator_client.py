@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+""" Benchmark per-call latency of piaware-configurator requests
+
+    Runs a local stand-in configurator and compares a fresh connection per
+    call (the previous requests.post behaviour) with the pooled keep-alive
+    ConfiguratorClient.
+
+    Usage: python3 tools/bench_configurator_client.py [--calls N] [--payload-bytes N]
+
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import time
+
+from bench_common import serve_configurator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-ble-connect'))
+from configurator_client import ConfiguratorClient
+
+
+def start_configurator(payload_bytes):
+    body = json.dumps({'success': True, 'filler': 'x' * payload_bytes}).encode('utf-8')
+    return serve_configurator(lambda request: (200, body))
+
+
+def post_per_call(url, json_body):
+    try:
+        import requests
+        return requests.post(url, json=json_body, timeout=20).json()
+    except ImportError:
+        pass
+
+    # requests not installed: open a new connection per call like it did
+    host, port = url.split('//')[1].split('/')[0].split(':')
+    conn = http.client.HTTPConnection(host, int(port), timeout=20)
+    conn.request('POST', '/configurator', body=json.dumps(json_body),
+                 headers={'Content-Type': 'application/json', 'Connection': 'close'})
+    data = conn.getresponse().read()
+    conn.close()
+    return json.loads(data)
+
+
+def measure(func, calls):
+    samples = []
+    for i in range(calls):
+        start = time.perf_counter()
+        func({'request': 'get_device_state', 'request_id': i})
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--payload-bytes', type=int, default=512)
+    args = parser.parse_args()
+
+    server = start_configurator(args.payload_bytes)
+    url = f'http://127.0.0.1:{server.server_address[1]}/configurator'
+
+    client = ConfiguratorClient(url)
+    before = measure(lambda body: post_per_call(url, body), args.calls)
+    after = measure(client.post, args.calls)
+
+    print(f'{args.calls} calls, {args.payload_bytes} byte payload')
+    print(f'connection per call: p50 {before[0]:.3f} ms, p95 {before[1]:.3f} ms')
+    print(f'pooled keep-alive:   p50 {after[0]:.3f} ms, p95 {after[1]:.3f} ms')
+
+    client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+""" End-to-end benchmark of the BLE request path without a radio
+
+    Runs the daemon's UartApplication, UartAdvertisement and BLE_Peripheral
+    on a private D-Bus session bus. A peer process owns org.bluez on that
+    bus and plays the part of BlueZ and the phones: it registers the GATT
+    application and advertisement like GattManager1/LEAdvertisingManager1
+    do, subscribes to the Tx characteristic, and drives WriteValue calls on
+    the Rx characteristic from a number of simulated centrals. The peer also
+    serves a stand-in piaware-configurator with configurable latency and
+    payload sizes.
+
+    Reported: request round-trip time percentiles (overall, per request type
+    and per simulated central, to check that centrals contending for the
+    workers are served fairly), notifications and bytes per response, notification throughput,
+    and daemon CPU time per request. --output writes the results as JSON;
+    --baseline compares against an earlier results file.
+
+    Requires dbus-python, PyGObject and dbus-daemon.
+
+    Usage: python3 tools/bench_e2e.py [--requests N] [--centrals N] [--pipeline N]
+                                      [--mtu MTU] [--latency-ms MS] [--networks N]
+                                      [--output FILE] [--baseline FILE]
+
+"""
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.mainloop.glib
+import dbus.service
+from gi.repository import GLib
+
+from bench_common import compare, percentiles, serve_configurator
+
+DAEMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-ble-connect')
+sys.path.insert(0, DAEMON_DIR)
+import constants
+from framing import MESSAGE_TERMINATOR, chunk_size_for_mtu
+
+ADAPTER_PATH = '/org/bluez/hci0'
+DEFAULT_MIX = ['get_device_info', 'get_device_state', 'piaware_config_read', 'get_wifi_networks',
+               'stream_wifi_networks']
+
+# Compared with --baseline: (name, path in the results, lower is better)
+BASELINE_CHECKS = [('rtt p50 (ms)', ['rtt_ms', 'p50'], True),
+                   ('rtt p95 (ms)', ['rtt_ms', 'p95'], True),
+                   ('rtt p99 (ms)', ['rtt_ms', 'p99'], True),
+                   ('cpu ms/request', ['cpu_ms_per_request'], True),
+                   ('notifications/response', ['notifications_per_response'], True),
+                   ('requests/s', ['requests_per_second'], False)]
+
+
+def load_daemon():
+    """ Import the extensionless piaware_ble_connect script as a module """
+    path = os.path.join(DAEMON_DIR, 'piaware_ble_connect')
+    loader = importlib.machinery.SourceFileLoader('piaware_ble_connect_main', path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+# Stand-in piaware-configurator
+
+def configurator_payload(request, networks, payload_bytes):
+    if request == 'get_wifi_networks':
+        return {'success': True, 'wifi_networks': [
+            {'ssid': f'Network-{i:02d}', 'signal_level': -40 - (i * 7) % 50, 'security': 'WPA2-PSK'}
+            for i in range(networks)]}
+    if request == 'get_device_state':
+        return {'is_connected_to_internet': True, 'network_interface': 'wlan0',
+                'is_receiver_claimed': False, 'filler': 'x' * payload_bytes}
+    if request == 'get_device_info':
+        return {'image_type': 'piaware', 'flightfeeder_serial': None, 'filler': 'x' * payload_bytes}
+    return {'filler': 'x' * payload_bytes}
+
+
+def start_configurator(latency, networks, payload_bytes):
+    def answer(request):
+        time.sleep(latency)
+        # Like piaware-configurator, answer with the bare payload; the daemon adds the envelope
+        return 200, json.dumps(configurator_payload(request.get('request'), networks, payload_bytes)).encode('utf-8')
+
+    return serve_configurator(answer)
+
+
+# Peer process: fake BlueZ adapter and simulated centrals
+
+class Central():
+    def __init__(self, index):
+        self.name = f'dev_BE_EC_00_00_00_{index:02X}'
+        self.device = dbus.ObjectPath(f'{ADAPTER_PATH}/{self.name}')
+        self.outstanding = 0
+        self.rtts = []
+
+
+class FakeAdapter(dbus.service.Object):
+    ''' GattManager1 and LEAdvertisingManager1 stand-in that generates load
+
+    '''
+    def __init__(self, bus, args, uuids, on_finished):
+        dbus.service.Object.__init__(self, bus, ADAPTER_PATH)
+        self.bus = bus
+        self.on_finished = on_finished
+        self.args = args
+        self.rx_uuid, self.tx_uuid = uuids
+        self.rx = None
+        self.centrals = [Central(i) for i in range(args.centrals)]
+        self.next_request_id = 1
+        self.sent = 0
+        self.in_flight = {}
+        self.partial_streams = {}
+        self.buffer = bytearray()
+        self.frame_notifications = 0
+        self.frame_bytes = 0
+        self.notifications = 0
+        self.notification_bytes = 0
+        self.results = []
+        self.errors = 0
+        self.started = None
+        self.registration = {}
+        self.random = random.Random(args.seed)
+
+    @dbus.service.method(constants.GATT_MANAGER_IFACE, in_signature='oa{sv}', out_signature='',
+                         sender_keyword='sender', async_callbacks=('reply', 'error'))
+    def RegisterApplication(self, path, options, sender=None, reply=None, error=None):
+        reply()
+        GLib.idle_add(self.load_application, sender, path)
+
+    @dbus.service.method(constants.GATT_MANAGER_IFACE, in_signature='o', out_signature='')
+    def UnregisterApplication(self, path):
+        pass
+
+    @dbus.service.method(constants.LE_ADVERTISING_MANAGER_IFACE, in_signature='oa{sv}', out_signature='',
+                         sender_keyword='sender')
+    def RegisterAdvertisement(self, path, options, sender=None):
+        started = time.perf_counter()
+        dbus.Interface(self.bus.get_object(sender, path), constants.DBUS_PROP_IFACE).GetAll(
+            constants.LE_ADVERTISEMENT_IFACE)
+        self.registration['advertisement_get_all_ms'] = (time.perf_counter() - started) * 1000
+
+    @dbus.service.method(constants.LE_ADVERTISING_MANAGER_IFACE, in_signature='o', out_signature='')
+    def UnregisterAdvertisement(self, path):
+        pass
+
+    def load_application(self, sender, path):
+        started = time.perf_counter()
+        objects = dbus.Interface(self.bus.get_object(sender, path),
+                                 constants.DBUS_OM_IFACE).GetManagedObjects()
+        self.registration['get_managed_objects_ms'] = (time.perf_counter() - started) * 1000
+
+        tx_path = None
+        for object_path, interfaces in objects.items():
+            chrc = interfaces.get(constants.GATT_CHRC_IFACE)
+            if chrc is None:
+                continue
+            if chrc['UUID'] == self.rx_uuid:
+                self.rx = dbus.Interface(self.bus.get_object(sender, object_path), constants.GATT_CHRC_IFACE)
+            elif chrc['UUID'] == self.tx_uuid:
+                tx_path = object_path
+
+        self.bus.add_signal_receiver(self.on_tx_changed, signal_name='PropertiesChanged',
+                                     dbus_interface=constants.DBUS_PROP_IFACE, path=tx_path,
+                                     byte_arrays=True)
+        dbus.Interface(self.bus.get_object(sender, tx_path), constants.GATT_CHRC_IFACE).StartNotify()
+
+        self.started = time.perf_counter()
+        for central in self.centrals:
+            for _ in range(self.args.pipeline):
+                self.send_request(central)
+        return GLib.SOURCE_REMOVE
+
+    def send_request(self, central):
+        if self.sent >= self.args.requests:
+            return
+
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.sent += 1
+        request = self.random.choice(self.args.mix)
+        payload = json.dumps({'request': request, 'request_id': request_id}).encode('utf-8') + MESSAGE_TERMINATOR
+
+        self.in_flight[request_id] = (central, request, time.perf_counter())
+        central.outstanding += 1
+
+        options = {'device': central.device, 'mtu': dbus.UInt16(self.args.mtu)}
+        chunk_size = chunk_size_for_mtu(self.args.mtu)
+        for i in range(0, len(payload), chunk_size):
+            self.rx.WriteValue(dbus.Array(payload[i:i + chunk_size], signature='y'), options,
+                               reply_handler=lambda: None, error_handler=self.on_write_error)
+
+    def on_write_error(self, error):
+        print(f'WriteValue failed: {error}', file=sys.stderr)
+
+    def on_tx_changed(self, interface, changed, invalidated):
+        value = changed.get('Value')
+        if value is None:
+            return
+
+        self.notifications += 1
+        self.notification_bytes += len(value)
+        self.frame_notifications += 1
+        self.frame_bytes += len(value)
+        self.buffer.extend(value)
+
+        while True:
+            end = self.buffer.find(MESSAGE_TERMINATOR)
+            if end < 0:
+                break
+            frame = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            self.on_response(frame)
+
+    def on_response(self, frame):
+        now = time.perf_counter()
+        notifications, self.frame_notifications = self.frame_notifications, 0
+        frame_bytes, self.frame_bytes = self.frame_bytes, 0
+
+        try:
+            response = json.loads(frame)
+        except ValueError:
+            self.errors += 1
+            return
+
+        request_id = response.get('request_id')
+        if request_id not in self.in_flight:
+            self.errors += 1
+            return
+
+        # Streamed responses (stream_wifi_networks) complete with their last page
+        if 'sequence' in response and not response.get('end_of_stream'):
+            earlier_notifications, earlier_bytes = self.partial_streams.get(request_id, (0, 0))
+            self.partial_streams[request_id] = (earlier_notifications + notifications, earlier_bytes + frame_bytes)
+            return
+
+        earlier_notifications, earlier_bytes = self.partial_streams.pop(request_id, (0, 0))
+        notifications += earlier_notifications
+        frame_bytes += earlier_bytes
+        central, request, sent_at = self.in_flight.pop(request_id)
+        central.outstanding -= 1
+        if not response.get('success'):
+            self.errors += 1
+        rtt = (now - sent_at) * 1000
+        central.rtts.append(rtt)
+        self.results.append((request, rtt, notifications, frame_bytes))
+
+        if self.sent >= self.args.requests and not self.in_flight:
+            self.finish()
+        else:
+            self.send_request(central)
+
+    def finish(self):
+        duration = time.perf_counter() - self.started
+        rtts = [rtt for _, rtt, _, _ in self.results]
+        per_request = {}
+        for request in sorted(set(request for request, _, _, _ in self.results)):
+            rows = [row for row in self.results if row[0] == request]
+            per_request[request] = {
+                'count': len(rows),
+                'rtt_ms': percentiles([rtt for _, rtt, _, _ in rows]),
+                'notifications_per_response': round(statistics.mean(n for _, _, n, _ in rows), 2),
+                'bytes_per_response': round(statistics.mean(b for _, _, _, b in rows), 1),
+            }
+
+        print(json.dumps({
+            'requests': len(self.results),
+            'errors': self.errors,
+            'duration_s': round(duration, 3),
+            'requests_per_second': round(len(self.results) / duration, 1) if duration else None,
+            'rtt_ms': percentiles(rtts),
+            'notifications_per_response': round(self.notifications / max(len(self.results), 1), 2),
+            'notification_bytes_per_second': round(self.notification_bytes / duration, 1) if duration else None,
+            'per_request': per_request,
+            'per_central': {central.name: {'count': len(central.rtts), 'rtt_ms': percentiles(central.rtts)}
+                            for central in self.centrals},
+            'registration': {k: round(v, 3) for k, v in self.registration.items()},
+        }), flush=True)
+        self.on_finished()
+
+
+def run_peer(args):
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    server = start_configurator(args.latency_ms / 1000, args.networks, args.payload_bytes)
+
+    daemon = load_daemon()
+    mainloop = GLib.MainLoop()
+    bus_name = dbus.service.BusName(constants.BLUEZ_SERVICE_NAME, bus)
+    adapter = FakeAdapter(bus, args, (daemon.UART_RX_CHARACTERISTIC_UUID, daemon.UART_TX_CHARACTERISTIC_UUID),
+                          mainloop.quit)
+
+    print(json.dumps({'port': server.server_address[1]}), flush=True)
+    mainloop.run()
+    server.shutdown()
+
+
+# Harness: private bus and the daemon under test
+
+def start_bus():
+    bus_daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                                  stdout=subprocess.PIPE, text=True)
+    address = bus_daemon.stdout.readline().strip()
+    if not address:
+        bus_daemon.kill()
+        sys.exit('dbus-daemon did not report an address')
+    return bus_daemon, address
+
+
+def run_harness(args):
+    bus_daemon, address = start_bus()
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+    peer = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--peer'] + sys.argv[1:],
+                            stdout=subprocess.PIPE, text=True, env=env)
+    try:
+        ready = json.loads(peer.stdout.readline())
+        os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+
+        daemon = load_daemon()
+        daemon.BLE_host = '127.0.0.1'
+        daemon.BLE_port = str(ready['port'])
+        daemon.request_dispatcher = daemon.RequestDispatcher(args.workers, args.queue_depth)
+
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        bus = dbus.SessionBus()
+        peripheral = daemon.BLE_Peripheral(bus, ADAPTER_PATH, 'PiAware benchmark')
+
+        results = {}
+
+        def on_peer_output(fd, condition):
+            line = peer.stdout.readline()
+            if line:
+                results.update(json.loads(line))
+            peripheral.mainloop.quit()
+            return GLib.SOURCE_REMOVE
+
+        GLib.io_add_watch(peer.stdout.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP, on_peer_output)
+        GLib.timeout_add_seconds(args.timeout, lambda: peripheral.mainloop.quit())
+
+        cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+        peripheral.register_application()
+        peripheral.start_advertising()
+        peripheral.run()
+        cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+        daemon.request_dispatcher.shutdown()
+    finally:
+        peer.kill()
+        bus_daemon.kill()
+
+    if not results:
+        sys.exit('Benchmark did not complete')
+
+    cpu_seconds = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+    results['cpu_ms_per_request'] = round(cpu_seconds * 1000 / max(results['requests'], 1), 3)
+    results['config'] = {key: getattr(args, key) for key in
+                         ['requests', 'centrals', 'pipeline', 'mtu', 'latency_ms', 'networks', 'payload_bytes',
+                          'workers', 'queue_depth', 'mix', 'seed']}
+
+    rtt = results['rtt_ms']
+    print(f'{results["requests"]} requests ({results["errors"]} errors) in {results["duration_s"]} s, '
+          f'{results["requests_per_second"]} req/s')
+    print(f'rtt ms: p50 {rtt.get("p50")} p95 {rtt.get("p95")} p99 {rtt.get("p99")} max {rtt.get("max")}')
+    print(f'{results["notifications_per_response"]} notifications/response, '
+          f'{results["notification_bytes_per_second"]} B/s, {results["cpu_ms_per_request"]} ms CPU/request')
+    for request, row in results['per_request'].items():
+        print(f'  {request:22} n={row["count"]:5} p50 {row["rtt_ms"]["p50"]:8.2f} ms  '
+              f'p95 {row["rtt_ms"]["p95"]:8.2f} ms  {row["notifications_per_response"]:6.1f} ntf  '
+              f'{row["bytes_per_response"]:8.1f} B')
+    if len(results['per_central']) > 1:
+        for central, row in results['per_central'].items():
+            rtt = row['rtt_ms']
+            if not rtt:
+                continue
+            print(f'  {central:22} n={row["count"]:5} p50 {rtt["p50"]:8.2f} ms  p95 {rtt["p95"]:8.2f} ms  '
+                  f'p99 {rtt["p99"]:8.2f} ms')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f'compared with {args.baseline}:')
+        if compare(results, baseline, BASELINE_CHECKS):
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500, help='Total number of requests to send')
+    parser.add_argument('--centrals', type=int, default=1, help='Number of simulated centrals')
+    parser.add_argument('--pipeline', type=int, default=1, help='Outstanding requests per central')
+    parser.add_argument('--mtu', type=int, default=185, help='ATT MTU the centrals report')
+    parser.add_argument('--latency-ms', type=float, default=5, help='Stand-in configurator latency per call')
+    parser.add_argument('--networks', type=int, default=20, help='Networks in get_wifi_networks responses')
+    parser.add_argument('--payload-bytes', type=int, default=64, help='Filler bytes in other responses')
+    parser.add_argument('--mix', nargs='+', default=DEFAULT_MIX, help='Request types to send, chosen at random')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--queue-depth', type=int, default=8)
+    parser.add_argument('--timeout', type=int, default=300, help='Give up after this many seconds')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--baseline', help='Compare with an earlier --output file, exit 1 on regression')
+    parser.add_argument('--peer', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.peer:
+        run_peer(args)
+    else:
+        run_harness(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+""" Compare bytes on air and notification counts for each Tx encoding
+
+    Bytes on air counts the notification payloads plus the 3 byte ATT header
+    of each notification. Link layer overhead is the same per notification
+    for every encoding and is not included.
+
+    Usage: python3 tools/bench_encoding.py [--networks N] [--mtu MTU ...]
+
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-ble-connect'))
+from framing import encode_message, split_payload, ENCODINGS, ATT_HEADER_SIZE
+
+
+def device_info_response():
+    return {'success': True, 'request_id': 1, 'response_payload': {
+        'image_type': 'piaware', 'piaware_version': '9.0.1', 'flightfeeder_serial': None,
+        'mac_address': 'dc:a6:32:01:02:03', 'feeder_id': '1a2b3c4d-5e6f-7a8b-9c0d-1e2f3a4b5c6d',
+        'site_number': '123456', 'os_version': 'Debian GNU/Linux 12 (bookworm)'}}
+
+
+def device_state_response():
+    return {'success': True, 'request_id': 2, 'response_payload': {
+        'is_connected_to_internet': True, 'network_interface': 'wlan0', 'is_receiver_claimed': True,
+        'is_adsb_receiver_connected': True, 'is_uat_receiver_connected': False,
+        'is_flightaware_connected': True, 'wifi_ssid': 'HomeNetwork', 'ip_address': '192.168.1.42'}}
+
+
+def config_read_response():
+    return {'success': True, 'request_id': 3, 'response_payload': {
+        'allow-ble-setup': 'auto', 'wireless-ssid': 'HomeNetwork', 'wireless-network': 'yes',
+        'wired-network': 'yes', 'wireless-type': 'dhcp', 'wired-type': 'dhcp',
+        'receiver-type': 'rtlsdr', 'uat-receiver-type': 'none', 'allow-auto-updates': 'yes',
+        'allow-manual-updates': 'yes', 'allow-mlat': 'yes', 'mlat-results': 'yes'}}
+
+
+def wifi_networks_response(count):
+    networks = [{'ssid': f'Network-{i:02d}', 'signal_level': -40 - (i % 50), 'security': 'WPA2-PSK',
+                 'frequency': 2412 + 5 * (i % 11)} for i in range(count)]
+    return {'success': True, 'request_id': 4, 'response_payload': {'success': True, 'wifi_networks': networks}}
+
+
+def measure(response, encoding, mtu):
+    chunks = split_payload(encode_message(response, encoding), mtu)
+    return sum(len(chunk) + ATT_HEADER_SIZE for chunk in chunks), len(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--networks', type=int, default=30, help='Number of networks in the get_wifi_networks sample')
+    parser.add_argument('--mtu', type=int, nargs='+', default=[23, 185, 247], help='Negotiated ATT MTUs to report')
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    samples = [
+        ('get_device_info', device_info_response()),
+        ('get_device_state', device_state_response()),
+        ('piaware_config_read', config_read_response()),
+        (f'get_wifi_networks ({args.networks})', wifi_networks_response(args.networks)),
+    ]
+
+    for name, response in samples:
+        print(name)
+        for encoding in ENCODINGS:
+            encode_time = timeit.timeit(lambda: encode_message(response, encoding),
+                                        number=args.iterations) / args.iterations
+            results = ', '.join(f'MTU {mtu}: {size} B / {count} ntf'
+                                for mtu in args.mtu for size, count in [measure(response, encoding, mtu)])
+            print(f'  {encoding:8} {len(encode_message(response, encoding)):6} B  '
+                  f'{encode_time * 1e6:7.1f} us  {results}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+""" Micro-benchmark comparing the per-character Tx encoder with the bulk framer
+
+    Usage: python3 tools/bench_framing.py [--networks N] [--mtu MTU] [--iterations N]
+
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import dbus
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-ble-connect'))
+from framing import encode_message, split_payload
+
+
+def legacy_encode(s):
+    """ Encoder used by TxCharacteristic.send_tx before bulk framing """
+    chunks = []
+    s_bytes = json.dumps(s) + chr(19)
+    value = []
+    for c in s_bytes:
+        value.append(dbus.Byte(c.encode('utf-8')))
+        if len(value) >= 20:
+            chunks.append(list(value))
+            value.clear()
+    if len(value) > 0:
+        chunks.append(list(value))
+    return chunks
+
+
+def bulk_encode(s, mtu):
+    return [dbus.Array(chunk, signature='y') for chunk in split_payload(encode_message(s), mtu)]
+
+
+def wifi_networks_response(count):
+    networks = [{'ssid': f'Network {i}', 'signal_level': -40 - (i % 50), 'security': 'WPA2'} for i in range(count)]
+    return {'success': True, 'request_id': 1, 'response_payload': {'success': True, 'wifi_networks': networks}}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--networks', type=int, default=40, help='Number of networks in the sample response')
+    parser.add_argument('--mtu', type=int, default=185, help='Negotiated ATT MTU for the bulk framer')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    response = wifi_networks_response(args.networks)
+    payload_size = len(encode_message(response))
+
+    legacy_time = timeit.timeit(lambda: legacy_encode(response), number=args.iterations) / args.iterations
+    bulk_time = timeit.timeit(lambda: bulk_encode(response, args.mtu), number=args.iterations) / args.iterations
+
+    print(f'payload: {payload_size} bytes')
+    print(f'legacy: {legacy_time * 1e6:9.1f} us/response, {len(legacy_encode(response))} notifications')
+    print(f'bulk:   {bulk_time * 1e6:9.1f} us/response, {len(bulk_encode(response, args.mtu))} notifications (MTU {args.mtu})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+""" Check the daemon's import time against a budget
+
+    Imports the daemon script in fresh interpreters with -X importtime, takes
+    the median total over several runs and exits non-zero when it exceeds the
+    budget, so a new heavyweight import on the startup path shows up as a
+    failure rather than as a slower boot. The default budget is meant for a
+    Pi Zero W; pass --budget-ms when checking on faster hardware.
+
+    Usage: python3 tools/import_budget.py [--budget-ms MS] [--runs N]
+
+"""
+import argparse
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-ble-connect'))
+from import_profile import measure_imports, format_report, total_ms
+
+DEFAULT_BUDGET_MS = 1500
+
+
+def measure_median(runs, python=sys.executable):
+    """ Measure the daemon's imports several times
+
+        Parameters:
+        runs (int): Number of fresh interpreters to measure
+        python (str): Interpreter to measure with
+
+        Returns: (median total ms, list of totals, entries of the run closest to the median)
+    """
+    measured = [measure_imports(python=python) for _ in range(runs)]
+    totals = [total_ms(entries) for entries in measured]
+    median = statistics.median(totals)
+    closest = min(measured, key=lambda entries: abs(total_ms(entries) - median))
+    return median, totals, closest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Maximum median import time of the daemon script')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--python', default=sys.executable, help='Interpreter to measure with')
+    args = parser.parse_args()
+
+    median, totals, closest = measure_median(args.runs, args.python)
+
+    # Report the run closest to the median
+    for line in format_report(closest):
+        print(line)
+    print(f'Median of {args.runs} runs: {median:.1f} ms (min {min(totals):.1f}, max {max(totals):.1f}), '
+          f'budget {args.budget_ms:.0f} ms')
+
+    if median > args.budget_ms:
+        print('FAIL: import time is over budget')
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+""" Replay a BLE session recording through the request path
+
+    Reads a file written by piaware-ble-connect --record, reassembles each
+    central's Rx writes into requests, runs them through handle_request on a
+    worker pool against a stand-in piaware-configurator that answers with
+    the recorded HTTP responses, and frames every response for the
+    central's recorded MTU and Tx encoding. Rx writes are fed either at
+    their recorded pace or as fast as possible.
+
+    Reported: request latency percentiles (overall and per request type),
+    and how many replayed Tx messages are byte-for-byte identical to the
+    recorded ones. --output writes the results as JSON; --baseline compares
+    against an earlier results file, so the same recording can be replayed
+    against two versions of the daemon.
+
+    Local requests (set_encoding, state subscriptions) only update the Tx
+    encoding; their acknowledgements and pushes are not replayed.
+
+    Usage: python3 tools/replay_session.py RECORDING [--pace recorded|fast] [--workers N]
+                                          [--output FILE] [--baseline FILE]
+
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_common import compare, percentiles, serve_configurator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'piaware-ble-connect'))
+from framing import FrameDecoder, FrameTooLargeError, encode_message, split_payload, DEFAULT_ATT_MTU, ENCODING_JSON
+from recorder import (read_recording, MTU_PAYLOAD, RECORD_SESSION, RECORD_MTU, RECORD_RX, RECORD_TX,
+                      RECORD_TX_END, RECORD_HTTP)
+from request_handlers import handle_request, parse_local_request, ResponseStream, ENCODING_REQUEST
+
+# Compared with --baseline: (name, path in the results, lower is better)
+BASELINE_CHECKS = [(f'latency {name} (ms)', ['latency_ms', name], True) for name in ('p50', 'p95', 'p99')]
+
+
+class ReplaySession():
+    def __init__(self, name):
+        self.name = name
+        self.mtu = DEFAULT_ATT_MTU
+        self.encoding = ENCODING_JSON
+        self.decoder = FrameDecoder()
+        self.recorded_messages = []
+        self.pending_chunks = []
+
+
+# Stand-in piaware-configurator answering with the recorded responses
+
+def recorded_exchanges(records):
+    """ Returns {request type: deque of recorded exchanges}, in recorded order """
+    exchanges = defaultdict(deque)
+    for record in records:
+        if record.type == RECORD_HTTP:
+            exchange = json.loads(record.payload)
+            exchanges[exchange['request'].get('request')].append(exchange)
+    return exchanges
+
+
+def start_configurator(exchanges, recorded_latency):
+    lock = threading.Lock()
+
+    def answer(request):
+        with lock:
+            queue = exchanges.get(request.get('request'))
+            # Keep answering with the last recorded response once they run out
+            exchange = None
+            if queue:
+                exchange = queue.popleft() if len(queue) > 1 else queue[0]
+
+        if exchange is None:
+            return 404, b''
+
+        if recorded_latency:
+            time.sleep(exchange['ms'] / 1000)
+        response = exchange['response']
+        if response is None:
+            body = b''
+        elif isinstance(response, str):
+            body = response.encode('utf-8')
+        else:
+            body = json.dumps(response).encode('utf-8')
+        return exchange['status'], body
+
+    return serve_configurator(answer)
+
+
+def request_type(frame):
+    try:
+        return str(json.loads(frame).get('request'))
+    except (ValueError, AttributeError):
+        return 'invalid'
+
+
+def frame_response(response, session, encoding):
+    """ Returns the notification chunks of each Tx message for a response """
+    if response is None:
+        response = {'success': False}
+    pages = response.pages if isinstance(response, ResponseStream) else [response]
+    return [split_payload(encode_message(page, encoding), session.mtu) for page in pages]
+
+
+def replay(args):
+    _, records = read_recording(args.recording)
+    records.sort(key=lambda record: record.offset)
+
+    exchanges = recorded_exchanges(records)
+    recorded_configurator_ms = [exchange['ms'] for queue in exchanges.values() for exchange in queue]
+    server = start_configurator(exchanges, args.pace == 'recorded')
+    port = str(server.server_address[1])
+
+    sessions = {}
+    latencies = defaultdict(list)
+    replayed_messages = defaultdict(list)
+    results_lock = threading.Lock()
+    counts = Counter()
+
+    def run_request(session, frame, encoding, received):
+        response = handle_request('127.0.0.1', port, frame)
+        messages = frame_response(response, session, encoding)
+        elapsed = (time.perf_counter() - received) * 1000
+        with results_lock:
+            latencies[request_type(frame)].append(elapsed)
+            replayed_messages[session.name].extend(messages)
+
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='replay')
+    started = time.perf_counter()
+    for record in records:
+        session = sessions.get(record.session)
+        if record.type == RECORD_SESSION:
+            sessions[record.session] = ReplaySession(record.payload.decode('utf-8', errors='replace'))
+        elif session is None:
+            continue
+        elif record.type == RECORD_MTU:
+            (session.mtu,) = MTU_PAYLOAD.unpack(record.payload)
+        elif record.type in (RECORD_TX, RECORD_TX_END):
+            session.pending_chunks.append(record.payload)
+            if record.type == RECORD_TX_END:
+                session.recorded_messages.append(session.pending_chunks)
+                session.pending_chunks = []
+        elif record.type == RECORD_RX:
+            if args.pace == 'recorded':
+                delay = started + record.offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                frames = list(session.decoder.feed(record.payload))
+            except FrameTooLargeError:
+                counts['too_large'] += 1
+                continue
+            for frame in frames:
+                local_request = parse_local_request(frame)
+                if local_request is not None:
+                    request, _, payload = local_request
+                    if request == ENCODING_REQUEST:
+                        session.encoding = payload.get('encoding', session.encoding)
+                    counts['local'] += 1
+                    continue
+                counts['requests'] += 1
+                executor.submit(run_request, session, frame, session.encoding, time.perf_counter())
+
+    executor.shutdown(wait=True)
+    duration = time.perf_counter() - started
+    server.shutdown()
+
+    # Replayed messages that match a recorded message of the same central, byte for byte
+    recorded_total = matching = 0
+    for session in sessions.values():
+        recorded = Counter(b''.join(message) for message in session.recorded_messages)
+        recorded_total += len(session.recorded_messages)
+        for message in replayed_messages[session.name]:
+            key = b''.join(message)
+            if recorded[key]:
+                recorded[key] -= 1
+                matching += 1
+
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    replayed_total = sum(len(messages) for messages in replayed_messages.values())
+    return {
+        'recording': os.path.basename(args.recording),
+        'pace': args.pace,
+        'sessions': len(sessions),
+        'requests': counts['requests'],
+        'local_requests': counts['local'],
+        'too_large': counts['too_large'],
+        'duration_s': round(duration, 3),
+        'requests_per_second': round(counts['requests'] / duration, 1) if duration else 0,
+        'latency_ms': percentiles(all_latencies),
+        'recorded_configurator_ms': percentiles(recorded_configurator_ms),
+        'per_request': {request: {'count': len(values), 'latency_ms': percentiles(values)}
+                        for request, values in sorted(latencies.items())},
+        'tx_messages_recorded': recorded_total,
+        'tx_messages_replayed': replayed_total,
+        'tx_messages_identical': matching,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording', help='File written by piaware-ble-connect --record')
+    parser.add_argument('--pace', choices=['recorded', 'fast'], default='recorded',
+                        help='Feed Rx writes and configurator responses at the recorded pace, or without delays')
+    parser.add_argument('--workers', type=int, default=2, help='Worker threads, as --workers of the daemon')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--baseline', help='Compare with an earlier --output file, exit 1 on regression')
+    args = parser.parse_args()
+
+    results = replay(args)
+
+    latency = results['latency_ms']
+    print(f'{results["requests"]} requests from {results["sessions"]} sessions in {results["duration_s"]} s '
+          f'({args.pace} pace), {results["requests_per_second"]} req/s')
+    print(f'latency ms: p50 {latency.get("p50")} p95 {latency.get("p95")} p99 {latency.get("p99")} '
+          f'max {latency.get("max")}')
+    for request, row in results['per_request'].items():
+        print(f'  {request:22} n={row["count"]:5} p50 {row["latency_ms"]["p50"]:8.2f} ms  '
+              f'p95 {row["latency_ms"]["p95"]:8.2f} ms')
+    print(f'Tx messages: {results["tx_messages_replayed"]} replayed, {results["tx_messages_recorded"]} recorded, '
+          f'{results["tx_messages_identical"]} identical')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f'compared with {args.baseline}:')
+        if compare(results, baseline, BASELINE_CHECKS):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+""" Soak test: leak check of the daemon under sustained load
+
+    Runs the daemon's BLE_Peripheral in this process on a private D-Bus bus,
+    with the fake BlueZ adapter, simulated centrals and stand-in
+    piaware-configurator of bench_e2e.py in a peer process. For the whole
+    run the centrals keep sending requests and advertising is switched off
+    and on again at a fixed interval. Resource usage (RSS, tracemalloc, fds,
+    threads) is sampled periodically. The sample taken after the warm-up
+    period, once caches and worker pools have filled, is the baseline; the
+    final sample is taken when the load ends, before anything is torn down.
+
+    Fails (exit 1) when growth between the baseline and the final sample
+    exceeds the thresholds, and prints the allocation sites that grew the
+    most.
+
+    Requires dbus-python, PyGObject and dbus-daemon.
+
+    Usage: python3 tools/soak.py [--duration S] [--warmup S] [--cycle-interval-ms MS]
+                                 [--max-traced-growth-kb KB] [--max-rss-growth-kb KB]
+                                 [--max-fd-growth N] [--max-thread-growth N]
+
+"""
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+# bench_e2e also puts the daemon's directory on sys.path
+import bench_e2e
+from bench_e2e import ADAPTER_PATH, load_daemon, start_bus
+from diagnostics import format_usage, memory_tracker, resource_usage
+from metrics import metrics
+
+TRACEMALLOC_FRAMES = 10
+
+# The peer stops after this many requests, far more than any run sends
+UNLIMITED_REQUESTS = 10 ** 9
+
+
+def growth(baseline, final):
+    return {field: getattr(final, field) - getattr(baseline, field)
+            for field in ('rss_kb', 'traced_kb', 'fds', 'threads')}
+
+
+def check(args, baseline, final):
+    """ Returns a list of threshold violations """
+    delta = growth(baseline, final)
+    limits = [('traced_kb', args.max_traced_growth_kb, 'traced memory grew {} KiB'),
+              ('rss_kb', args.max_rss_growth_kb, 'RSS grew {} KiB'),
+              ('fds', args.max_fd_growth, 'open fds grew by {}'),
+              ('threads', args.max_thread_growth, 'threads grew by {}')]
+    return [message.format(delta[field]) for field, limit, message in limits if delta[field] > limit]
+
+
+def handled_requests():
+    """ Returns (requests, errors) the daemon has answered, from its metrics """
+    _, _, histograms = metrics.snapshot()
+    requests = errors = 0
+    for name, histogram in histograms.items():
+        if name.startswith('ble_request_ms{'):
+            requests += histogram['count']
+            if 'outcome=error' in name:
+                errors += histogram['count']
+    return requests, errors
+
+
+def run_soak(args):
+    bus_daemon, address = start_bus()
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+    peer_args = ['--peer', '--requests', str(UNLIMITED_REQUESTS), '--centrals', str(args.centrals),
+                 '--pipeline', str(args.pipeline), '--latency-ms', str(args.latency_ms), '--seed', str(args.seed)]
+    peer = subprocess.Popen([sys.executable, bench_e2e.__file__] + peer_args,
+                            stdout=subprocess.PIPE, text=True, env=env)
+    cycles = 0
+    peer_exited = False
+    try:
+        ready = json.loads(peer.stdout.readline())
+        os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+
+        memory_tracker.start(TRACEMALLOC_FRAMES)
+        daemon = load_daemon()
+        daemon.BLE_host = '127.0.0.1'
+        daemon.BLE_port = str(ready['port'])
+        daemon.request_dispatcher = daemon.RequestDispatcher(args.workers, args.queue_depth)
+
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        bus = dbus.SessionBus()
+        peripheral = daemon.BLE_Peripheral(bus, ADAPTER_PATH, 'PiAware soak test')
+        started = time.monotonic()
+        baseline = None
+
+        def on_peer_output(fd, condition):
+            # The peer only writes again, or closes its output, if it stopped early
+            nonlocal peer_exited
+            peer_exited = True
+            peripheral.mainloop.quit()
+            return GLib.SOURCE_REMOVE
+
+        def toggle_advertising():
+            nonlocal cycles
+            if peripheral.is_advertising:
+                peripheral.stop_advertising()
+                cycles += 1
+            else:
+                peripheral.start_advertising()
+            return GLib.SOURCE_CONTINUE
+
+        def sample():
+            nonlocal baseline
+            usage = resource_usage()
+            elapsed = time.monotonic() - started
+            print(f'{elapsed:7.1f}s  {format_usage(usage)}', flush=True)
+            if baseline is None and elapsed >= args.warmup:
+                gc.collect()
+                baseline = resource_usage()
+                memory_tracker.snapshot()
+            return GLib.SOURCE_CONTINUE
+
+        GLib.io_add_watch(peer.stdout.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP, on_peer_output)
+        GLib.timeout_add(args.cycle_interval_ms, toggle_advertising)
+        GLib.timeout_add_seconds(args.sample_interval, sample)
+        GLib.timeout_add_seconds(args.duration, lambda: peripheral.mainloop.quit())
+
+        peripheral.register_application()
+        peripheral.start_advertising()
+        peripheral.run()
+
+        # Sample at the end of the load phase, in the same state as the baseline;
+        # teardown below releases workers, fds and the peer process
+        gc.collect()
+        final = resource_usage()
+        top_growth = memory_tracker.snapshot()
+        requests, errors = handled_requests()
+
+        peripheral.stop_advertising()
+        daemon.request_dispatcher.shutdown()
+    finally:
+        peer.kill()
+        peer.wait()
+        bus_daemon.kill()
+        bus_daemon.wait()
+
+    print(f'{requests} requests ({errors} errors), {cycles} advertising cycles in '
+          f'{time.monotonic() - started:.1f} s')
+    if peer_exited:
+        sys.exit('The load generating peer stopped before the end of the run')
+    if baseline is None:
+        sys.exit(f'Run ended before the {args.warmup} s warm-up, no baseline to compare with')
+
+    print(f'baseline: {format_usage(baseline)}')
+    print(f'final:    {format_usage(final)}')
+    print('growth:   ' + ', '.join(f'{field} {value:+d}' for field, value in growth(baseline, final).items()))
+    for stat in top_growth:
+        print(f'  {stat}')
+
+    failures = check(args, baseline, final)
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if failures:
+        sys.exit(1)
+    print('OK')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=int, default=120,
+                        help='Seconds to keep the load running, e.g. 900 for the ble_timeout_minutes window')
+    parser.add_argument('--centrals', type=int, default=2, help='Number of simulated centrals')
+    parser.add_argument('--pipeline', type=int, default=2, help='Outstanding requests per central')
+    parser.add_argument('--latency-ms', type=float, default=2, help='Stand-in configurator latency per call')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--queue-depth', type=int, default=8)
+    parser.add_argument('--cycle-interval-ms', type=int, default=200,
+                        help='Switch advertising off or on this often')
+    parser.add_argument('--sample-interval', type=int, default=5, help='Seconds between resource samples')
+    parser.add_argument('--warmup', type=int, default=10, help='Seconds before the baseline sample is taken')
+    parser.add_argument('--max-traced-growth-kb', type=int, default=256)
+    parser.add_argument('--max-rss-growth-kb', type=int, default=2048)
+    parser.add_argument('--max-fd-growth', type=int, default=0)
+    parser.add_argument('--max-thread-growth', type=int, default=0)
+    args = parser.parse_args()
+    if args.warmup + args.sample_interval > args.duration:
+        parser.error('--duration must leave room for at least one sample after the --warmup period')
+
+    run_soak(args)
+
+
+if __name__ == '__main__':
+    main()